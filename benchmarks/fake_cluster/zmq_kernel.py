@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+# stand-in for the ZMQ side of a Jupyter kernel: answers on shell (ROUTER) and publishes on iopub (PUB)
+#
+# usage: zmq_kernel.py <shell port> <iopub port>
+#
+# requests on shell:  ping                      -> pong
+#                     hello                     -> publishes "hello" on iopub (subscription check)
+#                     flood <count> <size> <payload> -> publishes <count> messages of <size> bytes, then "done"
+
+import os;
+import sys;
+import zmq;
+
+shell_port, iopub_port = int(sys.argv[1]), int(sys.argv[2]);
+
+context = zmq.Context();
+shell = context.socket(zmq.ROUTER);
+shell.bind(f'tcp://127.0.0.1:{shell_port}');
+iopub = context.socket(zmq.PUB);
+# a slow tunnel must not drop output, it has to hold it back like a real kernel does
+iopub.setsockopt(zmq.SNDHWM, 0);
+iopub.bind(f'tcp://127.0.0.1:{iopub_port}');
+
+def payload (size, kind):
+
+    if kind == 'random':
+        return os.urandom(size);
+    # rich text output (HTML tables, JSON) compresses well
+    row = b'<tr><td>0.123456</td><td>some text</td><td>42</td></tr>\n';
+    return (row * (size // len(row) + 1))[:size];
+
+print('ready', flush=True);
+while True:
+    frames = shell.recv_multipart();
+    identity, request = frames[0], frames[-1].decode().split();
+    if request[0] == 'ping':
+        shell.send_multipart([identity, b'pong']);
+    elif request[0] == 'hello':
+        iopub.send_multipart([b'hello', b'']);
+        shell.send_multipart([identity, b'ok']);
+    elif request[0] == 'flood':
+        count, size = int(request[1]), int(request[2]);
+        message = payload(size, request[3]);
+        shell.send_multipart([identity, b'ok']);
+        for index in range(count):
+            iopub.send_multipart([b'stream', message]);
+        iopub.send_multipart([b'done', b'']);
+    elif request[0] == 'exit':
+        shell.send_multipart([identity, b'bye']);
+        break;
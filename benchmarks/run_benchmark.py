@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark of the RemoteSlurmProvisioner against local stand-ins for ssh, sbatch and squeue
+"""
+
+import gc;
+import os;
+import sys;
+import json;
+import shutil;
+import signal;
+import asyncio;
+import argparse;
+import tempfile;
+from time import monotonic;
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__));
+fake_cluster = os.path.join(benchmark_directory, 'fake_cluster');
+sys.path.insert(0, os.path.dirname(benchmark_directory));
+
+from slurm_jupyter_kernel.timing import percentile;
+
+class LoopMonitor:
+
+    # measures how long the event loop was blocked: every tick should wake up after `interval`
+    def __init__ (self, interval=0.01):
+
+        self.interval = interval;
+        self.lags = [];
+        self.task = None;
+
+    async def _run (self):
+
+        while True:
+            start = monotonic();
+            await asyncio.sleep(self.interval);
+            self.lags.append(max(0.0, monotonic() - start - self.interval));
+
+    def start (self):
+
+        self.task = asyncio.ensure_future(self._run());
+
+    def stop (self):
+
+        self.task.cancel();
+        return {
+            'max_lag': max(self.lags, default=0.0),
+            'p99_lag': percentile(sorted(self.lags), 99),
+            # sum of all lags beyond a few milliseconds of scheduling noise
+            'blocked_time': sum(lag for lag in self.lags if lag > 0.005),
+        };
+
+def count_commands (state_directory):
+
+    # the log starts empty for every concurrency level
+    commands = {};
+    command_log = os.path.join(state_directory, 'commands.log');
+    if os.path.exists(command_log):
+        with open(command_log) as log:
+            for line in log:
+                kind = line.split()[-1];
+                commands[kind] = commands.get(kind, 0) + 1;
+        os.remove(command_log);
+    return commands;
+
+def stop_remote_sessions (state_directory):
+
+    # remote commands of killed ssh processes and Slurm jobs keep running like on a real cluster
+    sessions = os.path.join(state_directory, 'sessions');
+    if not os.path.exists(sessions):
+        return;
+    with open(sessions) as session_file:
+        session_ids = set(int(pid) for pid in session_file.read().split());
+    # e.g. timeout moves its command into another process group of the same session
+    for pid in [int(pid) for pid in os.listdir('/proc') if pid.isdigit()] if os.path.isdir('/proc') else []:
+        try:
+            if os.getsid(pid) in session_ids:
+                os.kill(pid, signal.SIGKILL);
+        except (ProcessLookupError, PermissionError):
+            pass;
+    for pid in session_ids:
+        try:
+            os.killpg(pid, signal.SIGKILL);
+        except (ProcessLookupError, PermissionError):
+            pass;
+
+def reset_shared_state ():
+
+    # every concurrency level starts cold: no master connection, status cache, pool or other per process registry
+    # (their asyncio locks and tasks also belong to the event loop of the previous level)
+    from slurm_jupyter_kernel.ssh_connection import SSHConnection, LoginNodeGroup;
+    from slurm_jupyter_kernel.job_status import SlurmJobStatusService;
+    from slurm_jupyter_kernel.job_files import JobFileWatcher;
+    from slurm_jupyter_kernel.job_array import JobArray;
+    from slurm_jupyter_kernel.warm_pool import WarmKernelPool;
+    from slurm_jupyter_kernel.shared_allocation import SharedAllocation;
+    from slurm_jupyter_kernel.rightsizing import JobHistory;
+    from slurm_jupyter_kernel.start_prediction import StartPredictionCache;
+    from slurm_jupyter_kernel.telemetry import JobTelemetry;
+    from slurm_jupyter_kernel.workdir_sync import WorkdirSync;
+    SSHConnection._connections.clear();
+    LoginNodeGroup._groups.clear();
+    SlurmJobStatusService._services.clear();
+    JobFileWatcher._watchers.clear();
+    JobArray._arrays.clear();
+    WarmKernelPool._pools.clear();
+    SharedAllocation._allocations.clear();
+    SharedAllocation._locks.clear();
+    JobHistory._histories.clear();
+    StartPredictionCache._caches.clear();
+    JobTelemetry._services.clear();
+    WorkdirSync._syncs.clear();
+
+async def run_kernel (index, args, provisioner_config, result):
+
+    from jupyter_client.manager import AsyncKernelManager;
+    from jupyter_client.kernelspec import KernelSpec;
+    from slurm_jupyter_kernel.provisioner import RemoteSlurmProvisioner;
+
+    kernel_spec = KernelSpec(argv=[sys.executable, os.path.join(fake_cluster, 'fake_kernel.py'), '{connection_file}'], display_name='benchmark', language='python', env={}, metadata={});
+    kernel_manager = AsyncKernelManager();
+    kernel_manager._kernel_spec = kernel_spec;
+    provisioner = RemoteSlurmProvisioner(kernel_id=f'benchmark-{index}', kernel_spec=kernel_spec, parent=kernel_manager, **provisioner_config);
+
+    start = monotonic();
+    try:
+        kwargs = await provisioner.pre_launch();
+        await provisioner.launch_kernel(kwargs.pop('cmd'), **kwargs);
+        result['submit'].append(monotonic() - start);
+
+        # the kernel restarter of jupyter_client polls on a fixed interval
+        while not provisioner.active_port_forwarding:
+            if monotonic() - start > args.launch_timeout:
+                raise TimeoutError(f'kernel {index} not ready after {args.launch_timeout}s');
+            if not await provisioner.poll() is None:
+                raise RuntimeError(f'kernel {index} died during the launch');
+            await asyncio.sleep(args.poll_interval);
+        result['launch'].append(monotonic() - start);
+
+        lifetime = monotonic();
+        while monotonic() - lifetime < args.kernel_lifetime:
+            await provisioner.poll();
+            await asyncio.sleep(args.poll_interval);
+    except Exception as e:
+        result['errors'].append(f'{type(e).__name__}: {e}');
+    finally:
+        shutdown = monotonic();
+        await provisioner.kill();
+        await provisioner.cleanup(restart=False);
+        result['shutdown'].append(monotonic() - shutdown);
+
+async def run_level (kernels, args, provisioner_config):
+
+    reset_shared_state();
+    result = {'submit': [], 'launch': [], 'shutdown': [], 'errors': []};
+    monitor = LoopMonitor();
+    monitor.start();
+    start = monotonic();
+    await asyncio.gather(*[run_kernel(index, args, provisioner_config, result) for index in range(kernels)]);
+    wall_time = monotonic() - start;
+    loop = monitor.stop();
+
+    # cancelled watchers still reap their ssh processes
+    pending = [task for task in asyncio.all_tasks() if not task is asyncio.current_task()];
+    if pending:
+        await asyncio.wait(pending, timeout=5);
+
+    commands = count_commands(args.state_directory);
+
+    return {
+        'kernels': kernels,
+        'errors': len(result['errors']),
+        'error_samples': result['errors'][:3],
+        'wall_time': wall_time,
+        'launch_p50': percentile(sorted(result['launch']), 50),
+        'launch_p90': percentile(sorted(result['launch']), 90),
+        'launch_max': max(result['launch'], default=None),
+        'submit_p50': percentile(sorted(result['submit']), 50),
+        'shutdown_p50': percentile(sorted(result['shutdown']), 50),
+        'loop_max_lag': loop['max_lag'],
+        'loop_p99_lag': loop['p99_lag'],
+        'loop_blocked_time': loop['blocked_time'],
+        'commands_per_kernel': sum(commands.values()) / kernels,
+        'commands': commands,
+    };
+
+async def run_levels (levels, args, provisioner_config, results):
+
+    for kernels in levels:
+        print(f'Running {kernels} concurrent kernels...', flush=True);
+        results.append(await run_level(kernels, args, provisioner_config));
+    # release finished subprocess transports while the loop is still running
+    gc.collect();
+    await asyncio.sleep(0.1);
+
+def parse_config (items):
+
+    # --config warm_pool_size=2 --config ready_signal=false --config 'sbatch_shapes=[{"partition": "short"}]'
+    config = {};
+    for item in items or []:
+        key, _, value = item.partition('=');
+        if value[:1] in ['[', '{']:
+            value = json.loads(value);
+        elif value.lower() in ['true', 'false']:
+            value = value.lower() == 'true';
+        else:
+            try:
+                value = float(value) if '.' in value else int(value);
+            except ValueError:
+                pass;
+        config[key] = value;
+    return config;
+
+def print_results (results):
+
+    def seconds (value):
+        return f'{value:8.2f}s' if value is not None else '       -';
+
+    print(f'{"kernels":>7} {"errors":>6} {"launch p50":>11} {"launch p90":>11} {"launch max":>11} {"loop max lag":>13} {"blocked":>9} {"cmds/kernel":>12}');
+    for level in results:
+        print(f'{level["kernels"]:>7} {level["errors"]:>6}    {seconds(level["launch_p50"])}    {seconds(level["launch_p90"])}    {seconds(level["launch_max"])}      {seconds(level["loop_max_lag"])}  {seconds(level["loop_blocked_time"])} {level["commands_per_kernel"]:>12.1f}');
+    for level in results:
+        print(f'\n{level["kernels"]} kernels, remote commands: ' + ', '.join(f'{kind}={count}' for kind, count in sorted(level['commands'].items())));
+        for error in level['error_samples']:
+            print(f'  error: {error}');
+
+def main ():
+
+    parser = argparse.ArgumentParser(description='Benchmark the Slurm kernel provisioner without a cluster');
+    parser.add_argument('--kernels', default='1,10,50,100,200', help='Comma separated numbers of concurrent kernels (default: 1,10,50,100,200)');
+    parser.add_argument('--ssh-latency', type=float, default=0.02, help='Seconds per SSH command over the master connection');
+    parser.add_argument('--connect-latency', type=float, default=0.2, help='Seconds to open a new SSH connection');
+    parser.add_argument('--squeue-latency', type=float, default=0.05, help='Seconds per squeue call');
+    parser.add_argument('--queue-delay', type=float, default=1.0, help='Seconds a Slurm job is pending');
+    parser.add_argument('--queue-jitter', type=float, default=0.0, help='Random extra seconds a Slurm job is pending');
+    parser.add_argument('--partition-delay', default='', help='Seconds a Slurm job is pending per partition, e.g. short=0.5,long=10 (use with --config sbatch_shapes=...)');
+    parser.add_argument('--host-latency', default='', help='Seconds per SSH command per login node, e.g. login1=0.5,login2=0.02 (use with --config loginnode=login1,login2)');
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of a failing SSH command (exit code 255)');
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='Seconds between polls of each kernel');
+    parser.add_argument('--kernel-lifetime', type=float, default=2.0, help='Seconds each kernel keeps running after its launch');
+    parser.add_argument('--launch-timeout', type=float, default=120.0, help='Seconds until a launch counts as failed');
+    parser.add_argument('--config', action='append', help='Provisioner option, e.g. --config warm_pool_size=2 (repeatable)');
+    parser.add_argument('--json', help='Write the results to this file');
+    parser.add_argument('--keep', action='store_true', help='Keep the benchmark directory (job outputs, timings)');
+    args = parser.parse_args();
+
+    args.state_directory = tempfile.mkdtemp(prefix='sjk-benchmark-');
+    os.makedirs(os.path.join(args.state_directory, 'home'));
+
+    # everything stays inside the benchmark directory: master sockets, connection files, timings
+    os.environ['PATH'] = fake_cluster + os.pathsep + os.environ.get('PATH', '');
+    os.environ['SJK_BENCH_DIR'] = args.state_directory;
+    os.environ['SJK_BENCH_SSH_LATENCY'] = str(args.ssh_latency);
+    os.environ['SJK_BENCH_CONNECT_LATENCY'] = str(args.connect_latency);
+    os.environ['SJK_BENCH_SQUEUE_LATENCY'] = str(args.squeue_latency);
+    os.environ['SJK_BENCH_QUEUE_DELAY'] = str(args.queue_delay);
+    os.environ['SJK_BENCH_QUEUE_JITTER'] = str(args.queue_jitter);
+    os.environ['SJK_BENCH_FAILURE_RATE'] = str(args.failure_rate);
+    os.environ['SJK_BENCH_HOST_LATENCY'] = args.host_latency;
+    os.environ['SJK_BENCH_PARTITION_DELAY'] = args.partition_delay;
+    os.environ['TMPDIR'] = args.state_directory;
+    os.environ['JUPYTER_RUNTIME_DIR'] = os.path.join(args.state_directory, 'runtime');
+    os.environ.setdefault('SSH_AUTH_SOCK', os.path.join(args.state_directory, 'agent'));
+    tempfile.tempdir = None;
+
+    provisioner_config = {'loginnode': 'benchmark-login', 'username': 'benchmark', 'proxyjump': '', 'sbatch_flags': {'partition': 'benchmark', 'time': '00:10:00'},
+                          'timing_file': os.path.join(args.state_directory, 'timings.jsonl')};
+    provisioner_config.update(parse_config(args.config));
+
+    # a terminated benchmark (e.g. CI timeout) still cleans up its processes
+    signal.signal(signal.SIGTERM, signal.default_int_handler);
+
+    results = [];
+    try:
+        asyncio.run(run_levels([int(level) for level in args.kernels.split(',')], args, provisioner_config, results));
+    except KeyboardInterrupt:
+        print('Benchmark interrupted');
+    finally:
+        print('');
+        print_results(results);
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump({'parameters': {key: value for key, value in vars(args).items() if not key in ['json']}, 'results': results}, json_file, indent=2);
+        stop_remote_sessions(args.state_directory);
+        if args.keep:
+            print(f'\nBenchmark directory: {args.state_directory}');
+        else:
+            shutil.rmtree(args.state_directory, ignore_errors=True);
+
+if __name__ == '__main__':
+    main();
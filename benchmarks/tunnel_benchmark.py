@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and latency of ZMQ messages through the kernel SSH tunnel, per transport profile
+"""
+
+import os;
+import sys;
+import json;
+import shutil;
+import socket;
+import asyncio;
+import getpass;
+import argparse;
+import tempfile;
+import subprocess;
+from time import monotonic;
+
+import zmq;
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__));
+fake_cluster = os.path.join(benchmark_directory, 'fake_cluster');
+sys.path.insert(0, os.path.dirname(benchmark_directory));
+
+from slurm_jupyter_kernel.timing import percentile;
+from slurm_jupyter_kernel.ssh_connection import SSHConnection;
+from slurm_jupyter_kernel.tunnel import SSHTunnel, SplitTunnel, transport_profile, transport_profiles;
+
+def free_ports (count):
+
+    sockets = [socket.socket() for _ in range(count)];
+    for free_socket in sockets:
+        free_socket.bind(('127.0.0.1', 0));
+    ports = [free_socket.getsockname()[1] for free_socket in sockets];
+    for free_socket in sockets:
+        free_socket.close();
+    return ports;
+
+def parse_size (size):
+
+    # 1k, 64k, 1m
+    units = {'k': 1024, 'm': 1024 * 1024};
+    if size[-1].lower() in units:
+        return int(float(size[:-1]) * units[size[-1].lower()]);
+    return int(size);
+
+class BenchmarkClient:
+
+    def __init__ (self, shell_port, iopub_port, timeout=30.0):
+
+        self.timeout = timeout;
+        self.context = zmq.Context();
+        self.shell = self.context.socket(zmq.DEALER);
+        self.shell.setsockopt(zmq.LINGER, 0);
+        self.shell.connect(f'tcp://127.0.0.1:{shell_port}');
+        self.iopub = self.context.socket(zmq.SUB);
+        self.iopub.setsockopt(zmq.LINGER, 0);
+        self.iopub.setsockopt(zmq.RCVHWM, 0);
+        self.iopub.setsockopt(zmq.SUBSCRIBE, b'');
+        self.iopub.connect(f'tcp://127.0.0.1:{iopub_port}');
+
+    def request (self, text):
+
+        self.shell.send_multipart([text.encode()]);
+        if not self.shell.poll(self.timeout * 1000):
+            raise TimeoutError(f'No reply to "{text}" within {self.timeout}s');
+        return self.shell.recv_multipart()[-1];
+
+    def subscribe (self):
+
+        # a subscription needs a moment to reach the kernel - output published before is lost
+        deadline = monotonic() + self.timeout;
+        while monotonic() < deadline:
+            self.request('hello');
+            if self.iopub.poll(200):
+                while self.iopub.poll(100):
+                    self.iopub.recv_multipart();
+                return;
+        raise TimeoutError(f'iopub subscription not established within {self.timeout}s');
+
+    def latency (self, count):
+
+        latencies = [];
+        for _ in range(count):
+            start = monotonic();
+            self.request('ping');
+            latencies.append(monotonic() - start);
+        return latencies;
+
+    def flood (self, count, size, payload):
+
+        # iopub output of <count> * <size> bytes, shell round trips keep going meanwhile
+        poller = zmq.Poller();
+        poller.register(self.shell, zmq.POLLIN);
+        poller.register(self.iopub, zmq.POLLIN);
+
+        start = monotonic();
+        self.request(f'flood {count} {size} {payload}');
+        received = 0;
+        latencies = [];
+        self.shell.send_multipart([b'ping']);
+        ping_sent = monotonic();
+        done = False;
+        while not done:
+            events = dict(poller.poll(self.timeout * 1000));
+            if not events:
+                raise TimeoutError(f'iopub output stalled after {received} bytes');
+            if self.iopub in events:
+                topic, data = self.iopub.recv_multipart();
+                if topic == b'done':
+                    done = True;
+                else:
+                    received += len(data);
+            if self.shell in events:
+                self.shell.recv_multipart();
+                latencies.append(monotonic() - ping_sent);
+                self.shell.send_multipart([b'ping']);
+                ping_sent = monotonic();
+        duration = monotonic() - start;
+
+        # the last ping is still on its way
+        if self.shell.poll(self.timeout * 1000):
+            self.shell.recv_multipart();
+        return duration, received, latencies;
+
+    def close (self):
+
+        self.context.destroy(linger=0);
+
+def measure (ports, args):
+
+    client = BenchmarkClient(ports[0], ports[1], timeout=args.timeout);
+    try:
+        client.subscribe();
+        idle = sorted(client.latency(args.pings));
+        results = [];
+        for size in args.sizes.split(','):
+            size_bytes = parse_size(size);
+            count = max(1, parse_size(args.volume) // size_bytes);
+            duration, received, loaded = client.flood(count, size_bytes, args.payload);
+            loaded = sorted(loaded);
+            results.append({
+                'size': size,
+                'messages': count,
+                'bytes': received,
+                'duration': duration,
+                'throughput': received / duration / 1024 / 1024,
+                'idle_p50': percentile(idle, 50),
+                'idle_p95': percentile(idle, 95),
+                'loaded_p50': percentile(loaded, 50),
+                'loaded_p95': percentile(loaded, 95),
+                'loaded_pings': len(loaded),
+            });
+        return results;
+    finally:
+        client.close();
+
+async def start_kernel (args, connection, ports):
+
+    script = os.path.join(fake_cluster, 'zmq_kernel.py');
+    if args.remote_kernel:
+        # the stand-in runs on the compute node (needs python3 with pyzmq there)
+        command = ['ssh', '-T', '-o', 'StrictHostKeyChecking=no', '-o', f'ProxyCommand={connection.proxy_command()}', args.exec_node, 'python3', '-', str(ports[0]), str(ports[1])];
+        with open(script, 'rb') as script_file:
+            stdin = script_file.read();
+    else:
+        command = [sys.executable, script, str(ports[0]), str(ports[1])];
+        stdin = None;
+
+    process = await asyncio.create_subprocess_exec(*command, stdin=subprocess.PIPE if stdin else subprocess.DEVNULL, stdout=subprocess.PIPE);
+    if stdin:
+        process.stdin.write(stdin);
+        process.stdin.close();
+    ready = await asyncio.wait_for(process.stdout.readline(), timeout=args.timeout);
+    if not ready.strip() == b'ready':
+        raise RuntimeError('The stand-in kernel did not start');
+    return process;
+
+async def run_profiles (args, results):
+
+    connection = SSHConnection.get(args.loginnode, args.user, args.proxyjump);
+    await connection.ensure();
+    kernel_ports = free_ports(2);
+    kernel = await start_kernel(args, connection, kernel_ports);
+    loop = asyncio.get_running_loop();
+    try:
+        for profile_name in args.profiles.split(','):
+            if profile_name == 'direct':
+                if args.remote_kernel:
+                    continue;
+                # baseline without any tunnel
+                print(f'Measuring without a tunnel...', flush=True);
+                measurements = await loop.run_in_executor(None, measure, kernel_ports, args);
+                results.append({'profile': profile_name, 'setup_time': 0.0, 'results': measurements});
+                continue;
+
+            profile = transport_profile(profile_name);
+            local_ports = free_ports(2);
+            if profile['split_channels']:
+                tunnel = SplitTunnel(connection, args.exec_node, local_ports, [local_ports[1]], timeout=args.timeout, profile=profile, remote_ports=kernel_ports);
+            else:
+                tunnel = SSHTunnel(connection, args.exec_node, local_ports, timeout=args.timeout, profile=profile, remote_ports=kernel_ports);
+            print(f'Measuring transport profile {profile_name}...', flush=True);
+            await tunnel.start();
+            try:
+                measurements = await loop.run_in_executor(None, measure, local_ports, args);
+            finally:
+                await tunnel.stop();
+            results.append({'profile': profile_name, 'setup_time': tunnel.setup_time, 'results': measurements});
+    finally:
+        if kernel.returncode is None:
+            kernel.kill();
+        await kernel.wait();
+        await connection.close();
+
+def print_results (results):
+
+    def milliseconds (value):
+        return f'{value * 1000:8.2f}ms' if value is not None else '         -';
+
+    print(f'{"profile":<12} {"size":>6} {"messages":>8} {"MB/s":>9} {"ping p50":>10} {"ping p95":>10} {"loaded p50":>11} {"loaded p95":>11}');
+    for profile in results:
+        for result in profile['results']:
+            print(f'{profile["profile"]:<12} {result["size"]:>6} {result["messages"]:>8} {result["throughput"]:>9.1f} {milliseconds(result["idle_p50"])} {milliseconds(result["idle_p95"])}  {milliseconds(result["loaded_p50"])}  {milliseconds(result["loaded_p95"])}');
+
+def main ():
+
+    parser = argparse.ArgumentParser(description='Benchmark the kernel SSH tunnel per transport profile');
+    parser.add_argument('--loginnode', default='localhost', help='Loginnode to jump through (default: localhost)');
+    parser.add_argument('--user', default=getpass.getuser(), help='Username on the loginnode');
+    parser.add_argument('--proxyjump', default='', help='Proxy jump in front of the loginnode (SSH -J)');
+    parser.add_argument('--exec-node', help='Node the tunnel ends on (default: the loginnode); the stand-in kernel runs there with --remote-kernel, else locally');
+    parser.add_argument('--remote-kernel', action='store_true', help='Start the stand-in kernel on the exec node (needs python3 with pyzmq there)');
+    parser.add_argument('--profiles', default='direct,' + ','.join(transport_profiles.keys()), help='Comma separated transport profiles; "direct" measures without a tunnel');
+    parser.add_argument('--sizes', default='1k,64k,1m', help='Comma separated iopub message sizes (default: 1k,64k,1m)');
+    parser.add_argument('--volume', default='32m', help='Bytes of iopub output per message size (default: 32m)');
+    parser.add_argument('--payload', choices=['text', 'random'], default='text', help='Compressible text (tables, JSON) or random bytes (images)');
+    parser.add_argument('--pings', type=int, default=200, help='Shell round trips for the idle latency');
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds until a tunnel or message counts as failed');
+    parser.add_argument('--fake', action='store_true', help='Use the ssh stand-in of fake_cluster (relays ports locally, no encryption) to check the benchmark itself');
+    parser.add_argument('--json', help='Write the results to this file');
+    args = parser.parse_args();
+    args.exec_node = args.exec_node or args.loginnode;
+
+    state_directory = None;
+    if args.fake:
+        state_directory = tempfile.mkdtemp(prefix='sjk-tunnel-benchmark-');
+        os.makedirs(os.path.join(state_directory, 'home'));
+        os.environ['PATH'] = fake_cluster + os.pathsep + os.environ.get('PATH', '');
+        os.environ['SJK_BENCH_DIR'] = state_directory;
+        os.environ['TMPDIR'] = state_directory;
+        tempfile.tempdir = None;
+
+    results = [];
+    try:
+        asyncio.run(run_profiles(args, results));
+    except KeyboardInterrupt:
+        print('Benchmark interrupted');
+    finally:
+        print('');
+        print_results(results);
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump({'parameters': {key: value for key, value in vars(args).items() if not key in ['json']}, 'results': results}, json_file, indent=2);
+        if state_directory:
+            shutil.rmtree(state_directory, ignore_errors=True);
+
+if __name__ == '__main__':
+    main();
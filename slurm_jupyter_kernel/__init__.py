@@ -1 +1,6 @@
 __version__ = '1.9';
+
+def _jupyter_server_extension_points ():
+
+    # optional: jupyter server extension enable slurm_jupyter_kernel (needs jupyter_server)
+    return [{'module': 'slurm_jupyter_kernel.server_extension'}];
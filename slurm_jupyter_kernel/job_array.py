@@ -0,0 +1,161 @@
+import re;
+import threading;
+from subprocess import TimeoutExpired;
+from slurm_jupyter_kernel.job_status import SlurmStatusUnavailable;
+
+class JobArrayError (Exception):
+    pass;
+
+class JobArray:
+
+    # job arrays of one kernelspec (loginnode, sbatch flags, kernel command, environment) inside this process
+    _arrays = {};
+    _arrays_lock = threading.Lock();
+
+    # a workshop, not a whole partition
+    max_size = 1000;
+    # candidates tried by one claim command
+    claim_batch = 16;
+
+    def __init__ (self, key, connection, status_service, batch_job, job_directory, timeout=10.0, log=None):
+
+        self.key = key;
+        self.connection = connection;
+        self.status_service = status_service;
+        self.batch_job = batch_job;
+        self.job_directory = job_directory;
+        self.timeout = timeout;
+        self.log = log;
+
+        # array job ids, oldest first, and task ids (<array id>_<index>) known to be taken
+        self.array_ids = [];
+        # arrays which left the queue - job_array of the kernelspec may still list them
+        self.ended = set();
+        self.claimed = set();
+        self.tasks = 0;
+
+        self.submitted = 0;
+        self.hits = 0;
+        self.misses = 0;
+
+    @classmethod
+    def get (cls, key, *args, **kwargs):
+
+        with cls._arrays_lock:
+            if not key in cls._arrays:
+                cls._arrays[key] = cls(key, *args, **kwargs);
+            job_array = cls._arrays[key];
+            job_array.log = kwargs.get('log', job_array.log);
+            return job_array;
+
+    def adopt (self, array_id):
+
+        # an array submitted elsewhere, e.g. with slurmkernel bulk
+        array_id = str(array_id).strip();
+        if array_id and not array_id in self.array_ids and not array_id in self.ended:
+            self.array_ids.append(array_id);
+            self.status_service.register(array_id);
+
+    async def submit (self, size):
+
+        if size < 1 or size > self.max_size:
+            raise JobArrayError(f'A job array has 1 to {self.max_size} tasks, not {size}');
+        sbatch_command = ['/bin/bash', '--login', '-c', f'"sbatch --parsable --array=0-{size - 1}"'];
+        await self.connection.ensure();
+        try:
+            returncode, sbatch_out, sbatch_err = await self.connection.run(sbatch_command, input=self.batch_job.encode(), timeout=self.timeout);
+        except TimeoutExpired:
+            raise JobArrayError('Timeout expired when submitting the job array');
+
+        array_id = re.search(r'(\d+)', sbatch_out.decode('utf-8'));
+        if not returncode == 0 or not array_id:
+            raise JobArrayError('Could not submit the job array: ' + sbatch_err.decode('utf-8').strip());
+        self.adopt(array_id.group(1));
+        self.submitted += size;
+        if self.log:
+            self.log.info(f'Submitted job array {array_id.group(1)} with {size} tasks');
+        return array_id.group(1);
+
+    async def _task_states (self):
+
+        # the tasks of all arrays are part of the batched squeue of the status service (one line per task)
+        states = {};
+        ended = [];
+        for array_id in list(self.array_ids):
+            try:
+                tasks = await self.status_service.get_array_states(array_id);
+            except SlurmStatusUnavailable:
+                continue;
+            if not tasks:
+                # every task ended, expired or was cancelled
+                self.array_ids.remove(array_id);
+                self.status_service.unregister(array_id);
+                self.ended.add(array_id);
+                ended.append(array_id);
+                continue;
+            states.update(tasks);
+        self.tasks = len(states);
+        if ended:
+            # expired tasks leave their claimed directories behind
+            remove_command = ['/bin/bash', '-c', '"rm -rf ' + ' '.join(f'{self.job_directory}/{array_id}_*' for array_id in ended) + '"'];
+            try:
+                await self.connection.run(remove_command, timeout=self.timeout);
+            except TimeoutExpired:
+                pass;
+        return states;
+
+    async def prune (self):
+
+        # array ids which still have tasks in the queue
+        await self._task_states();
+        return list(self.array_ids);
+
+    async def claim (self, connection_info):
+
+        # running tasks first, then by array and index - a pending task is started by Slurm in index order
+        states = await self._task_states();
+        candidates = [task_id for task_id in states.keys() if not task_id in self.claimed];
+        candidates.sort(key=lambda task_id: (0 if states[task_id][0] == 'RUNNING' else 1, [int(part) for part in task_id.split('_')]));
+
+        while candidates:
+            batch, candidates = candidates[:self.claim_batch], candidates[self.claim_batch:];
+            # mkdir is atomic: the first candidate nobody (other servers, the idle timeout of the task) took is ours
+            attempts = [];
+            for task_id in batch:
+                task_directory = f'{self.job_directory}/{task_id}';
+                attempts.append(f'{{ mkdir -p {task_directory} && mkdir {task_directory}/claimed 2> /dev/null && cat > {task_directory}/connection.json.tmp && mv {task_directory}/connection.json.tmp {task_directory}/connection.json && echo {task_id}; }}');
+            claim_command = ['/bin/bash', '-c', '"' + ' || '.join(attempts) + '"'];
+            try:
+                returncode, claim_out, _ = await self.connection.run(claim_command, input=connection_info.encode(), timeout=self.timeout);
+            except TimeoutExpired:
+                break;
+            claimed = claim_out.decode('utf-8').strip().splitlines();
+            task_id = claimed[-1] if returncode == 0 and claimed else None;
+            # every candidate before the claimed one is taken
+            for candidate in batch:
+                self.claimed.add(candidate);
+                if candidate == task_id:
+                    break;
+            if task_id in batch:
+                self.hits += 1;
+                return task_id;
+
+        self.misses += 1;
+        return None;
+
+    async def cancel (self):
+
+        if not self.array_ids:
+            return;
+        cancel_command = ['/bin/bash', '--login', '-c', f'"scancel {" ".join(self.array_ids)}"'];
+        try:
+            await self.connection.run(cancel_command, timeout=self.timeout);
+        except TimeoutExpired:
+            raise JobArrayError('Timeout expired when cancelling the job arrays');
+        for array_id in self.array_ids:
+            self.status_service.unregister(array_id);
+        self.array_ids = [];
+
+    def stats (self):
+
+        return {'arrays': list(self.array_ids), 'tasks': self.tasks, 'claimed': len(self.claimed), 'hits': self.hits, 'misses': self.misses, 'submitted': self.submitted};
@@ -0,0 +1,114 @@
+import asyncio;
+import threading;
+from time import monotonic;
+from subprocess import TimeoutExpired;
+
+class JobFileWatcher:
+
+    # one watcher per SSH connection (proxyjump, loginnode, username) inside this process - the files of all jobs
+    # (ready signal, exited marker) are checked with one short command, so no kernel keeps a session of the
+    # SSH master connection open while it waits (sshd allows MaxSessions, by default 10, per connection)
+    _watchers = {};
+    _watchers_lock = threading.Lock();
+
+    def __init__ (self, connection, timeout=10.0):
+
+        self.connection = connection;
+        self.timeout = timeout;
+        # every pending wait: path, directory which has to exist, check interval, last check, no check before (after a failure), future
+        self.waiters = [];
+        self._task = None;
+
+        self.checks = 0;
+        self.failures = 0;
+        self.last_latency = None;
+
+    @classmethod
+    def get (cls, connection, timeout=10.0):
+
+        with cls._watchers_lock:
+            if not connection.key in cls._watchers:
+                cls._watchers[connection.key] = cls(connection, timeout);
+            watcher = cls._watchers[connection.key];
+            watcher.timeout = timeout;
+            return watcher;
+
+    async def wait (self, path, interval=0.2, directory=None):
+
+        # key=value lines of the file once it exists, None if <directory> is gone first (the job ended)
+        # <interval> may be a function, asked again after every check
+        waiter = {'path': path, 'directory': directory, 'interval': interval, 'checked': None, 'retry': 0.0, 'future': asyncio.get_running_loop().create_future()};
+        self.waiters.append(waiter);
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._check_loop());
+        try:
+            return await waiter['future'];
+        finally:
+            self.waiters.remove(waiter);
+
+    async def _check_loop (self):
+
+        while self.waiters:
+            now = monotonic();
+            due = [waiter for waiter in self.waiters if self._due(waiter) <= now and not waiter['future'].done()];
+            for waiter in due:
+                waiter['checked'] = now;
+            if due:
+                try:
+                    await self._check(due);
+                except Exception:
+                    self.failures += 1;
+                    for waiter in due:
+                        waiter['retry'] = monotonic() + self.timeout;
+            next_check = min([self._due(waiter) for waiter in self.waiters] or [now]);
+            # a changing interval (e.g. the job started) is noticed within a second
+            await asyncio.sleep(min(max(next_check - monotonic(), 0.05), 1.0));
+
+    def _due (self, waiter):
+
+        if waiter['checked'] is None:
+            return waiter['retry'];
+        interval = waiter['interval'];
+        interval = interval() if callable(interval) else interval;
+        return max(waiter['checked'] + interval, waiter['retry']);
+
+    async def _check (self, waiters):
+
+        script = '';
+        for index, waiter in enumerate(waiters):
+            gone = f'elif [ ! -d {waiter["directory"]} ]; then echo {index}:gone; ' if waiter['directory'] else '';
+            script += f'if [ -f {waiter["path"]} ]; then sed "s/^/{index}:/" {waiter["path"]}; echo {index}:found; {gone}fi\n';
+
+        await self.connection.ensure();
+        start = monotonic();
+        try:
+            returncode, check_out, _ = await self.connection.run(['/bin/bash', '-s'], input=script.encode(), timeout=self.timeout);
+        except TimeoutExpired:
+            returncode, check_out = 255, b'';
+        if returncode == 255:
+            # ssh failed, polling keeps working meanwhile - try again later
+            raise TimeoutExpired('job file check', self.timeout);
+        self.checks += 1;
+        self.last_latency = monotonic() - start;
+
+        lines = {};
+        for line in check_out.decode('utf-8', 'replace').splitlines():
+            index, _, content = line.partition(':');
+            if index.isdigit() and int(index) < len(waiters):
+                lines.setdefault(int(index), []).append(content);
+        for index, content in lines.items():
+            future = waiters[index]['future'];
+            if future.done():
+                continue;
+            if content[-1] == 'found':
+                future.set_result(dict(line.split('=', 1) for line in content[:-1] if '=' in line));
+            elif content[-1] == 'gone':
+                future.set_result(None);
+            else:
+                continue;
+            # many jobs start at once: every woken kernel starts its tunnel before the next one is woken
+            await asyncio.sleep(0);
+
+    def stats (self):
+
+        return {'waiting': len(self.waiters), 'checks': self.checks, 'failures': self.failures, 'last_latency': self.last_latency};
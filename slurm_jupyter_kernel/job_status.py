@@ -0,0 +1,179 @@
+import asyncio;
+import threading;
+from time import monotonic;
+from datetime import datetime, timedelta;
+from subprocess import TimeoutExpired;
+
+class SlurmStatusUnavailable (Exception):
+    pass;
+
+class SlurmJobStatusService:
+
+    # one status service per SSH connection (proxyjump, loginnode, username) inside this process
+    _services = {};
+    _services_lock = threading.Lock();
+
+    # job id, state, batch host, (estimated) start time, pending reason - the reason may contain spaces
+    squeue_format = '%i %T %B %S %r';
+
+    def __init__ (self, connection, timeout=10.0):
+
+        self.connection = connection;
+        self.timeout = timeout;
+        self.job_ids = set();
+        # job id -> squeue fields of the last batched query
+        self.cache = {};
+        self.cache_time = None;
+        self.queried_jobs = set();
+        # (cluster time, monotonic time) of the last query - squeue prints times in the local time of the cluster
+        self.cluster_time = None;
+        self._refresh_task = None;
+        # optional LaunchTimer, set by the first provisioner with timing enabled
+        self.timer = None;
+
+        self.queries = 0;
+        self.served = 0;
+        self.last_latency = None;
+        self.total_latency = 0.0;
+        self.max_latency = 0.0;
+        self.last_staleness = None;
+        self.max_staleness = 0.0;
+
+    @classmethod
+    def get (cls, connection, timeout=10.0):
+
+        with cls._services_lock:
+            if not connection.key in cls._services:
+                cls._services[connection.key] = cls(connection, timeout);
+            return cls._services[connection.key];
+
+    def register (self, job_id):
+
+        job_id = str(job_id);
+        if not job_id in self.job_ids:
+            self.job_ids.add(job_id);
+            # a new job is not part of the cached result yet
+            self.cache_time = None;
+
+    def unregister (self, job_id):
+
+        self.job_ids.discard(str(job_id));
+        self.queried_jobs.discard(str(job_id));
+        self.cache.pop(str(job_id), None);
+
+    def cluster_now (self):
+
+        if self.cluster_time is None:
+            return None;
+        cluster_time, query_time = self.cluster_time;
+        return cluster_time + timedelta(seconds=monotonic() - query_time);
+
+    def age (self):
+
+        if self.cache_time is None:
+            return None;
+        return monotonic() - self.cache_time;
+
+    async def get_state (self, job_id, max_age=5.0):
+
+        # serve from the cache as long as it is fresh enough, otherwise run (or join) one batched query
+        job_id = str(job_id);
+        self.register(job_id);
+
+        age = self.age();
+        if age is None or age > max_age:
+            await self.refresh();
+            age = self.age() or 0.0;
+
+        # the last successful query did not include this job (e.g. the loginnode timed out) - an array task is part of its array
+        if not job_id in self.queried_jobs and not job_id.split('_')[0] in self.queried_jobs:
+            raise SlurmStatusUnavailable(f'No state available for Slurm job {job_id}');
+
+        self.served += 1;
+        self.last_staleness = age;
+        self.max_staleness = max(self.max_staleness, age);
+
+        # None: the job is not in the queue anymore
+        return self.cache.get(job_id, None);
+
+    async def get_array_states (self, array_id, max_age=5.0):
+
+        # task id (<array id>_<index>) -> squeue fields of every task of a job array still in the queue
+        array_id = str(array_id);
+        self.register(array_id);
+
+        age = self.age();
+        if age is None or age > max_age:
+            await self.refresh();
+        if not array_id in self.queried_jobs:
+            raise SlurmStatusUnavailable(f'No state available for job array {array_id}');
+
+        self.served += 1;
+        prefix = f'{array_id}_';
+        return {job_id: fields for job_id, fields in self.cache.items() if job_id.startswith(prefix)};
+
+    async def refresh (self):
+
+        # concurrent callers share the query which is already running
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._query());
+        await asyncio.shield(self._refresh_task);
+
+    async def _query (self):
+
+        if not self.job_ids:
+            return;
+
+        job_ids = set(self.job_ids);
+        job_list = ','.join(sorted(job_ids));
+        # -r: one line per array task instead of pending tasks folded into <array id>_[1-99]
+        check_command = ['/bin/bash', '--login', '-c', f'"echo now=$(date +%Y-%m-%dT%H:%M:%S); squeue -h -r -j {job_list} -o \'{self.squeue_format}\'"'];
+
+        start = monotonic();
+        await self.connection.ensure();
+        try:
+            returncode, squeue_output, squeue_err = await self.connection.run(check_command, timeout=self.timeout);
+        except TimeoutExpired:
+            # keep serving the old result, the next call will try again
+            return;
+        # squeue fails with "Invalid job id specified" if none of the jobs exists anymore - that is an answer;
+        # anything else (255 = ssh could not reach the loginnode, slurmctld unreachable) is not
+        if not returncode == 0 and not b'Invalid job id' in squeue_err:
+            return;
+        latency = monotonic() - start;
+
+        cache = {};
+        for line in squeue_output.decode('utf-8').strip().splitlines():
+            if line.startswith('now='):
+                try:
+                    self.cluster_time = (datetime.fromisoformat(line[4:].strip()), start + latency / 2);
+                except ValueError:
+                    pass;
+                continue;
+            fields = line.strip().split(' ', 4);
+            if len(fields) >= 2:
+                cache[fields[0]] = fields[1:];
+
+        self.cache = cache;
+        self.cache_time = monotonic();
+        self.queried_jobs = job_ids;
+        self.queries += 1;
+        self.last_latency = latency;
+        self.total_latency += latency;
+        self.max_latency = max(self.max_latency, latency);
+        if self.timer:
+            self.timer.record('ssh.squeue', latency, jobs=len(job_ids));
+
+    def stats (self):
+
+        return {
+            'jobs': len(self.job_ids),
+            'queries': self.queries,
+            'served': self.served,
+            'cache_age': self.age(),
+            'last_staleness': self.last_staleness,
+            'max_staleness': self.max_staleness,
+            'last_query_latency': self.last_latency,
+            'avg_query_latency': self.total_latency / self.queries if self.queries else None,
+            'max_query_latency': self.max_latency,
+        };
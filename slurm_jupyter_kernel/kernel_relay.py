@@ -0,0 +1,245 @@
+import json;
+import socket;
+import asyncio;
+import zmq;
+import zmq.asyncio;
+from time import monotonic;
+from jupyter_client.session import Session;
+
+# iopub messages which show that the kernel works for the user - status and comm traffic do not count
+output_messages = ['stream', 'display_data', 'update_display_data', 'execute_input', 'execute_result', 'error', 'clear_output'];
+
+def free_ports (count, ip='127.0.0.1'):
+
+    sockets = [socket.socket() for _ in range(count)];
+    for free_socket in sockets:
+        free_socket.bind((ip, 0));
+    ports = [free_socket.getsockname()[1] for free_socket in sockets];
+    for free_socket in sockets:
+        free_socket.close();
+    return ports;
+
+def parse_message (frames):
+
+    # [identities..., <IDS|MSG>, signature, header, parent header, metadata, content, buffers...]
+    try:
+        index = frames.index(b'<IDS|MSG>');
+        return json.loads(frames[index + 2]), frames[index + 5];
+    except (ValueError, IndexError):
+        return {}, None;
+
+class KernelRelay:
+
+    # Jupyter connects to the kernel ports on localhost, the relay passes every message on to the kernel behind the
+    # SSH tunnel (on other local ports) - it sees all activity and keeps the ports open while no Slurm job is running
+    channels = ['shell', 'control', 'stdin', 'hb', 'iopub'];
+    # messages held back while the kernel is not reachable
+    max_pending = 1000;
+    # time for the iopub subscription to reach a new kernel before its first request
+    subscribe_delay = 0.5;
+
+    def __init__ (self, connection_info, on_resume=None, log=None):
+
+        self.connection_info = connection_info;
+        self.on_resume = on_resume;
+        self.log = log;
+        # the SSH tunnel forwards these local ports to the kernel ports on the compute node
+        self.upstream_ports = dict(zip(self.channels, free_ports(len(self.channels))));
+
+        key = connection_info.get('key', b'');
+        self.key = key;
+        self.bound_ports = None;
+        self.session = Session(key=key.encode() if isinstance(key, str) else key, signature_scheme=connection_info.get('signature_scheme', 'hmac-sha256'), username='slurm_jupyter_kernel');
+        self.context = None;
+        self.sockets = {};
+        self.task = None;
+
+        # suspended: no Slurm job, upstream_ready: the kernel is reachable through the tunnel
+        self.suspended = False;
+        self.upstream_ready = False;
+        self.resume_requested = False;
+        self.resume_message = '';
+        self.pending = [];
+        self.flush_task = None;
+        self.execution_state = 'starting';
+        self.last_activity = monotonic();
+
+        self.messages = {channel: 0 for channel in self.channels};
+        self.dropped = 0;
+        self.suspends = 0;
+        self.resumes = 0;
+
+    def ports (self, connection_info=None):
+
+        connection_info = connection_info or self.connection_info;
+        return {channel: connection_info[f'{channel}_port'] for channel in self.channels};
+
+    def matches (self, connection_info):
+
+        return self.ports(connection_info) == self.bound_ports and connection_info.get('key') == self.key;
+
+    def start (self):
+
+        self.context = zmq.asyncio.Context();
+        ip = self.connection_info.get('ip', '127.0.0.1');
+        # shell and stdin share one routing id towards the kernel: input requests are routed by the identities of the execute request
+        routing_id = self.session.bsession;
+        self.bound_ports = self.ports();
+        for channel, port in self.bound_ports.items():
+            if channel == 'iopub':
+                frontend = self.context.socket(zmq.PUB);
+                backend = self.context.socket(zmq.SUB);
+                backend.setsockopt(zmq.SUBSCRIBE, b'');
+            else:
+                frontend = self.context.socket(zmq.ROUTER);
+                frontend.setsockopt(zmq.ROUTER_HANDOVER, 1);
+                backend = self.context.socket(zmq.DEALER);
+                backend.setsockopt(zmq.ROUTING_ID, routing_id + channel.encode() if channel in ['control', 'hb'] else routing_id);
+            for relay_socket in [frontend, backend]:
+                relay_socket.setsockopt(zmq.LINGER, 0);
+            frontend.bind(f'tcp://{ip}:{port}');
+            backend.connect(f'tcp://127.0.0.1:{self.upstream_ports[channel]}');
+            self.sockets[channel] = (frontend, backend);
+        self.task = asyncio.ensure_future(self._relay());
+
+    async def _relay (self):
+
+        poller = zmq.asyncio.Poller();
+        for channel, (frontend, backend) in self.sockets.items():
+            if not channel == 'iopub':
+                poller.register(frontend, zmq.POLLIN);
+            poller.register(backend, zmq.POLLIN);
+        while True:
+            events = dict(await poller.poll());
+            for channel, (frontend, backend) in self.sockets.items():
+                try:
+                    if frontend in events:
+                        await self._from_client(channel, frontend, backend, await frontend.recv_multipart());
+                    if backend in events:
+                        await self._from_kernel(channel, frontend, await backend.recv_multipart());
+                except zmq.ZMQError as e:
+                    if self.log:
+                        self.log.warning(f'Kernel relay ({channel}): {e}');
+
+    async def _from_client (self, channel, frontend, backend, frames):
+
+        if channel == 'hb':
+            # nothing to ask while there is no kernel - answer heartbeats on its behalf
+            if not self.upstream_ready:
+                await frontend.send_multipart(frames);
+                return;
+        else:
+            self.messages[channel] += 1;
+            self.last_activity = monotonic();
+            header, _ = parse_message(frames);
+            if self.suspended and channel == 'control':
+                # a shutdown or interrupt is meant for the released kernel, not for the next one
+                self.dropped += 1;
+                return;
+            if self.suspended and not self.resume_requested and header.get('msg_type') == 'execute_request':
+                self.resume_requested = True;
+                await self._announce_resume(header);
+                if self.on_resume:
+                    self.on_resume();
+            if not self.upstream_ready:
+                if len(self.pending) < self.max_pending:
+                    self.pending.append((backend, frames));
+                else:
+                    self.dropped += 1;
+                return;
+
+        await self._send(backend, frames);
+
+    async def _send (self, backend, frames):
+
+        try:
+            await backend.send_multipart(frames, flags=zmq.NOBLOCK);
+        except zmq.Again:
+            self.dropped += 1;
+
+    async def _flush (self):
+
+        await asyncio.sleep(self.subscribe_delay);
+        pending, self.pending = self.pending, [];
+        for backend, frames in pending:
+            await self._send(backend, frames);
+        self.upstream_ready = True;
+
+    async def _from_kernel (self, channel, frontend, frames):
+
+        if channel == 'iopub':
+            header, content = parse_message(frames);
+            if header.get('msg_type') == 'status':
+                try:
+                    self.execution_state = json.loads(content).get('execution_state', self.execution_state);
+                except (TypeError, ValueError):
+                    pass;
+            elif header.get('msg_type') in output_messages:
+                self.last_activity = monotonic();
+        elif not channel == 'hb':
+            self.last_activity = monotonic();
+        self.messages[channel] += 1;
+        await frontend.send_multipart(frames);
+
+    async def _publish (self, msg_type, content, parent=None):
+
+        message = self.session.msg(msg_type, content=content, parent=parent or {});
+        await self.sockets['iopub'][0].send_multipart(self.session.serialize(message, ident=f'kernel.relay.{msg_type}'.encode()));
+
+    async def _announce_resume (self, header):
+
+        # shown as output of the cell which triggered the resume
+        await self._publish('status', {'execution_state': 'busy'}, parent=header);
+        if self.resume_message:
+            await self._publish('stream', {'name': 'stderr', 'text': self.resume_message}, parent=header);
+
+    def idle_time (self):
+
+        return monotonic() - self.last_activity;
+
+    def connected (self):
+
+        # held back requests go out in order before any new one
+        if not self.flush_task or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self._flush());
+
+    def disconnected (self):
+
+        if self.flush_task and not self.flush_task.done():
+            self.flush_task.cancel();
+        self.upstream_ready = False;
+
+    async def suspend (self, resume_message=''):
+
+        self.suspended = True;
+        self.upstream_ready = False;
+        self.resume_requested = False;
+        self.resume_message = resume_message;
+        self.execution_state = 'suspended';
+        self.suspends += 1;
+        await self._publish('status', {'execution_state': 'suspended'});
+
+    def resumed (self):
+
+        self.suspended = False;
+        self.execution_state = 'starting';
+        self.last_activity = monotonic();
+        self.resumes += 1;
+
+    async def stop (self):
+
+        for task in [self.flush_task, self.task]:
+            if task and not task.done():
+                task.cancel();
+                try:
+                    await task;
+                except asyncio.CancelledError:
+                    pass;
+        if self.context:
+            self.context.destroy(linger=0);
+            self.context = None;
+
+    def stats (self):
+
+        return {'execution_state': self.execution_state, 'idle': round(self.idle_time(), 1), 'suspended': self.suspended, 'messages': dict(self.messages), 'pending': len(self.pending), 'dropped': self.dropped,
+                'suspends': self.suspends, 'resumes': self.resumes};
@@ -0,0 +1,142 @@
+import os;
+import json;
+from hashlib import sha256;
+from jupyter_core.paths import jupyter_data_dir;
+from jupyter_client.kernelspec import KernelSpecManager;
+
+def default_index_file ():
+
+    return os.path.join(jupyter_data_dir(), 'slurm_jupyter_kernel', 'kernelspec_index.json');
+
+class KernelspecIndex:
+
+    # bump to throw away indexes written by older versions
+    version = 1;
+
+    def __init__ (self, path=None, kernel_dirs=None):
+
+        self.path = path or default_index_file();
+        self.kernel_dirs = kernel_dirs or KernelSpecManager().kernel_dirs;
+        # kernels directory -> mtime and entries, kernelspec directory -> stat, hash and parsed kernel.json
+        self.directories = {};
+        self.kernelspecs = {};
+        self.changed = False;
+
+        self.parsed = 0;
+        self.reused = 0;
+
+    def load (self):
+
+        try:
+            with open(self.path, 'r') as index_file:
+                index = json.load(index_file);
+        except (OSError, ValueError):
+            return;
+        if index.get('version') == self.version:
+            self.directories = index.get('directories', {});
+            self.kernelspecs = index.get('kernelspecs', {});
+
+    def save (self):
+
+        if not self.changed:
+            return;
+        index = {'version': self.version, 'directories': self.directories, 'kernelspecs': self.kernelspecs};
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True);
+            temp_path = f'{self.path}.{os.getpid()}.tmp';
+            with open(temp_path, 'w') as index_file:
+                json.dump(index, index_file);
+            os.replace(temp_path, self.path);
+        except OSError:
+            # a read-only home only costs the cache
+            pass;
+        self.changed = False;
+
+    def _entries (self, kernel_dir):
+
+        # adding or removing a kernelspec changes the mtime of the kernels directory
+        try:
+            mtime = os.stat(kernel_dir).st_mtime_ns;
+        except OSError:
+            if kernel_dir in self.directories:
+                del self.directories[kernel_dir];
+                self.changed = True;
+            return [];
+
+        cached = self.directories.get(kernel_dir);
+        if cached and cached['mtime'] == mtime:
+            return cached['entries'];
+
+        entries = sorted(entry for entry in os.listdir(kernel_dir) if os.path.isdir(os.path.join(kernel_dir, entry)));
+        self.directories[kernel_dir] = {'mtime': mtime, 'entries': entries};
+        self.changed = True;
+        return entries;
+
+    def _kernelspec (self, resource_dir):
+
+        # only kernelspecs whose kernel.json changed are read again
+        kernel_file = os.path.join(resource_dir, 'kernel.json');
+        try:
+            stat = os.stat(kernel_file);
+        except OSError:
+            return None;
+
+        cached = self.kernelspecs.get(resource_dir);
+        if cached and cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            self.reused += 1;
+            return cached;
+
+        with open(kernel_file, 'rb') as kernel_json:
+            kernel_data = kernel_json.read();
+        file_hash = sha256(kernel_data).hexdigest();
+        if cached and cached['sha256'] == file_hash:
+            # touched but not modified
+            cached.update({'mtime': stat.st_mtime_ns, 'size': stat.st_size});
+            self.changed = True;
+            self.reused += 1;
+            return cached;
+
+        self.parsed += 1;
+        entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': file_hash, 'valid': True, 'slurm': False, 'spec': None};
+        try:
+            spec = json.loads(kernel_data);
+            entry['slurm'] = spec.get('metadata', {}).get('kernel_provisioner', {}).get('provisioner_name') == 'remote-slurm-provisioner';
+            if entry['slurm']:
+                entry['spec'] = {key: spec.get(key) for key in ['display_name', 'language', 'env', 'metadata']};
+        except (ValueError, AttributeError):
+            entry['valid'] = False;
+
+        self.kernelspecs[resource_dir] = entry;
+        self.changed = True;
+        return entry;
+
+    def scan (self, rescan=False):
+
+        if rescan:
+            self.directories = {};
+            self.kernelspecs = {};
+            self.changed = True;
+        else:
+            self.load();
+
+        # same precedence as find_kernel_specs: the first kernels directory providing a name wins
+        found = {};
+        for kernel_dir in self.kernel_dirs:
+            for entry in self._entries(kernel_dir):
+                name = entry.lower();
+                if name in found:
+                    continue;
+                resource_dir = os.path.join(kernel_dir, entry);
+                kernelspec = self._kernelspec(resource_dir);
+                if kernelspec:
+                    found[name] = (resource_dir, kernelspec);
+
+        # forget kernelspecs which were deleted
+        known = set(resource_dir for resource_dir, _ in found.values());
+        for resource_dir in list(self.kernelspecs.keys()):
+            if not resource_dir in known:
+                del self.kernelspecs[resource_dir];
+                self.changed = True;
+
+        self.save();
+        return found;
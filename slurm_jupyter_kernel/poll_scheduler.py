@@ -0,0 +1,64 @@
+from time import monotonic;
+from datetime import datetime;
+
+class PollScheduler:
+
+    base_interval = 3.0;
+    # poll fast this many seconds before the predicted start
+    near_start_window = 15.0;
+    # pending reasons which will not resolve within the next minutes
+    blocked_reasons = ('Dependency', 'JobHeld', 'BeginTime', 'QOSMax', 'QOSGrp', 'AssocGrp', 'AssocMax', 'ReqNodeNotAvail', 'PartitionDown', 'PartitionInactive', 'Reservation');
+
+    def __init__ (self, min_interval=0.5, max_interval=120.0):
+
+        self.min_interval = min_interval;
+        self.max_interval = max_interval;
+        self.pending_since = None;
+        self.interval = min_interval;
+        self.expected_wait = None;
+
+    @staticmethod
+    def parse_start_time (start_time):
+
+        # squeue %S: 2024-05-02T14:03:11, N/A or Unknown if the scheduler has no estimation yet
+        try:
+            return datetime.fromisoformat(start_time);
+        except (TypeError, ValueError):
+            return None;
+
+    def next_interval (self, state, start_time=None, reason=None, cluster_now=None):
+
+        now = monotonic();
+        if not state == 'PENDING':
+            self.pending_since = None;
+            self.expected_wait = None;
+            self.interval = self.min_interval;
+            return self.interval;
+
+        if self.pending_since is None:
+            self.pending_since = now;
+        pending = now - self.pending_since;
+
+        # back off exponentially the longer the job is pending: doubles every minute (capped, the float overflows after hours)
+        interval = self.base_interval * 2 ** min(pending / 60.0, 16);
+        if not reason or not any(reason.startswith(blocked) for blocked in self.blocked_reasons):
+            # Priority/Resources: the job may start any moment a backfill slot opens up
+            interval = min(interval, self.max_interval / 2);
+
+        self.expected_wait = None;
+        # %S is local time of the cluster - compare it with the cluster clock (cluster_now), not with the one of the Jupyter host
+        estimated_start = self.parse_start_time(start_time);
+        if estimated_start:
+            self.expected_wait = (estimated_start - (cluster_now or datetime.now())).total_seconds();
+        if self.expected_wait is not None and self.expected_wait < 0:
+            # the estimate slipped into the past - it says nothing about the start anymore
+            self.expected_wait = None;
+        if self.expected_wait is not None:
+            if self.expected_wait <= self.near_start_window:
+                interval = self.min_interval;
+            else:
+                # wake up again shortly before the predicted start
+                interval = min(interval, max(self.expected_wait - self.near_start_window, self.min_interval));
+
+        self.interval = min(max(interval, self.min_interval), self.max_interval);
+        return self.interval;
@@ -6,13 +6,33 @@ from typing import Dict
 from typing import List
 from typing import Optional
 from traitlets import Unicode;
+from traitlets import Float;
+from traitlets import Integer;
+from traitlets import Bool;
 from traitlets import Dict as tDict;
-from time import sleep;
+from traitlets import List as tList;
 from os import environ;
+import os;
 import re;
 import json;
 import signal;
-from subprocess import check_output, Popen, PIPE, DEVNULL, STDOUT, TimeoutExpired;
+import asyncio;
+from hashlib import sha256;
+from subprocess import TimeoutExpired;
+from slurm_jupyter_kernel.ssh_connection import SSHConnection, LoginNodeGroup, SSHMasterError;
+from slurm_jupyter_kernel.job_status import SlurmJobStatusService, SlurmStatusUnavailable;
+from slurm_jupyter_kernel.job_files import JobFileWatcher;
+from slurm_jupyter_kernel.warm_pool import WarmKernelPool;
+from slurm_jupyter_kernel.job_array import JobArray, JobArrayError;
+from slurm_jupyter_kernel.shared_allocation import SharedAllocation, SharedAllocationError, split_sbatch_flags;
+from slurm_jupyter_kernel.poll_scheduler import PollScheduler;
+from slurm_jupyter_kernel.tunnel import SSHTunnel, SplitTunnel, SSHTunnelError, transport_profile;
+from slurm_jupyter_kernel.timing import LaunchTimer;
+from slurm_jupyter_kernel.kernel_relay import KernelRelay;
+from slurm_jupyter_kernel.rightsizing import JobHistory, JobHistoryUnavailable, suggest_sbatch_flags;
+from slurm_jupyter_kernel.start_prediction import StartPredictionCache, describe_shape;
+from slurm_jupyter_kernel.workdir_sync import WorkdirSync, WorkdirSyncError;
+from slurm_jupyter_kernel.telemetry import JobTelemetry;
 
 # custom exceptions
 class NoSlurmFlagsFound (Exception):
@@ -32,12 +52,78 @@ class SSHCommandError (Exception):
 class SSHTunnelCommandError (Exception):
     pass;
 
+class SlurmJobHandle:
+
+    # stands in for the local kernel process: the kernel itself runs inside the Slurm job
+    def __init__ (self, job_id):
+        self.job_id = job_id;
+        self.pid = None;
+        self.returncode = None;
+        self.stdin = self.stdout = self.stderr = None;
+
+    def poll (self):
+        return self.returncode;
+
+    def wait (self):
+        return self.returncode;
+
+    def send_signal (self, signum):
+        pass;
+
+    def kill (self):
+        pass;
+
+    def terminate (self):
+        pass;
+
 class RemoteSlurmProvisioner(LocalProvisioner):
 
     sbatch_flags: dict = tDict(config=True);
+    sbatch_shapes: list = tList(tDict(), config=True);
+    shape_prediction_ttl: float = Float(30.0, config=True);
     proxyjump: str = Unicode(config=True);
     loginnode: str = Unicode(config=True);
+    loginnodes: list = tList(Unicode(), config=True);
     username: str = Unicode(config=True);
+    ssh_timeout: float = Float(10.0, config=True);
+    transport_profile: str = Unicode('default', config=True);
+    transport_options: dict = tDict(config=True);
+    status_cache_ttl: float = Float(5.0, config=True);
+    warm_pool_size: int = Integer(0, config=True);
+    warm_pool_max_idle: int = Integer(1800, config=True);
+    poll_min_interval: float = Float(0.5, config=True);
+    poll_max_interval: float = Float(120.0, config=True);
+    ready_signal: bool = Bool(True, config=True);
+    restart_in_allocation: bool = Bool(True, config=True);
+    restart_wait: int = Integer(120, config=True);
+    shared_allocation: bool = Bool(False, config=True);
+    shared_allocation_size: int = Integer(4, config=True);
+    shared_allocation_max_idle: int = Integer(300, config=True);
+    launch_timing: bool = Bool(True, config=True);
+    timing_file: str = Unicode(config=True);
+    stage_paths: list = tList(Unicode(), config=True);
+    stage_directory: str = Unicode(config=True);
+    sync_paths: list = tList(Unicode(), config=True);
+    sync_directory: str = Unicode(config=True);
+    sync_timeout: float = Float(600.0, config=True);
+    job_array: str = Unicode(config=True);
+    job_array_max_idle: int = Integer(3600, config=True);
+    idle_release: int = Integer(0, config=True);
+    idle_release_prequeue: bool = Bool(False, config=True);
+    rightsize: str = Unicode('off', config=True);
+    rightsize_bounds: dict = tDict(config=True);
+    rightsize_days: int = Integer(30, config=True);
+    rightsize_margin: float = Float(1.2, config=True);
+    telemetry_interval: float = Float(15.0, config=True);
+    telemetry_history: int = Integer(240, config=True);
+    telemetry_lease: float = Float(60.0, config=True);
+
+    # shared filesystem directory on the cluster used to hand over connection files to running jobs
+    remote_job_directory = '$HOME/.slurm_jupyter_kernel/jobs';
+    # packed environments for node-local staging
+    remote_stage_directory = '$HOME/.slurm_jupyter_kernel/stage';
+    # synced working directories, if no sync_directory (e.g. a scratch filesystem) is configured
+    remote_sync_directory = '$HOME/.slurm_jupyter_kernel/sync';
 
     default_batch_job = """#!/bin/bash
 #SBATCH -J jupyter_slurm_kernel
@@ -49,53 +135,337 @@ cat << EOF > $tmpfile
 EOF
 connection_file=$tmpfile
 
+{STAGE}
+
 {EXTRA_ENVIRONMENT}
 
 {COMMAND}    
 """;
 
+    # warm pool job: waits for a kernel to claim it by writing the connection file
+    # (own job name: its elapsed time and memory include the idle wait and are left out of the right-sizing history)
+    warm_batch_job = """#!/bin/bash
+#SBATCH -J jupyter_slurm_kernel_warm
+{SBATCH_JOB_FLAGS}
+
+job_directory={JOB_DIRECTORY}/$SLURM_JOB_ID
+mkdir -p $job_directory
+connection_file=$job_directory/connection.json
+
+{STAGE}
+
+idle_deadline=$((SECONDS + {MAX_IDLE}))
+while [ ! -f $connection_file ]; do
+    # give the allocation back if nobody claimed it in time - the claimed directory stays, a late claim fails
+    if [ $SECONDS -ge $idle_deadline ] && mkdir $job_directory/claimed 2> /dev/null; then
+        exit 0
+    fi
+    sleep 1
+done
+
+{EXTRA_ENVIRONMENT}
+
+{COMMAND}
+rm -rf $job_directory
+""";
+
+    # job array task (bulk launch): like a warm pool job, every task waits for a kernel to claim it
+    array_batch_job = """#!/bin/bash
+#SBATCH -J jupyter_slurm_kernel_array
+{SBATCH_JOB_FLAGS}
+
+array_task=$SLURM_ARRAY_JOB_ID"_"$SLURM_ARRAY_TASK_ID
+job_directory={JOB_DIRECTORY}/$array_task
+mkdir -p $job_directory
+connection_file=$job_directory/connection.json
+
+{STAGE}
+
+idle_deadline=$((SECONDS + {MAX_IDLE}))
+while [ ! -f $connection_file ]; do
+    # give the allocation back if nobody claimed it in time - the claimed directory stays, a late claim fails
+    if [ $SECONDS -ge $idle_deadline ] && mkdir $job_directory/claimed 2> /dev/null; then
+        exit 0
+    fi
+    sleep 1
+done
+
+{EXTRA_ENVIRONMENT}
+
+{COMMAND}
+rm -rf $job_directory
+""";
+
+    # wraps the kernel command: announces when the kernel listens on all of its ports (ready signal)
+    # and keeps the allocation after the kernel exited to start the next kernel of a restart
+    kernel_supervisor_job = """job_directory={JOB_DIRECTORY}
+mkdir -p $job_directory
+ready_signal={READY_SIGNAL}
+restart_wait={RESTART_WAIT}
+generation=0
+
+while true; do
+    {COMMAND} &
+    kernel_pid=$!
+    trap 'kill $kernel_pid 2> /dev/null; touch $job_directory/stop' TERM INT
+
+    kernel_ports=$(grep -o '_port": *[0-9]*' $connection_file | grep -o '[0-9]*$')
+    signalled=0
+    while kill -0 $kernel_pid 2> /dev/null; do
+        if [ $ready_signal -eq 1 ] && [ $signalled -eq 0 ]; then
+            listening=1
+            for port in $kernel_ports; do
+                (echo > /dev/tcp/127.0.0.1/$port) 2> /dev/null || listening=0
+            done
+            if [ $listening -eq 1 ]; then
+                printf 'exec_node=%s\\nstatus=ready\\ngeneration=%s\\nstage_ms=%s\\nstage_status=%s\\n' "$SLURMD_NODENAME" $generation "$stage_ms" "$stage_status" > $job_directory/ready.tmp
+                mv $job_directory/ready.tmp $job_directory/ready.$generation
+                signalled=1
+            fi
+        fi
+        # the provisioner wants this kernel gone (restart or shutdown)
+        if [ -f $job_directory/terminate.$generation ] || [ -f $job_directory/stop ]; then
+            kill $kernel_pid 2> /dev/null
+        fi
+        sleep 0.2
+    done
+    wait $kernel_pid
+    printf 'exit_code=%s\\n' $? > $job_directory/exited.$generation
+
+    # a restart hands over the connection file of the next kernel
+    next_connection_file=$job_directory/connection.$((generation + 1)).json
+    restart_deadline=$((SECONDS + restart_wait))
+    while [ ! -f $next_connection_file ]; do
+        if [ -f $job_directory/stop ] || [ $SECONDS -ge $restart_deadline ]; then
+            rm -rf $job_directory
+            exit 0
+        fi
+        sleep 0.2
+    done
+    generation=$((generation + 1))
+    connection_file=$next_connection_file
+done""";
+
+    # shared allocation: starts a job step for every kernel handed over to the allocation
+    shared_batch_job = """#!/bin/bash
+#SBATCH -J jupyter_slurm_kernels
+{SBATCH_JOB_FLAGS}
+
+allocation_directory={JOB_DIRECTORY}/$SLURM_JOB_ID
+mkdir -p $allocation_directory/kernels
+
+idle_deadline=$((SECONDS + {MAX_IDLE}))
+while [ ! -f $allocation_directory/release ]; do
+    for kernel_directory in $allocation_directory/kernels/*; do
+        if [ -f $kernel_directory/kernel.sh ] && mkdir $kernel_directory/started 2> /dev/null; then
+            srun --exact --nodes=1 --ntasks=1 {STEP_FLAGS} -J jupyter_kernel /bin/bash $kernel_directory/kernel.sh $kernel_directory &
+        fi
+    done
+    # the provisioner releases the allocation with its last kernel, this is only the fallback
+    if [ -n "$(jobs -rp)" ]; then
+        idle_deadline=$((SECONDS + {MAX_IDLE}))
+    elif [ $SECONDS -ge $idle_deadline ]; then
+        break
+    fi
+    sleep 1
+done
+
+for kernel_directory in $allocation_directory/kernels/*; do
+    touch $kernel_directory/stop 2> /dev/null
+done
+wait
+rm -rf $allocation_directory
+""";
+
+    # one kernel (job step) of a shared allocation
+    shared_kernel_job = """#!/bin/bash
+kernel_directory=$1
+connection_file=$kernel_directory/connection.json
+cat << EOF > $connection_file
+{KERNEL_CONNECTION_INFO}
+EOF
+
+{STAGE}
+
+{EXTRA_ENVIRONMENT}
+
+{COMMAND}
+""";
+
+    # copies the environment of the kernel to node-local storage before it starts: every stage path is packed
+    # once into an archive on the shared filesystem (again if one of its directories changed) and extracted
+    # on the compute node; $stage_path_N points to the node-local copy or, if staging failed, to the original
+    stage_job = """{STAGE_DEFAULTS}
+stage_started=$(date +%s%N)
+stage_status=staged
+stage_root={STAGE_DIRECTORY}
+[ -n "$stage_root" ] || stage_root=/tmp
+stage_root=$stage_root/slurm_jupyter_kernel_stage
+mkdir -p {ARCHIVE_DIRECTORY} $stage_root
+stage_index=0
+for stage_source in {STAGE_SOURCES}; do
+    stage_archive={ARCHIVE_DIRECTORY}/{STAGE_KEY}.$stage_index.tar
+    if [ ! -f $stage_archive ] || [ -n "$(find $stage_source -type d -newer $stage_archive -print -quit 2> /dev/null)" ]; then
+        # one job packs the archive, concurrent jobs start from the shared filesystem meanwhile
+        if [ -d $stage_archive.lock ] && [ -n "$(find $stage_archive.lock -maxdepth 0 -mmin +30)" ]; then
+            rmdir $stage_archive.lock
+        fi
+        if mkdir $stage_archive.lock 2> /dev/null; then
+            stage_packed=$(date +%s.%N)
+            tar -cf $stage_archive.$$ -C $stage_source . && mv $stage_archive.$$ $stage_archive && touch -d @$stage_packed $stage_archive
+            rm -f $stage_archive.$$
+            rmdir $stage_archive.lock
+            stage_status=packed
+        else
+            stage_status=partial
+            stage_index=$((stage_index + 1))
+            continue
+        fi
+    fi
+
+    # kernels on the same node share the extracted copy of an archive
+    stage_destination=$stage_root/{STAGE_KEY}.$stage_index.$(stat -c %Y $stage_archive)
+    if [ ! -d $stage_destination ]; then
+        mkdir -p $stage_destination.$$
+        if tar -xf $stage_archive -C $stage_destination.$$; then
+            # scripts of the environment refer to its original location (shebangs, activate scripts, wrappers)
+            grep -rlIZF "$stage_source" $stage_destination.$$ | xargs -0 -r sed -i "s|$stage_source|$stage_destination|g"
+            mv -T $stage_destination.$$ $stage_destination 2> /dev/null
+        fi
+        rm -rf $stage_destination.$$
+    fi
+    if [ -d $stage_destination ]; then
+        eval "stage_path_$stage_index=$stage_destination"
+    else
+        stage_status=partial
+    fi
+    stage_index=$((stage_index + 1))
+done
+stage_ms=$((($(date +%s%N) - stage_started) / 1000000))
+echo "Staged kernel environment to $stage_root in $stage_ms ms ($stage_status)" >&2""";
+
+    # seconds between two checks for the ready signal of a running job
+    ready_check_interval = 0.2;
+    # seconds between two checks whether the kernel of a running job exited - one command for all kernels of a login node
+    exit_check_interval = 2.0;
+    # seconds a wait for a job file may take before it is renewed (after checking the job is still there)
+    ready_signal_wait = 300;
+
     def __init__(self, **kwargs):
 
         self.job_id = None;
         self.job_state = None;
+        self.state = None;
         self.exec_node = None;
         self.estimated_start_time = None;
+        self.pending_reason = None;
         self.active_port_forwarding = False;
+        self.status_service = None;
+        self.pending_watcher = None;
+        self.watchers = [];
+        self.tunnel = None;
+        self.port_forwarding_lock = asyncio.Lock();
+        # every kernel started inside the same allocation is a new generation
+        self.kernel_generation = 0;
+        self.kernel_exited = False;
+        self.restarting = False;
+        self.timer = None;
+        self.allocation = None;
+        self.rightsize_task = None;
+        self.job_array_pool = None;
+        self.sync_task = None;
+        self.sync_failed = False;
+        self.sync_error = None;
+        self.sync_environment = '';
+        # sbatch flags of the submitted job (selected shape, right-sized), kept for restarts inside its allocation
+        self.launched_sbatch_flags = None;
+        # idle release: the relay serves the kernel ports while no Slurm job runs
+        self.relay = None;
+        self.idle_watcher = None;
+        self.resume_task = None;
+        self.suspended = False;
+        self.held_job_id = None;
 
         super().__init__(**kwargs);
 
     async def pre_launch(self, **kwargs: Any) -> Dict[str, Any]:
 
+        # timing spans of all launch phases, tagged with cluster, partition and kernelspec
+        kernelspec_name = getattr(self.kernel_spec, 'name', None) or getattr(self.kernel_spec, 'display_name', None);
+        self.timer = LaunchTimer(self.timing_file or None, enabled=self.launch_timing, kernel_id=self.kernel_id, kernelspec=kernelspec_name, loginnode=self.loginnode, partition=self.sbatch_flags.get('partition'));
+        self.timer.mark('launch');
+        with self.timer.span('pre_launch'):
+            return await self._pre_launch(**kwargs);
+
+    async def _pre_launch(self, **kwargs: Any) -> Dict[str, Any]:
+
+        await self._prepare_batch_jobs(**kwargs);
+        return await super().pre_launch(**kwargs)
+
+    async def _prepare_batch_jobs (self, **kwargs: Any) -> None:
+
         # basic kernelspec checks
         if not self.sbatch_flags:
             raise NoSlurmFlagsFound('Please provide sbatch flags to start the Slurm job with!');
-        if not self.loginnode:
+        # loginnode may be a comma-separated list as well - all login nodes of a cluster can stand in for each other
+        loginnodes = list(dict.fromkeys(loginnode.strip() for loginnode in self.loginnode.split(',') + list(self.loginnodes) if loginnode.strip()));
+        if not loginnodes:
             raise UnknownLoginnode('Could not start Slurm job. Unknown loginnode!');
         if not self.username:
-            loginnode = self.loginnode;
+            loginnode = ', '.join(loginnodes);
             if self.proxyjump:
-                loginnode = self.loginnode + f' (via {self.proxyjump})';
+                loginnode = loginnode + f' (via {self.proxyjump})';
             raise UnknownUsername(f'Could not login to {loginnode}! Unknown username!');
 
+        # ssh settings of the tunnel - unknown profiles or options fail before a job is submitted
+        self.transport = transport_profile(self.transport_profile, self.transport_options);
+
         # check running SSH agent
         try:
             environ['SSH_AUTH_SOCK'];
         except KeyError:
             raise SSHAgentNotRunning('SSH Agent is not running. Start you agent using following cmd:\n$ eval $(ssh-agent)')
 
+        # build ssh command - all commands share one multiplexed master connection
+        # (with several login nodes: the one of the fastest healthy login node)
+        if len(loginnodes) > 1:
+            self.connection = LoginNodeGroup.get(loginnodes, self.username, self.proxyjump);
+        else:
+            self.connection = SSHConnection.get(loginnodes[0], self.username, self.proxyjump);
+        self.loginnode_failover = len(loginnodes) > 1;
+        # job states of all kernels behind this loginnode are fetched with one batched squeue
+        self.status_service = SlurmJobStatusService.get(self.connection, timeout=self.ssh_timeout);
+        if self.launch_timing and self.status_service.timer is None:
+            self.status_service.timer = LaunchTimer(self.timing_file or None, loginnode=self.connection.loginnode);
+
+        # a restart inside the running allocation needs no scheduler, sacct or rsync round trip: the resources and the
+        # synced working directory of the running job are kept (also for the fallback submission if the restart fails)
+        reuse_job = bool(self.restart_in_allocation and self.job_id and self.state == 'RUNNING' and self.launched_sbatch_flags is not None);
+        if reuse_job:
+            sbatch_flags = dict(self.launched_sbatch_flags);
+        else:
+            # alternative resource shapes: the one the scheduler expects to start first is submitted
+            sbatch_flags = dict(self.sbatch_flags);
+            if self.sbatch_shapes:
+                sbatch_flags = await self._select_sbatch_shape();
+
+            # tighter time and mem requests from the job history of this kernelspec
+            if self.rightsize in ['suggest', 'apply']:
+                sbatch_flags = await self._rightsize_sbatch_flags(sbatch_flags);
+            elif not self.rightsize == 'off':
+                self.log.warning(f'Unknown rightsize mode {self.rightsize} (off, suggest or apply) - right-sizing is off');
+            self.launched_sbatch_flags = dict(sbatch_flags);
+
         # Build sbatch job flags
         slurm_job_flags = '';
-        for parameter, value in self.sbatch_flags.items():
+        for parameter, value in sbatch_flags.items():
             slurm_job_flags += f'#SBATCH --{parameter}={value}\n';
 
-        # build ssh command
-        proxyjump = '';
-        if self.proxyjump:
-            proxyjump = f'-J {self.proxyjump}';
-        self.ssh_command = f'ssh -tA {proxyjump} {self.loginnode}';
-
         # build sbatch command
         self.sbatch_command = ['/bin/bash', '--login', '-c', '"sbatch --parsable"'];
+        if self.loginnode_failover:
+            # finds the job again if a login node hangs during the submission
+            self.sbatch_command = ['/bin/bash', '--login', '-c', f'"sbatch --parsable --comment={self.sbatch_comment()}"'];
 
         # add extra environment variables into sbatch job
         extra_environment = '';
@@ -108,12 +478,75 @@ connection_file=$tmpfile
 
         # finally build the Slurm sbatch job
         kernel_command = ' '.join(self.kernel_spec.argv);
-        self.batch_job = self.default_batch_job.format(SBATCH_JOB_FLAGS=slurm_job_flags,EXTRA_ENVIRONMENT=extra_environment,COMMAND=kernel_command,KERNEL_CONNECTION_INFO='{KERNEL_CONNECTION_INFO}');
+        stage_script = '';
+        if self.stage_paths:
+            stage_script, kernel_command, extra_environment = self._stage_environment(kernel_command, extra_environment);
+        if self.sync_paths:
+            # the kernel starts inside the synced copy of the local working directory
+            if not reuse_job:
+                self.sync_environment = await self._prepare_workdir_sync(kwargs.get('cwd'));
+            extra_environment = self.sync_environment + extra_environment;
+        # job array tasks wrap the plain kernel command themselves
+        array_kernel_command = kernel_command;
+        if self.shared_allocation:
+            # kernels of a shared allocation are only reachable through their ready signal (the node of the job step)
+            kernel_command = self.kernel_supervisor_job.format(COMMAND=kernel_command, JOB_DIRECTORY='$kernel_directory', READY_SIGNAL=1, RESTART_WAIT=self.restart_wait if self.restart_in_allocation else 0);
+            self.shared_kernel = self.shared_kernel_job.format(STAGE=stage_script, EXTRA_ENVIRONMENT=extra_environment, COMMAND=kernel_command, KERNEL_CONNECTION_INFO='{KERNEL_CONNECTION_INFO}');
 
-        return await super().pre_launch(**kwargs)
+            allocation_flags, step_flags = split_sbatch_flags(sbatch_flags, self.shared_allocation_size);
+            allocation_job_flags = ''.join(f'#SBATCH --{parameter}={value}\n' for parameter, value in allocation_flags.items());
+            step_job_flags = ' '.join(f'--{parameter}={value}' for parameter, value in step_flags.items());
+            self.shared_batch = self.shared_batch_job.format(SBATCH_JOB_FLAGS=allocation_job_flags, JOB_DIRECTORY=self.remote_job_directory, MAX_IDLE=self.shared_allocation_max_idle, STEP_FLAGS=step_job_flags);
+            # kernelspecs asking for the same resources share allocations, the kernel command may differ
+            self.shared_allocation_key = WarmKernelPool.kernelspec_key(self.connection.key, self.shared_batch);
+        elif self.ready_signal or self.restart_in_allocation:
+            restart_wait = self.restart_wait if self.restart_in_allocation else 0;
+            kernel_command = self.kernel_supervisor_job.format(COMMAND=kernel_command, JOB_DIRECTORY=f'{self.remote_job_directory}/$SLURM_JOB_ID', READY_SIGNAL=int(self.ready_signal), RESTART_WAIT=restart_wait);
+        self.batch_job = self.default_batch_job.format(SBATCH_JOB_FLAGS=slurm_job_flags,STAGE=stage_script,EXTRA_ENVIRONMENT=extra_environment,COMMAND=kernel_command,KERNEL_CONNECTION_INFO='{KERNEL_CONNECTION_INFO}');
+
+        # warm pool: allocations with the same kernelspec are interchangeable
+        self.warm_pool = None;
+        if self.warm_pool_size > 0 and not self.shared_allocation:
+            warm_batch_job = self.warm_batch_job.format(SBATCH_JOB_FLAGS=slurm_job_flags,STAGE=stage_script,EXTRA_ENVIRONMENT=extra_environment,COMMAND=kernel_command,JOB_DIRECTORY=self.remote_job_directory,MAX_IDLE=self.warm_pool_max_idle);
+            warm_batch_job = warm_batch_job.format(connection_file='$connection_file');
+            pool_key = WarmKernelPool.kernelspec_key(self.connection.key, warm_batch_job);
+            self.warm_pool = WarmKernelPool.get(pool_key, self.connection, self.status_service, warm_batch_job, self.remote_job_directory, size=self.warm_pool_size, timeout=self.ssh_timeout, log=self.log);
+
+        # bulk launch: tasks of a job array with this kernelspec are claimed like warm jobs
+        self.job_array_pool = None;
+        if not self.shared_allocation:
+            if self.ready_signal or self.restart_in_allocation:
+                restart_wait = self.restart_wait if self.restart_in_allocation else 0;
+                array_kernel_command = self.kernel_supervisor_job.format(COMMAND=array_kernel_command, JOB_DIRECTORY=f'{self.remote_job_directory}/$array_task', READY_SIGNAL=int(self.ready_signal), RESTART_WAIT=restart_wait);
+            array_batch_job = self.array_batch_job.format(SBATCH_JOB_FLAGS=slurm_job_flags,STAGE=stage_script,EXTRA_ENVIRONMENT=extra_environment,COMMAND=array_kernel_command,JOB_DIRECTORY=self.remote_job_directory,MAX_IDLE=self.job_array_max_idle);
+            array_batch_job = array_batch_job.format(connection_file='$connection_file');
+            array_key = WarmKernelPool.kernelspec_key(self.connection.key, array_batch_job);
+            self.job_array_pool = JobArray.get(array_key, self.connection, self.status_service, array_batch_job, self.remote_job_directory, timeout=self.ssh_timeout, log=self.log);
+            for array_id in self.job_array.split(','):
+                self.job_array_pool.adopt(array_id);
+
+    async def submit_job_array (self, size: int, **kwargs: Any) -> str:
+
+        # bulk launch for workshops: one sbatch for a job array of <size> tasks instead of one per kernel -
+        # kernels of this kernelspec (in this process, or elsewhere with job_array set) claim its tasks
+        self.timer = LaunchTimer(self.timing_file or None, enabled=False);
+        await self._prepare_batch_jobs(**kwargs);
+        if not self.job_array_pool:
+            raise JobArrayError('Job arrays are not available for kernels in a shared allocation');
+        await self._ensure_ssh_connection();
+        array_id = await self.job_array_pool.submit(size);
+        if self.sync_task:
+            # the tasks wait for the working directory sync
+            await self.sync_task;
+        return array_id;
 
     async def launch_kernel (self, cmd: List[str], **kwargs: Any) -> KernelConnectionInfo:
 
+        with self.timer.span('launch_kernel'):
+            return await self._launch_kernel(cmd, **kwargs);
+
+    async def _launch_kernel (self, cmd: List[str], **kwargs: Any) -> KernelConnectionInfo:
+
         # kernel connection info is now available - add it to the Slurm batch job
         kernel_connection_info = {};
         # the kernel connection info contains byte-strings which are not JSON valid
@@ -126,23 +559,105 @@ connection_file=$tmpfile
         kernel_connection_info = str(kernel_connection_info).replace("'", '"');
 
         self.batch_job = self.batch_job.format(KERNEL_CONNECTION_INFO=kernel_connection_info, connection_file='$connection_file');
-        self.log.debug('Final sbatch jobfile: ' + str(self.batch_job));
+        self.kernel_connection_info = kernel_connection_info;
 
-        run_command = self.ssh_command.split(' ') + self.sbatch_command;
-        self.log.debug('Would run SSH command: ' + str(run_command));
+        # with idle release, Jupyter talks to a local relay which outlives the Slurm job
+        if self.idle_release > 0 and not self.shared_allocation:
+            await self._start_relay();
 
-        try:
-            self.process = Popen(run_command, stdout=PIPE, stderr=PIPE, stdin=PIPE);
-            child_process_out, child_process_err = self.process.communicate(input=self.batch_job.encode(), timeout=10.0);
-            child_process_out = child_process_out.decode('utf-8').strip();
+        # a restart starts the next kernel inside the allocation of the previous one
+        if self.restart_in_allocation and self.job_id and self.state == 'RUNNING':
+            if await self._restart_in_allocation(kernel_connection_info):
+                return self.connection_info;
 
-            # check exit code
-            if not self.process.returncode == 0:
-                error_text = child_process_err.decode('utf-8').strip();
-                raise SSHCommandError('Error running the SSH command. Output:\n\n' + error_text + '\n\nYou may want to update your kernelspec file with: $ slurmkernel edit');
+        self.kernel_generation = 0;
+        self.kernel_exited = False;
+        self.restarting = False;
 
-        except TimeoutExpired:
-            raise SSHTimeout(f'Timeout expired when calling command\n{" ".join(run_command)}\n\nPlease check your SSH config. Run the command in your terminal to see whats wrong.\nYou may want to update your kernel configuration.');
+        # start the kernel as job step of an allocation shared with other kernels
+        if self.shared_allocation:
+            shared_kernel = self.shared_kernel.format(KERNEL_CONNECTION_INFO=kernel_connection_info, connection_file='$connection_file');
+            await self._ensure_ssh_connection();
+            try:
+                with self.timer.span('ssh.shared_allocation_attach'):
+                    self.allocation = await SharedAllocation.attach(self.shared_allocation_key, self.kernel_id, shared_kernel, self.connection, self.status_service, self.shared_batch, self.remote_job_directory,
+                                                                    size=self.shared_allocation_size, timeout=self.ssh_timeout, log=self.log);
+            except SharedAllocationError as e:
+                raise SSHCommandError(str(e) + '\n\nYou may want to update your kernelspec file with: $ slurmkernel edit');
+            self.job_id = self.allocation.job_id;
+            self.log.info(f'Starting the kernel in shared Slurm job {self.job_id}: ' + str(self.allocation.stats()));
+            self.process = SlurmJobHandle(self.job_id);
+            self.status_service.register(self.job_id);
+            self.timer.tag(job_id=self.job_id, shared=True);
+            self.timer.mark('queue');
+            self._start_watchers();
+            return self.connection_info;
+
+        await self._submit_job();
+        return self.connection_info;
+
+    async def _submit_job (self):
+
+        if self.sync_failed:
+            # the kernel would start without its data
+            raise WorkdirSyncError(f'Syncing the working directory failed, no Slurm job was submitted: {self.sync_error}');
+
+        # a task of a job array (bulk launch) is bound to this kernel as soon as it runs
+        if self.job_array_pool and self.job_array_pool.array_ids:
+            await self._ensure_ssh_connection();
+            with self.timer.span('ssh.job_array_claim'):
+                task_id = await self.job_array_pool.claim(self.kernel_connection_info);
+            self.log.info('Job array stats: ' + str(self.job_array_pool.stats()));
+            if task_id:
+                self.job_id = task_id;
+                self.log.info(f'Claimed task {task_id} of the job array');
+                self.timer.tag(job_id=self.job_id, warm=False, array=True);
+                self.timer.mark('queue');
+                self.process = SlurmJobHandle(self.job_id);
+                self.status_service.register(self.job_id);
+                self._start_watchers();
+                return;
+
+        # try to claim an already submitted allocation first
+        if self.warm_pool:
+            await self._ensure_ssh_connection();
+            with self.timer.span('ssh.warm_pool_claim'):
+                self.job_id = await self.warm_pool.claim(self.kernel_connection_info);
+            self.warm_pool.refill();
+            self.log.info(f'Warm pool stats: ' + str(self.warm_pool.stats()));
+            if self.job_id:
+                self.log.info(f'Claimed warm Slurm job {self.job_id} from the pool');
+                self.timer.tag(job_id=self.job_id, warm=True);
+                self.timer.mark('queue');
+                self.process = SlurmJobHandle(self.job_id);
+                self.status_service.register(self.job_id);
+                self._start_watchers();
+                return;
+
+        self.log.debug('Final sbatch jobfile: ' + str(self.batch_job));
+
+        self.log.debug('Would run SSH command: ' + str(self.connection.ssh_command(['-tA']) + self.sbatch_command));
+
+        await self._ensure_ssh_connection();
+        submitted = None;
+        failovers = 0;
+        while submitted is None:
+            try:
+                with self.timer.span('ssh.sbatch'):
+                    returncode, child_process_out, child_process_err = await self.connection.run(self.sbatch_command, input=self.batch_job.encode(), timeout=self.ssh_timeout, flags=['-tA']);
+                submitted = child_process_out.decode('utf-8').strip();
+            except TimeoutExpired:
+                failovers += 1;
+                if not self.loginnode_failover or failovers >= len(self.connection.loginnodes) or not await self._failover_submission():
+                    raise SSHTimeout(f'Timeout expired when calling command\n{" ".join(self.connection.ssh_command(["-tA"]) + self.sbatch_command)}\n\nPlease check your SSH config. Run the command in your terminal to see whats wrong.\nYou may want to update your kernel configuration.');
+                if self.job_id:
+                    returncode, submitted = 0, str(self.job_id);
+
+        # check exit code
+        if not returncode == 0:
+            error_text = child_process_err.decode('utf-8').strip();
+            raise SSHCommandError('Error running the SSH command. Output:\n\n' + error_text + '\n\nYou may want to update your kernelspec file with: $ slurmkernel edit');
+        child_process_out = submitted;
 
         self.log.debug('Submitted Slurm job! sbatch output: ' + str(child_process_out));
 
@@ -155,75 +670,630 @@ connection_file=$tmpfile
                 self.log.info("Slurm job successfully submitted. Slurm job id: " + str(self.job_id));
             except:
                 raise NoSlurmJobID("Could not fetch the Slurm job id!");
+        if self.sync_failed:
+            # the transfer failed while sbatch ran - later failures cancel the job themselves
+            await self._cancel_job(self.job_id);
+            self.job_id = None;
+            raise WorkdirSyncError(f'Syncing the working directory failed, the Slurm job was cancelled: {self.sync_error}');
+        self.process = SlurmJobHandle(self.job_id);
+        self.status_service.register(self.job_id);
+        self.timer.tag(job_id=self.job_id, warm=False);
+        self.timer.mark('queue');
+        self._start_watchers();
 
-        return self.connection_info;
+    async def _prepare_workdir_sync (self, cwd):
+
+        # the declared local paths are sent while the job waits in the queue - the batch job waits for the transfer
+        local_root = os.path.abspath(cwd or os.getcwd());
+        sync = WorkdirSync.get(self.connection, local_root, self.sync_paths, self.sync_directory or self.remote_sync_directory, timeout=self.sync_timeout, ssh_timeout=self.ssh_timeout);
+        self.sync_failed = False;
+        await self._ensure_ssh_connection();
+        with self.timer.span('ssh.sync_prepare'):
+            remote_path, sync_wait, prepared = await sync.prepare(self.sync_timeout);
+        self.timer.record('sync.scan', prepared['scan_time'], files=prepared['files']);
+
+        if prepared['pending']:
+            self.log.info(f'Syncing {prepared["changed"]} of {prepared["files"]} files in {local_root} to {self.connection.loginnode}:{remote_path} while the Slurm job is queued');
+            self.sync_task = asyncio.ensure_future(self._transfer_workdir(sync, remote_path, prepared));
+        elif prepared['busy']:
+            self.log.info(f'Another sync to {self.connection.loginnode}:{remote_path} is running, the Slurm job waits for it');
+        else:
+            self.log.info(f'All {prepared["files"]} files in {local_root} are unchanged since the last sync to {remote_path}');
+            self.timer.record('sync', 0.0, files=0, bytes=0);
+        return sync_wait;
+
+    async def _transfer_workdir (self, sync, remote_path, prepared):
+
+        try:
+            stats = await sync.transfer(remote_path, prepared);
+        except Exception as e:
+            # the kernel would start without its data
+            self.log.error(f'Syncing the working directory failed, cancelling the Slurm job: {e}');
+            self.sync_failed = True;
+            self.sync_error = str(e);
+            if self.job_id:
+                await self._cancel_job(self.job_id);
+            return;
+        self.log.info(f'Synced {stats.get("files_transferred", prepared["changed"])} files to {remote_path} in {stats["duration"]:.2f}s ({stats.get("bytes_sent", 0)} bytes sent for {stats.get("transferred_size", 0)} bytes of changed files)');
+        self.timer.record('sync', stats['duration'], files=stats.get('files_transferred', prepared['changed']), bytes=stats.get('bytes_sent', 0), attempts=stats['attempts']);
+        self.log.debug('Workdir sync stats: ' + str(sync.stats()));
+
+    def _stage_environment (self, kernel_command, extra_environment):
+
+        # the kernel command and environment use the node-local copies of the stage paths
+        stage_paths = list(dict.fromkeys(path.rstrip('/') for path in self.stage_paths if path.strip('/')));
+        stage_defaults = '';
+        for index, path in enumerate(stage_paths):
+            stage_defaults += f'stage_path_{index}={path}\n';
+        for index, path in sorted(enumerate(stage_paths), key=lambda item: len(item[1]), reverse=True):
+            kernel_command = kernel_command.replace(path, f'$stage_path_{index}');
+            extra_environment = extra_environment.replace(path, f'$stage_path_{index}');
+
+        stage_key = sha256('\n'.join(stage_paths).encode('utf-8')).hexdigest()[:16];
+        stage_script = self.stage_job.format(STAGE_DEFAULTS=stage_defaults.rstrip('\n'), STAGE_DIRECTORY=self.stage_directory or '$TMPDIR', ARCHIVE_DIRECTORY=self.remote_stage_directory, STAGE_KEY=stage_key, STAGE_SOURCES=' '.join(stage_paths));
+        return stage_script, kernel_command, extra_environment;
+
+    async def _select_sbatch_shape (self):
+
+        # all shapes are probed with sbatch --test-only in one remote command, ties go to the shape listed first
+        shapes = [dict(self.sbatch_flags, **shape) for shape in self.sbatch_shapes];
+        cache = StartPredictionCache.get(self.connection, ttl=self.shape_prediction_ttl, timeout=self.ssh_timeout);
+        try:
+            await self._ensure_ssh_connection();
+            with self.timer.span('ssh.shape_probe', shapes=len(shapes)):
+                predictions = await cache.predict(shapes);
+        except SSHTimeout as e:
+            self.log.warning(f'Could not probe the sbatch shapes, submitting the first one: {e}');
+            return shapes[0];
+
+        chosen = None;
+        for index, (start, message) in enumerate(predictions):
+            self.log.debug(f'sbatch shape {index} ({describe_shape(shapes[index], self.sbatch_flags)}): {message}');
+            if start is not None and (chosen is None or start < predictions[chosen][0]):
+                chosen = index;
+        if chosen is None:
+            self.log.warning('The scheduler predicted no start time for any sbatch shape, submitting the first one');
+            chosen = 0;
+
+        starts = ', '.join(f'{describe_shape(shape, self.sbatch_flags)}: {start.isoformat() if start else "-"}' for shape, (start, _) in zip(shapes, predictions));
+        self.log.info(f'Submitting sbatch shape {describe_shape(shapes[chosen], self.sbatch_flags)} with the earliest predicted start (predicted starts: {starts})');
+        self.log.debug('Start prediction cache stats: ' + str(cache.stats()));
+        self.timer.tag(shape=chosen, partition=shapes[chosen].get('partition'));
+        return shapes[chosen];
+
+    async def _rightsize_sbatch_flags (self, sbatch_flags):
+
+        # the history is only a hint - without it the job starts with the configured flags
+        history = JobHistory.get(self.connection, days=self.rightsize_days, timeout=self.ssh_timeout);
+        try:
+            await self._ensure_ssh_connection();
+            with self.timer.span('ssh.rightsize'):
+                jobs = await history.get_jobs();
+        except (SSHTimeout, JobHistoryUnavailable) as e:
+            self.log.warning(f'Right-sizing skipped: {e}');
+            return sbatch_flags;
+
+        suggestion = suggest_sbatch_flags(jobs, sbatch_flags, bounds=self.rightsize_bounds, margin=self.rightsize_margin);
+        if not suggestion['flags']:
+            self.log.debug(f'No right-sizing from {suggestion["samples"]} past kernel jobs: ' + ', '.join(suggestion['reasons'] or ['the configured flags fit']));
+            return sbatch_flags;
+
+        rightsized = dict(sbatch_flags, **suggestion['flags']);
+        changes = ', '.join(f'{parameter} {sbatch_flags[parameter]} -> {value}' for parameter, value in suggestion['flags'].items());
+        # the scheduler estimates both start times while the launch goes on
+        self.rightsize_task = asyncio.ensure_future(self._log_predicted_wait_saved(sbatch_flags, rightsized, changes));
+        if self.rightsize == 'apply':
+            self.log.info(f'Right-sized the Slurm job from {suggestion["samples"]} past kernel jobs: {changes}');
+            self.timer.tag(rightsized=True);
+            return rightsized;
+        self.log.info(f'Right-sizing suggestion from {suggestion["samples"]} past kernel jobs: {changes} (apply it with: $ slurmkernel rightsize --apply)');
+        return sbatch_flags;
+
+    async def _log_predicted_wait_saved (self, configured, rightsized, changes):
+
+        # the configured flags are usually still cached from the shape selection
+        cache = StartPredictionCache.get(self.connection, ttl=self.shape_prediction_ttl, timeout=self.ssh_timeout);
+        try:
+            (configured_start, _), (rightsized_start, _) = await cache.predict([configured, rightsized]);
+        except Exception as e:
+            self.log.debug(f'Could not predict the start of the right-sized Slurm job: {e}');
+            return;
+        if configured_start is None or rightsized_start is None:
+            self.log.debug(f'The scheduler did not predict a start time for the right-sized Slurm job ({changes})');
+            return;
+
+        saved = (configured_start - rightsized_start).total_seconds();
+        self.log.info(f'Predicted queue wait saved by right-sizing ({changes}): {int(saved)}s, start at {rightsized_start.isoformat()} instead of {configured_start.isoformat()}');
+        self.timer.record('rightsize.predicted_wait_saved', saved, applied=self.rightsize == 'apply');
 
-    def _start_ssh_port_forwarding (self):
+    def _job_directory (self):
+
+        # directory of the kernel supervisor: one per job, or one per job step in a shared allocation
+        if self.allocation:
+            return f'{self.remote_job_directory}/{self.job_id}/kernels/{self.kernel_id}';
+        return f'{self.remote_job_directory}/{self.job_id}';
+
+    async def _restart_in_allocation (self, kernel_connection_info):
+
+        # hand over the connection file of the next kernel generation, the old kernel is terminated if still alive
+        generation = self.kernel_generation;
+        job_directory = self._job_directory();
+        next_connection_file = f'{job_directory}/connection.{generation + 1}.json';
+        restart_command = ['/bin/bash', '-c', f'"[ -d {job_directory} ] && touch {job_directory}/terminate.{generation} && cat > {next_connection_file}.tmp && mv {next_connection_file}.tmp {next_connection_file}"'];
+
+        await self._ensure_ssh_connection();
+        try:
+            with self.timer.span('ssh.restart'):
+                returncode, _, _ = await self.connection.run(restart_command, input=kernel_connection_info.encode(), timeout=self.ssh_timeout);
+        except TimeoutExpired:
+            returncode = 1;
+
+        if not returncode == 0:
+            self.log.info(f'Slurm job {self.job_id} cannot be reused for the restart. Submitting a new Slurm job.');
+            await self._stop_ssh_port_forwarding();
+            await self._detach_allocation();
+            self.status_service.unregister(self.job_id);
+            self.job_id = None;
+            self.state = None;
+            self.exec_node = None;
+            return False;
+
+        self.kernel_generation = generation + 1;
+        self.kernel_exited = False;
+        self.restarting = False;
+        self.process = SlurmJobHandle(self.job_id);
+        self.timer.tag(job_id=self.job_id, restart=True);
+
+        # the tunnel survives the restart if the kernel keeps its ports
+        ports = sorted(self.connection_info[kport] for kport in [ 'stdin_port', 'shell_port', 'iopub_port', 'hb_port', 'control_port' ]);
+        if self.tunnel and self.tunnel.is_alive() and sorted(self.tunnel.ports) == ports:
+            self.log.info('Reusing the SSH tunnel of the previous kernel');
+        else:
+            await self._stop_ssh_port_forwarding();
+
+        self.log.info(f'Restarting the kernel inside Slurm job {self.job_id} on compute node {self.exec_node} (kernel #{self.kernel_generation})');
+        self._start_watchers(pending=False);
+        return True;
+
+    async def _start_ssh_port_forwarding (self):
+
+        # poll() and the pending watcher may both notice the running job
+        async with self.port_forwarding_lock:
+            if not self.active_port_forwarding:
+                with self.timer.span('tunnel', exec_node=self.exec_node):
+                    await self._open_ssh_port_forwarding();
+                if self.active_port_forwarding:
+                    # from pre_launch until the kernel ports are reachable on localhost
+                    self.timer.since('launch', 'launch_total', generation=self.kernel_generation);
+
+    async def _open_ssh_port_forwarding (self):
 
         if self.exec_node:
             if self.connection_info:
 
-                port_forward = ' ';
-                port_forward = port_forward.join(['-L {{{kport}}}:127.0.0.1:{{{kport}}}'.format(kport=kport) for kport in [ 'stdin_port', 'shell_port', 'iopub_port', 'hb_port', 'control_port' ]]);
-                # replace needed ports
-                port_forward = port_forward.format(**self.connection_info);
+                ports = [self.connection_info[kport] for kport in [ 'stdin_port', 'shell_port', 'iopub_port', 'hb_port', 'control_port' ]];
+                local_ports = ports;
+                if self.relay:
+                    # the relay listens on the kernel ports, the tunnel ends on its upstream ports
+                    local_ports = [self.relay.upstream_ports[channel] for channel in ['stdin', 'shell', 'iopub', 'hb', 'control']];
 
-                proxy_jump = '';
-                if self.proxyjump:
-                    proxy_jump = f'-J {self.proxyjump},{self.loginnode}';
+                await self._ensure_ssh_connection();
+                if self.transport['split_channels']:
+                    self.tunnel = SplitTunnel(self.connection, self.exec_node, local_ports, [local_ports[2]], timeout=self.ssh_timeout, log=self.log, profile=self.transport, remote_ports=ports);
                 else:
-                    proxy_jump = f'-J {self.loginnode}';
+                    self.tunnel = SSHTunnel(self.connection, self.exec_node, local_ports, timeout=self.ssh_timeout, log=self.log, profile=self.transport, remote_ports=ports);
 
-                ssh_command = ['ssh', '-fNA', '-o', 'StrictHostKeyChecking=no'] + proxy_jump.split(' ') + port_forward.split(' ');
-                ssh_command.append(self.exec_node);
+                self.log.info(f'Starting SSH tunnel to forward kernel ports to localhost (transport profile {self.transport_profile})');
+                self.log.debug('Using command: ' + str(self.tunnel.command()));
 
-                self.log.info('Starting SSH tunnel to forward kernel ports to localhost');
-                self.log.debug('Using command: ' + str(ssh_command));
+                # a failed tunnel is retried with the next poll
+                try:
+                    await self.tunnel.start();
+                except SSHTunnelError as e:
+                    self.log.error(str(e));
+                    self.tunnel = None;
+                    return;
 
-                ssh_tunnel_process = Popen(ssh_command, stdout=PIPE, stderr=STDOUT);
+                self.log.info(f'SSH tunnel is up after {self.tunnel.setup_time:.2f}s');
                 if self.exec_node:
                     self.log.info(f'Your started kernel is now ready to use on compute node {self.exec_node}');
                 self.active_port_forwarding = True;
+                if self.relay:
+                    self.relay.connected();
+
+    async def _stop_ssh_port_forwarding (self):
+
+        async with self.port_forwarding_lock:
+            if self.tunnel:
+                self.log.debug('SSH tunnel stats: ' + str(self.tunnel.stats()));
+                await self.tunnel.stop();
+                self.tunnel = None;
+            self.active_port_forwarding = False;
+            if self.relay:
+                self.relay.disconnected();
+
+    async def _start_relay (self):
+
+        if self.relay and not self.relay.matches(self.connection_info):
+            # restarted with other ports or another key
+            await self.relay.stop();
+            self.relay = None;
+        if not self.relay:
+            self.relay = KernelRelay(self.connection_info, on_resume=self._request_resume, log=self.log);
+            self.relay.start();
+        if self.relay.suspended:
+            # restarted while suspended
+            self.relay.resumed();
+        self.suspended = False;
+        if not self.idle_watcher or self.idle_watcher.done():
+            self.idle_watcher = asyncio.ensure_future(self._watch_idle());
+
+    async def _stop_relay (self, restart=False):
+
+        for task in [self.resume_task] + ([] if restart else [self.idle_watcher]):
+            if task and not task.done():
+                task.cancel();
+        if self.held_job_id:
+            await self._cancel_job(self.held_job_id);
+            self.held_job_id = None;
+        if self.relay and not restart:
+            self.log.debug('Kernel relay stats: ' + str(self.relay.stats()));
+            await self.relay.stop();
+            self.relay = None;
+
+    async def _watch_idle (self):
+
+        # the relay sees every message - a kernel without activity for idle_release seconds gives its allocation back
+        interval = min(60.0, max(1.0, self.idle_release / 10));
+        while True:
+            await asyncio.sleep(interval);
+            try:
+                if self.suspended or self.restarting or not self.active_port_forwarding or not self.state == 'RUNNING':
+                    continue;
+                # a long computation without output is busy, not idle
+                if self.relay.execution_state == 'busy' or self.relay.idle_time() < self.idle_release:
+                    continue;
+                await self._suspend();
+            except asyncio.CancelledError:
+                raise;
+            except Exception as e:
+                self.log.error(f'Releasing the idle Slurm job {self.job_id} failed: {e}');
+
+    async def _suspend (self):
+
+        job_id = self.job_id;
+        idle = self.relay.idle_time();
+        self.log.info(f'Kernel was idle for {int(idle)}s, releasing Slurm job {job_id} until the next execute request');
+        self.suspended = True;
+        await self.relay.suspend(f'Resuming the suspended kernel: its Slurm job {job_id} was released after {int(idle)}s without activity, a new Slurm job is started.\nVariables and imports of the previous session are gone.\n');
+        self._stop_watchers();
+        await self._stop_ssh_port_forwarding();
+        await self._cancel_job(job_id);
+        self.status_service.unregister(job_id);
+        self._forget_telemetry(job_id);
+        self.job_id = None;
+        self.state = None;
+        self.exec_node = None;
+        self.kernel_generation = 0;
+        self.kernel_exited = False;
+        self.timer.record('idle_release', idle, job_id=job_id);
+        self.log.debug('Kernel relay stats: ' + str(self.relay.stats()));
+        if self.idle_release_prequeue:
+            await self._prequeue_job();
+
+    def _request_resume (self):
+
+        if not self.resume_task or self.resume_task.done():
+            self.resume_task = asyncio.ensure_future(self._resume());
+
+    async def _resume (self):
+
+        self.log.info('Execute request for the suspended kernel, starting a new Slurm job');
+        self.timer.mark('launch');
+        try:
+            if self.held_job_id:
+                await self._release_held_job();
+            if not self.job_id:
+                await self._submit_job();
+        except Exception as e:
+            self.log.error(f'Could not resume the suspended kernel: {e}');
+            # the next execute request tries again
+            self.relay.resume_requested = False;
+            return;
+        self.suspended = False;
+        self.relay.resumed();
+
+    async def _prequeue_job (self):
+
+        # a held job waits in the queue without starting, resuming only has to release it
+        hold_command = self.sbatch_command[:-1] + [self.sbatch_command[-1].replace('sbatch --parsable', 'sbatch --parsable --hold')];
+        try:
+            await self._ensure_ssh_connection();
+            with self.timer.span('ssh.sbatch_hold'):
+                returncode, sbatch_out, sbatch_err = await self.connection.run(hold_command, input=self.batch_job.encode(), timeout=self.ssh_timeout);
+        except (SSHTimeout, TimeoutExpired) as e:
+            self.log.warning(f'Could not pre-queue a held Slurm job: {e}');
+            return;
+        job_id = re.search(r'(\d+)', sbatch_out.decode('utf-8'));
+        if not returncode == 0 or not job_id:
+            self.log.warning('Could not pre-queue a held Slurm job: ' + sbatch_err.decode('utf-8').strip());
+            return;
+        self.held_job_id = int(job_id.group(1));
+        self.log.info(f'Pre-queued held Slurm job {self.held_job_id} for the next execute request');
+
+    async def _release_held_job (self):
+
+        job_id, self.held_job_id = self.held_job_id, None;
+        await self._ensure_ssh_connection();
+        try:
+            with self.timer.span('ssh.release_hold'):
+                returncode, _, release_err = await self.connection.run(['/bin/bash', '--login', '-c', f'"scontrol release {job_id}"'], timeout=self.ssh_timeout);
+        except TimeoutExpired:
+            returncode, release_err = 1, b'timeout expired';
+        if not returncode == 0:
+            self.log.warning(f'Could not release the held Slurm job {job_id}, submitting a new one: ' + release_err.decode('utf-8').strip());
+            await self._cancel_job(job_id);
+            return;
+
+        self.job_id = job_id;
+        self.log.info(f'Released the pre-queued Slurm job {job_id}');
+        self.process = SlurmJobHandle(job_id);
+        self.status_service.register(job_id);
+        self.timer.tag(job_id=job_id, warm=False, prequeued=True);
+        self.timer.mark('queue');
+        self._start_watchers();
+
+    async def _cancel_job (self, job_id):
+
+        try:
+            await self._ensure_ssh_connection();
+            with self.timer.span('ssh.scancel'):
+                await self.connection.run(['/bin/bash', '--login', '-c', f'"scancel {job_id}"'], timeout=self.ssh_timeout);
+        except Exception as e:
+            self.log.warning(f'Could not cancel Slurm job {job_id}: {e}');
 
-    def _get_slurm_job_state (self, job_id: int):
+    def sbatch_comment (self):
 
-        check_command = self.ssh_command.split(' ') + ['-T', '/bin/bash', '--login', '-c', f'"squeue -h -j {self.job_id} -o \'%T %B\' 2> /dev/null"'];
+        return f'slurm_jupyter_kernel:{self.kernel_id}';
 
-        squeue_output = check_output(check_command);
-        squeue_output = squeue_output.decode('utf-8').strip().split(' ');
+    def telemetry (self, lease: Optional[float] = None) -> Dict[str, Any]:
+
+        # CPU, memory and I/O samples of the Slurm job - every call keeps the sampling alive for <lease> seconds,
+        # without a reader no sstat runs at all
+        telemetry = {'kernel_id': self.kernel_id, 'job_id': str(self.job_id) if self.job_id else None, 'exec_node': self.exec_node, 'state': self.state,
+                     'suspended': self.suspended, 'shared_allocation': bool(self.allocation), 'interval': self.telemetry_interval, 'samples': []};
+        if not self.job_id or self.telemetry_interval <= 0 or not getattr(self, 'connection', None):
+            return telemetry;
+        service = JobTelemetry.get(self.connection, interval=self.telemetry_interval, history=self.telemetry_history, timeout=self.ssh_timeout, log=self.log);
+        # a reader may ask for less than telemetry_lease (0: read only), never for more
+        lease = self.telemetry_lease if lease is None else min(lease, self.telemetry_lease);
+        if self.state == 'RUNNING' and lease > 0:
+            service.watch(self.job_id, lease);
+        telemetry['samples'] = service.get_samples(self.job_id);
+        return telemetry;
+
+    def _forget_telemetry (self, job_id):
+
+        # a shared allocation outlives the kernel, its samples are still of use to the other kernels
+        if getattr(self, 'connection', None) and not self.allocation:
+            JobTelemetry.get(self.connection, interval=self.telemetry_interval, history=self.telemetry_history, timeout=self.ssh_timeout).forget(job_id);
+
+    async def _failover_submission (self):
+
+        # the login node hung while submitting: continue on the next one, the job may have been submitted anyway
+        failed_loginnode = self.connection.loginnode;
+        self.connection.report_failure(failed_loginnode);
+        self.job_id = None;
+        try:
+            await self._ensure_ssh_connection();
+        except SSHTimeout:
+            return False;
+        if self.connection.loginnode == failed_loginnode:
+            return False;
+        self.log.warning(f'Submitting the Slurm job via {failed_loginnode} timed out, continuing via {self.connection.loginnode}');
+
+        find_command = ['/bin/bash', '--login', '-c', '"squeue -h -u $USER -o \'%i %k\'"'];
+        try:
+            returncode, squeue_output, _ = await self.connection.run(find_command, timeout=self.ssh_timeout);
+        except TimeoutExpired:
+            return False;
+        if not returncode == 0:
+            return False;
+        for line in squeue_output.decode('utf-8').splitlines():
+            fields = line.strip().split(' ', 1);
+            if len(fields) == 2 and fields[1].strip() == self.sbatch_comment():
+                self.job_id = int(fields[0]);
+                self.log.info(f'Slurm job {self.job_id} was submitted before {failed_loginnode} hung');
+        return True;
+
+    async def _ensure_ssh_connection (self):
+
+        try:
+            with self.timer.span('ssh.ensure_master'):
+                reused = await self.connection.ensure();
+        except SSHMasterError as e:
+            raise SSHTimeout(str(e) + '\n\nPlease check your SSH config. You may want to update your kernel configuration.');
+
+        if not reused:
+            self.timer.record('ssh.master_connect', self.connection.connect_time or 0.0);
+            self.log.debug(f'Opened SSH master connection to {self.connection.loginnode}');
+        # spans are tagged with the login node the commands actually went through
+        self.timer.tag(loginnode=self.connection.loginnode);
+        self.log.debug(f'SSH connection stats for {self.connection.loginnode}: ' + str(self.connection.stats()));
+
+    async def _get_slurm_job_state (self, job_id: int, max_age: Optional[float] = None):
+
+        if max_age is None:
+            max_age = self.status_cache_ttl;
+        try:
+            squeue_output = await self.status_service.get_state(job_id, max_age=max_age);
+        except SSHMasterError as e:
+            raise SSHTimeout(str(e) + '\n\nPlease check your SSH config. You may want to update your kernel configuration.');
+        except SlurmStatusUnavailable:
+            # keep the last known state - a slow loginnode should not kill the kernel
+            self.log.warning(f'Could not query the state of Slurm job {job_id}. Keeping the last known state.');
+            return [self.state, self.exec_node, self.estimated_start_time];
+
+        self.log.debug(f'Slurm job status cache for {self.connection.loginnode}: ' + str(self.status_service.stats()));
+
+        squeue_output = squeue_output or [''];
         self.state = squeue_output[0].strip();
 
         self.log.debug(f'Slurm job {job_id} is in state "{self.state}"');
 
         if 'RUNNING' in self.state:
-            self.exec_node = squeue_output[1];
-            self.exec_node = self.exec_node.strip();
+            # the job step of a shared allocation may run on another node than the batch host - its ready signal tells
+            if not self.allocation:
+                self.exec_node = squeue_output[1];
+                self.exec_node = self.exec_node.strip();
+            self.timer.since('queue', 'queue_wait', exec_node=squeue_output[1].strip());
         elif 'PENDING' in self.state:
-            self.estimated_start_time = squeue_output[1].strip();
+            # %S is the estimated start time, %r the pending reason
+            self.estimated_start_time = squeue_output[2].strip() if len(squeue_output) > 2 else squeue_output[1].strip();
+            self.pending_reason = squeue_output[3].strip() if len(squeue_output) > 3 else None;
         elif self.state == '':
             self.state = 'UNKNOWN';
 
         return [self.state, self.exec_node, self.estimated_start_time];
 
+    def _start_watchers (self, pending=True):
+
+        if pending:
+            self.poll_scheduler = PollScheduler(min_interval=self.poll_min_interval, max_interval=self.poll_max_interval);
+            self.pending_watcher = asyncio.ensure_future(self._watch_pending_job());
+            self.watchers.append(self.pending_watcher);
+        if self.ready_signal or self.restart_in_allocation or self.allocation:
+            self.watchers.append(asyncio.ensure_future(self._watch_kernel(self.kernel_generation)));
+
+    def _ready_interval (self):
+
+        # a pending job cannot signal - check at the pace of the pending poll schedule (fast only close to the estimated start)
+        if self.state == 'RUNNING' or not self.pending_watcher or self.pending_watcher.done():
+            return self.ready_check_interval;
+        return max(self.poll_scheduler.interval, self.ready_check_interval);
+
+    async def _wait_for_job_file (self, name, interval=0.2, running=False):
+
+        # the file watcher checks the files of all jobs on this login node with one short command per interval
+        job_directory = self._job_directory();
+        # a running job removes its directory when it ends, the wait must not outlive it
+        directory = job_directory if running else None;
+        watcher = JobFileWatcher.get(self.connection, timeout=self.ssh_timeout);
+        while self.job_id and self.state in [None, 'PENDING', 'RUNNING']:
+            await self._ensure_ssh_connection();
+            try:
+                return await asyncio.wait_for(watcher.wait(f'{job_directory}/{name}', interval, directory), self.ready_signal_wait);
+            except asyncio.TimeoutError:
+                continue;
+        return None;
+
+    async def _watch_kernel (self, generation):
+
+        self.timer.mark('ready');
+        try:
+            if self.ready_signal or self.allocation:
+                ready_info = await self._wait_for_job_file(f'ready.{generation}', interval=self._ready_interval);
+                if ready_info and ready_info.get('status') == 'ready' and ready_info.get('exec_node'):
+                    self.log.info(f'Received ready signal of Slurm job {self.job_id} from compute node {ready_info["exec_node"]}');
+                    self.exec_node = ready_info['exec_node'];
+                    self.state = 'RUNNING';
+                    self.timer.since('queue', 'queue_wait', exec_node=self.exec_node);
+                    self.timer.since('ready', 'kernel_ready', generation=generation);
+                    if ready_info.get('stage_ms') and generation == 0:
+                        # node-local staging ran inside the job, before the kernel started
+                        self.log.info(f'Staged the kernel environment on {self.exec_node} in {ready_info["stage_ms"]} ms ({ready_info.get("stage_status")})');
+                        self.timer.record('stage', int(ready_info['stage_ms']) / 1000, status=ready_info.get('stage_status'));
+                    await self._start_ssh_port_forwarding();
+
+            if self.restart_in_allocation:
+                # the allocation outlives the kernel - notice when the kernel itself is gone
+                exit_info = await self._wait_for_job_file(f'exited.{generation}', interval=self.exit_check_interval, running=True);
+                if exit_info and generation == self.kernel_generation and not self.restarting:
+                    self.log.warning(f'Kernel in Slurm job {self.job_id} exited with code {exit_info.get("exit_code")}');
+                    self.kernel_exited = True;
+        except asyncio.CancelledError:
+            raise;
+        except Exception as e:
+            self.log.error(f'Watching the kernel in Slurm job {self.job_id} failed: {e}');
+
+    async def _watch_pending_job (self):
+
+        # follow the job until it leaves the queue - the check interval depends on the expected start time
+        try:
+            # the ready signal of the job may have been faster
+            while self.job_id and not self.active_port_forwarding:
+                state, exec_node, estimated_start_time = await self._get_slurm_job_state(self.job_id, max_age=self.poll_scheduler.interval);
+                if state is None:
+                    await asyncio.sleep(PollScheduler.base_interval);
+                    continue;
+                if not state == 'PENDING':
+                    break;
+
+                interval = self.poll_scheduler.next_interval(state, estimated_start_time, self.pending_reason, cluster_now=self.status_service.cluster_now());
+                if interval >= PollScheduler.base_interval:
+                    expected_wait = self.poll_scheduler.expected_wait;
+                    expected_wait = f'expected start in {int(max(expected_wait, 0))}s' if expected_wait is not None else 'no start time estimated yet';
+                    self.log.info(f'Your Slurm job {self.job_id} is in state pending ({self.pending_reason}, {expected_wait}). Next check in {interval:.1f}s');
+                await asyncio.sleep(interval);
+
+            if self.state == 'RUNNING' and isinstance(self.exec_node, str) and self.active_port_forwarding == False:
+                self.log.info(f'Slurm job is in state running on compute node {self.exec_node}');
+                await self._start_ssh_port_forwarding();
+        except asyncio.CancelledError:
+            raise;
+        except Exception as e:
+            # poll() takes over again
+            self.log.error(f'Watching the pending Slurm job {self.job_id} failed: {e}');
+
+    def _stop_watchers (self):
+
+        for watcher in self.watchers:
+            if not watcher.done():
+                watcher.cancel();
+        self.watchers = [];
+
     async def poll(self) -> Optional[int]:
 
         # 0 = polling
         result = 0;
+        if self.suspended:
+            # no Slurm job until the next execute request, the relay keeps the kernel ports open
+            return None;
+        if self.restarting or self.kernel_exited:
+            # only the kernel is gone, the allocation is kept for the next kernel
+            return result;
         if self.job_id:            
-            state, exec_node, estimated_starttime = self._get_slurm_job_state(self.job_id);
+            if self.state == 'PENDING' and self.pending_watcher and not self.pending_watcher.done():
+                # the pending watcher queries the job state on its own schedule
+                state, exec_node, estimated_starttime = self.state, self.exec_node, self.estimated_start_time;
+            elif not self.active_port_forwarding:
+                # only polls during the launch are timed, a running kernel is polled for hours
+                with self.timer.span('poll'):
+                    state, exec_node, estimated_starttime = await self._get_slurm_job_state(self.job_id);
+            else:
+                state, exec_node, estimated_starttime = await self._get_slurm_job_state(self.job_id);
+            # the tunnel watches itself and reconnects - report it together with the kernel state
+            if self.tunnel and not self.tunnel.is_alive():
+                self.log.warning(f'SSH tunnel to compute node {self.exec_node} is down, reconnecting: ' + str(self.tunnel.stats()));
             # also returning None if Slurm job is PENDING
             if state in ['RUNNING', 'PENDING']:
-                if 'PENDING' in state:
-                    self.log.info(f'Your Slurm job {self.job_id} is in state pending. Waiting for Slurm job to start!');
                 # if we have an execution node (running job) start ssh tunnel
                 if isinstance(exec_node, str):
                     if self.active_port_forwarding == False:
                         self.log.info(f'Slurm job is in state running on compute node {exec_node}');
-                        self._start_ssh_port_forwarding();
+                        await self._start_ssh_port_forwarding();
+                result = None;
+            elif state is None:
+                # no state could be fetched yet - keep waiting
                 result = None;
             elif state == 'UNKNOWN':
-                self.log.error(f'Slurm job {self.job_id} is UNKNOWN! The Slurm job disappeared in the queue. Check the Slurm job logs for more information!');
+                if self.sync_failed:
+                    self.log.error(f'Slurm job {self.job_id} was cancelled because syncing the working directory failed: {self.sync_error}');
+                else:
+                    self.log.error(f'Slurm job {self.job_id} is UNKNOWN! The Slurm job disappeared in the queue. Check the Slurm job logs for more information!');
+                self.status_service.unregister(self.job_id);
                 await self.kill(restart=False);
+                await self._detach_allocation();
 
         return result;
 
@@ -248,5 +1318,57 @@ connection_file=$tmpfile
         else:
             return await super().send_signal(signum);
 
+    async def _signal_job (self, marker):
+
+        # control files for the kernel supervisor of the batch job
+        if self.job_id and self.status_service and (self.ready_signal or self.restart_in_allocation or self.allocation):
+            job_directory = self._job_directory();
+            try:
+                await self._ensure_ssh_connection();
+                with self.timer.span('ssh.signal', marker=marker):
+                    await self.connection.run(['/bin/bash', '-c', f'"[ -d {job_directory} ] && touch {job_directory}/{marker}"'], timeout=self.ssh_timeout);
+            except Exception as e:
+                self.log.warning(f'Could not signal Slurm job {self.job_id}: {e}');
+
+    async def shutdown_requested(self, restart: bool = False) -> None:
+
+        # the kernel is about to exit: no need to wait until the Slurm job ends
+        if restart and self.restart_in_allocation and self.state == 'RUNNING':
+            self.restarting = True;
+        return await super().shutdown_requested(restart)
+
     async def kill(self, restart: bool = False) -> None:
-        return await super().kill(restart)
\ No newline at end of file
+        self._stop_watchers();
+        self.suspended = False;
+        await self._stop_ssh_port_forwarding();
+        if not self.kernel_exited:
+            await self._signal_job(f'terminate.{self.kernel_generation}');
+            self.kernel_exited = True;
+        return await super().kill(restart)
+
+    async def cleanup(self, restart: bool = False) -> None:
+
+        if restart and self.restart_in_allocation and self.state == 'RUNNING':
+            # keep job, tunnel and job state for the next kernel
+            self.restarting = True;
+            return await super().cleanup(restart)
+
+        # stop fetching the state of a job nobody is interested in anymore
+        self._stop_watchers();
+        await self._stop_ssh_port_forwarding();
+        await self._signal_job('stop');
+        if self.allocation:
+            # the last kernel releases the shared allocation
+            await self._detach_allocation();
+        elif self.status_service and self.job_id:
+            self.status_service.unregister(self.job_id);
+            self._forget_telemetry(self.job_id);
+        await self._stop_relay(restart);
+        return await super().cleanup(restart)
+
+    async def _detach_allocation (self):
+
+        if self.allocation:
+            allocation = self.allocation;
+            self.allocation = None;
+            await allocation.detach(self.kernel_id);
\ No newline at end of file
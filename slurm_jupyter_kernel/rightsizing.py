@@ -0,0 +1,222 @@
+import re;
+import math;
+import asyncio;
+import threading;
+from time import monotonic;
+from subprocess import TimeoutExpired;
+from slurm_jupyter_kernel.timing import percentile;
+
+class JobHistoryUnavailable (Exception):
+    pass;
+
+# job name of the kernel jobs (shared allocations use jupyter_slurm_kernels and are not sized per kernel;
+# warm pool jobs and job array tasks have their own names, they spend part of their time waiting for a kernel)
+kernel_job_name = 'jupyter_slurm_kernel';
+# the batch step carries MaxRSS, the job line everything else
+sacct_fields = ['JobIDRaw', 'JobName', 'Partition', 'State', 'Elapsed', 'TimelimitRaw', 'ReqMem', 'ReqTRES', 'MaxRSS'];
+
+memory_units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4};
+
+def parse_time (value):
+
+    # Slurm time formats: minutes, minutes:seconds, hours:minutes:seconds, days-hours[:minutes[:seconds]]
+    value = str(value).strip();
+    if not value or value in ['UNLIMITED', 'Partition_Limit', 'INVALID']:
+        return None;
+    if '-' in value:
+        days, value = value.split('-', 1);
+        days = int(days);
+        parts = [float(part) for part in value.split(':')] + [0, 0];
+        return days * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2];
+    parts = [float(part) for part in value.split(':')];
+    if len(parts) == 1:
+        return parts[0] * 60;
+    if len(parts) == 2:
+        return parts[0] * 60 + parts[1];
+    return parts[0] * 3600 + parts[1] * 60 + parts[2];
+
+def format_time (seconds):
+
+    seconds = int(math.ceil(seconds));
+    days, seconds = divmod(seconds, 86400);
+    time = f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}';
+    return f'{days}-{time}' if days else time;
+
+def parse_memory (value, default_unit='M'):
+
+    # 4000M, 1.5G, 123456K, old ReqMem style 4000Mn / 2Gc (per node / per cpu)
+    match = re.match(r'^([\d.]+)([KMGT]?)[nc]?$', str(value).strip(), re.IGNORECASE);
+    if not match:
+        return None;
+    return int(float(match.group(1)) * memory_units[(match.group(2) or default_unit).upper()]);
+
+def format_memory (size):
+
+    # whole gigabytes, below one gigabyte steps of 256M
+    if size >= memory_units['G']:
+        return f'{math.ceil(size / memory_units["G"])}G';
+    return f'{max(1, math.ceil(size / (256 * memory_units["M"]))) * 256}M';
+
+def parse_sacct (output):
+
+    # one entry per job, MaxRSS is the largest of all its steps
+    jobs = {};
+    for line in output.splitlines():
+        fields = line.strip().split('|');
+        if not len(fields) == len(sacct_fields):
+            continue;
+        record = dict(zip(sacct_fields, fields));
+        job_id, _, step = record['JobIDRaw'].partition('.');
+        if not step:
+            if not record['JobName'] == kernel_job_name:
+                continue;
+            job = jobs.setdefault(job_id, {'max_rss': None});
+            job.update({
+                'job_id': job_id,
+                'partition': record['Partition'],
+                # CANCELLED by 1234
+                'state': record['State'].split(' ')[0],
+                'elapsed': parse_time(record['Elapsed']),
+                'time_limit': float(record['TimelimitRaw']) * 60 if record['TimelimitRaw'].isdigit() else None,
+                'req_mem': parse_memory(record['ReqMem']),
+                'tres': dict(item.split('=', 1) for item in record['ReqTRES'].split(',') if '=' in item),
+            });
+        else:
+            max_rss = parse_memory(record['MaxRSS'], default_unit='K') if record['MaxRSS'] else None;
+            if max_rss is not None:
+                job = jobs.setdefault(job_id, {'max_rss': None});
+                job['max_rss'] = max(job['max_rss'] or 0, max_rss);
+    return [job for job in jobs.values() if 'state' in job];
+
+def matching_jobs (jobs, sbatch_flags):
+
+    # jobs of the same shape: partition, cpu count and whether GPUs were requested - time and memory are what is sized
+    partition = sbatch_flags.get('partition');
+    cpus = sbatch_flags.get('cpus-per-task');
+    if cpus:
+        cpus = str(int(cpus) * int(sbatch_flags.get('ntasks', 1)));
+    gpus = bool(sbatch_flags.get('gpus') or 'gpu' in str(sbatch_flags.get('gres', '')));
+
+    matching = [];
+    for job in jobs:
+        if job['state'] in ['PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED']:
+            continue;
+        if partition and not job['partition'] in str(partition).split(','):
+            continue;
+        if cpus and not job['tres'].get('cpu') == cpus:
+            continue;
+        if not gpus == any(key.startswith('gres/gpu') for key in job['tres'].keys()):
+            continue;
+        matching.append(job);
+    return matching;
+
+def suggest_sbatch_flags (jobs, sbatch_flags, bounds=None, margin=1.2, min_samples=5):
+
+    # tighter time and mem requests from the p95 usage of past kernel jobs - never more than configured
+    bounds = bounds or {};
+    jobs = matching_jobs(jobs, sbatch_flags);
+    suggestion = {'samples': len(jobs), 'flags': {}, 'reasons': []};
+    if len(jobs) < min_samples:
+        suggestion['reasons'].append(f'only {len(jobs)} past kernel jobs of this shape (at least {min_samples} needed)');
+        return suggestion;
+
+    configured_time = parse_time(sbatch_flags['time']) if 'time' in sbatch_flags else None;
+    elapsed = sorted(job['elapsed'] for job in jobs if job['elapsed'] is not None);
+    timeouts = sum(1 for job in jobs if job['state'] in ['TIMEOUT', 'DEADLINE']);
+    if configured_time is None:
+        suggestion['reasons'].append('no time configured');
+    elif timeouts > 0.1 * len(jobs):
+        # sessions get cut off by the limit - the elapsed times say nothing about the time needed
+        suggestion['reasons'].append(f'{timeouts} of {len(jobs)} kernel jobs ran into their time limit');
+    elif elapsed:
+        # whole quarter hours
+        time = math.ceil(percentile(elapsed, 95) * margin / 900) * 900;
+        time_bounds = [parse_time(bound) for bound in bounds.get('time', [])];
+        if time_bounds:
+            time = max(time, time_bounds[0]);
+        if len(time_bounds) > 1:
+            time = min(time, time_bounds[1]);
+        if time < configured_time:
+            suggestion['flags']['time'] = format_time(time);
+
+    configured_mem = parse_memory(sbatch_flags['mem']) if 'mem' in sbatch_flags else None;
+    max_rss = sorted(job['max_rss'] for job in jobs if job['max_rss']);
+    out_of_memory = sum(1 for job in jobs if job['state'] == 'OUT_OF_MEMORY');
+    if configured_mem is None:
+        suggestion['reasons'].append('no mem configured');
+    elif out_of_memory:
+        suggestion['reasons'].append(f'{out_of_memory} of {len(jobs)} kernel jobs ran out of memory');
+    elif len(max_rss) < min_samples:
+        suggestion['reasons'].append(f'MaxRSS of only {len(max_rss)} kernel jobs recorded');
+    else:
+        mem = percentile(max_rss, 95) * margin;
+        mem_bounds = [parse_memory(bound) for bound in bounds.get('mem', [])];
+        if mem_bounds:
+            mem = max(mem, mem_bounds[0]);
+        if len(mem_bounds) > 1:
+            mem = min(mem, mem_bounds[1]);
+        mem = format_memory(mem);
+        if parse_memory(mem) < configured_mem:
+            suggestion['flags']['mem'] = mem;
+
+    return suggestion;
+
+class JobHistory:
+
+    # one accounting history per SSH connection (proxyjump, loginnode, username) inside this process
+    _histories = {};
+    _histories_lock = threading.Lock();
+
+    # sacct is heavy on the accounting database - the history is fetched at most once an hour
+    cache_ttl = 3600;
+
+    def __init__ (self, connection, days=30, timeout=10.0):
+
+        self.connection = connection;
+        self.days = days;
+        self.timeout = timeout;
+        self.jobs = None;
+        self.fetched = None;
+        self._lock = asyncio.Lock();
+
+        self.fetches = 0;
+        self.hits = 0;
+
+    @classmethod
+    def get (cls, connection, days=30, timeout=10.0):
+
+        key = (connection.key, days);
+        with cls._histories_lock:
+            if not key in cls._histories:
+                cls._histories[key] = cls(connection, days, timeout);
+            return cls._histories[key];
+
+    def sacct_command (self):
+
+        fields = ','.join(sacct_fields);
+        return ['/bin/bash', '--login', '-c', f'"sacct -n -P --name={kernel_job_name} -S now-{self.days}days -o {fields}"'];
+
+    async def get_jobs (self):
+
+        async with self._lock:
+            if self.jobs is not None and monotonic() - self.fetched < self.cache_ttl:
+                self.hits += 1;
+                return self.jobs;
+
+            await self.connection.ensure();
+            try:
+                returncode, sacct_out, sacct_err = await self.connection.run(self.sacct_command(), timeout=self.timeout);
+            except TimeoutExpired:
+                raise JobHistoryUnavailable(f'Timeout expired when reading the job history (sacct)');
+            jobs = parse_sacct(sacct_out.decode('utf-8', 'replace'));
+            if not returncode == 0 and not jobs:
+                raise JobHistoryUnavailable('Could not read the job history (sacct): ' + sacct_err.decode('utf-8', 'replace').strip());
+
+            self.jobs = jobs;
+            self.fetched = monotonic();
+            self.fetches += 1;
+            return self.jobs;
+
+    def stats (self):
+
+        return {'jobs': len(self.jobs or []), 'fetches': self.fetches, 'hits': self.hits, 'age': monotonic() - self.fetched if self.fetched else None};
@@ -1,5 +1,9 @@
 import os;
+import re;
+import time;
+import shlex;
 import subprocess;
+from hashlib import sha256;
 from pexpect import pxssh;
 from shutil import copyfile;
 
@@ -35,6 +39,86 @@ class SSHAgentNotRunning (Exception):
     pass;
 class RenderTemplateError (Exception):
     pass;
+class TemplateExecutionError (Exception):
+    pass;
+
+class TemplateCache:
+
+    # markers of finished steps on the remote host, named by the hash of the step and all steps before it
+    directory = '$HOME/.slurm_jupyter_kernel/template_cache';
+    # these only change the state of the current shell and run every time
+    shell_state_commands = ['cd', 'source', '.', 'module', 'ml', 'export', 'unset', 'set', 'alias', 'umask', 'pushd', 'popd', 'deactivate', 'conda activate', 'conda deactivate'];
+    # words of a line which may name a file or directory the step creates, e.g. $HOME/venv or ~/.julia
+    path_pattern = re.compile(r'[\w$~{}.+-]*/[\w$~{}./+-]*');
+
+    def __init__ (self, execute_lines, kernel_specs, force=False):
+
+        self.force = force;
+        self.keys = [];
+        self.paths = [];
+        chain = sha256();
+        for line in execute_lines:
+            chain.update(line.encode('utf-8') + b'\n');
+            if any(line == command or line.startswith(command + ' ') for command in self.shell_state_commands):
+                self.keys.append(None);
+            else:
+                self.keys.append(chain.hexdigest());
+            self.paths.append(list(dict.fromkeys(self.path_pattern.findall(line))));
+        # the complete environment also depends on the kernel it is used for
+        for spec in sorted(kernel_specs.keys()):
+            chain.update(f'{spec}={kernel_specs[spec]}\n'.encode('utf-8'));
+        self.complete_key = chain.hexdigest();
+
+        # a cached environment is only used if the kernel executable is still there
+        argv = kernel_specs.get('ARGV', '').split();
+        self.executable = argv[0] if argv else None;
+
+    def marker (self, step):
+
+        key = self.keys[step];
+        return f'{self.directory}/{key}' if key else None;
+
+    def prepare (self, on_cached):
+
+        complete_marker = f'{self.directory}/{self.complete_key}';
+        if self.force:
+            return f'mkdir -p {self.directory} && rm -f {complete_marker}';
+        # a step only counts while every path it created is still there, and only if no step before it had to run again
+        # (e.g. pip install into a venv which is gone)
+        check = 'cache_valid=1; cache_check () { [ $cache_valid -eq 1 ] && [ -f "$1" ] && while IFS= read -r cache_path; do [ -e "$cache_path" ] || return 1; done < "$1"; }';
+        # a complete environment without its kernel executable is installed again from the first step,
+        # one with a step whose result is gone from that step on
+        verify = f'command -v {self.executable} > /dev/null' if self.executable else 'true';
+        steps = ''.join([f' && cache_check {self.directory}/{key}' for key in self.keys if key]);
+        stale_markers = ' '.join([f'{self.directory}/{key}' for key in self.keys if key] + [complete_marker]);
+        return f'mkdir -p {self.directory}; {check}; if [ -f {complete_marker} ]; then if ! {verify}; then rm -f {stale_markers}; elif true{steps}; then {on_cached}; else rm -f {complete_marker}; fi; fi';
+
+    def record (self, step):
+
+        # the marker lists the paths of the line which exist after the step ran
+        marker = self.marker(step);
+        if not self.paths[step]:
+            return f': > {marker}';
+        return f'{{ for cache_path in {" ".join(self.paths[step])}; do [ -e "$cache_path" ] && printf \'%s\\n\' "$cache_path"; done > {marker}; true; }}';
+
+    def skip (self, step):
+
+        # condition to skip a step - a step which runs again invalidates all steps after it
+        return f'cache_check {self.marker(step)} || ! cache_valid=0';
+
+    def wrap (self, step, line, on_cached, on_failure):
+
+        marker = self.marker(step);
+        if not marker:
+            return f'{{ {line} ; }} || {on_failure}';
+        command = f'{{ {line} ; }} && {self.record(step)} || {on_failure}';
+        if self.force:
+            return command;
+        return f'if {self.skip(step)}; then {on_cached}; else {command}; fi';
+
+    def complete (self):
+
+        return f'touch {self.directory}/{self.complete_key}';
 
 class ScriptTemplate:
 
@@ -76,7 +160,100 @@ class ScriptTemplate:
             return script_to_install;
 
 
-    def use (self, loginnode=None, user=None, proxyjump=None, dry_run=False):
+    @staticmethod
+    def render_batch (execute_lines, marker, cache=None):
+
+        # one script for all lines: every step reports its start and exit code, the first failing step ends the script
+        batch_script = ['exec 2>&1 < /dev/null'];
+        if cache:
+            batch_script.append(cache.prepare(f"printf '%s\\n' '{marker} cached'; exit 0"));
+        for step, line in enumerate(execute_lines, start=1):
+            step_script = [f"printf '%s\\n' '{marker} start {step}'", line, f"step_status=$?; printf '%s\\n' \"{marker} end {step} $step_status\"; [ $step_status -eq 0 ] || exit $step_status"];
+            step_marker = cache.marker(step - 1) if cache else None;
+            if not step_marker:
+                batch_script += step_script;
+                continue;
+            step_script.append(cache.record(step - 1));
+            if cache.force:
+                batch_script += step_script;
+            else:
+                batch_script.append(f"if {cache.skip(step - 1)}; then printf '%s\\n' '{marker} skip {step}'; else");
+                batch_script += step_script;
+                batch_script.append('fi');
+        if cache:
+            batch_script.append(cache.complete());
+        return '\n'.join(batch_script) + '\n';
+
+    @staticmethod
+    def run_batch (loginnode, user, proxyjump, execute_lines, cache=None):
+
+        marker = '@@slurmkernel-' + os.urandom(8).hex();
+        batch_script = ScriptTemplate.render_batch(execute_lines, marker, cache);
+
+        # upload and run the script over a single connection; it runs in a login shell like the interactive mode
+        remote_command = 'batch_script=$(mktemp) && cat > $batch_script && bash --login $batch_script; batch_status=$?; rm -f $batch_script; exit $batch_status';
+        ssh_command = ['ssh', '-T', '-l', user];
+        if proxyjump:
+            ssh_command += ['-J', proxyjump];
+        ssh_command += [loginnode, remote_command];
+
+        print(f'Executing {len(execute_lines)} lines on {loginnode} using command: {Color.F_Default}{" ".join(shlex.quote(argument) for argument in ssh_command[:-1])}\n');
+        batch_started = time.monotonic();
+        batch_process = subprocess.Popen(ssh_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1);
+        batch_process.stdin.write(batch_script);
+        batch_process.stdin.close();
+
+        step = None;
+        step_started = None;
+        failed_step = None;
+        timings = [];
+        skipped = 0;
+        cached = False;
+        for output_line in batch_process.stdout:
+            output_line = output_line.rstrip('\n');
+            if output_line.startswith(marker):
+                fields = output_line.split()[1:];
+                if fields[0] == 'cached':
+                    cached = True;
+                    print(f'{Color.F_LightGreen}\u2713 environment already installed and verified, nothing to do (use --force to install again){Color.F_Default}');
+                elif fields[0] == 'skip':
+                    skipped += 1;
+                    print(f'[{fields[1]}/{len(execute_lines)}] {Color.F_Blue}{execute_lines[int(fields[1]) - 1]}{Color.F_Default} {Color.F_DarkGray}(cached, skipped){Color.F_Default}');
+                elif fields[0] == 'start':
+                    step = int(fields[1]);
+                    step_started = time.monotonic();
+                    print(f'[{step}/{len(execute_lines)}] {Color.F_Blue}{execute_lines[step - 1]}{Color.F_Default}');
+                elif fields[0] == 'end':
+                    step_duration = time.monotonic() - step_started;
+                    timings.append((step, step_duration));
+                    if fields[2] == '0':
+                        print(f'{Color.F_LightGreen}\u2713 step {step} finished in {step_duration:.2f}s{Color.F_Default}');
+                    else:
+                        failed_step = (step, fields[2]);
+                        print(f'{Color.F_LightRed}\u2717 step {step} failed with exit code {fields[2]} after {step_duration:.2f}s{Color.F_Default}');
+                continue;
+            print(f'    {output_line}');
+
+        ssh_errors = batch_process.stderr.read();
+        returncode = batch_process.wait();
+        batch_duration = time.monotonic() - batch_started;
+
+        if cached and returncode == 0:
+            return timings;
+
+        print(f'\nStep timings (total {batch_duration:.2f}s, {len(timings)}/{len(execute_lines)} steps, {skipped} cached):');
+        for step, step_duration in timings:
+            print(f'  [{step}] {step_duration:7.2f}s  {execute_lines[step - 1]}');
+        print('');
+
+        if failed_step:
+            raise TemplateExecutionError(f'Error: Step {failed_step[0]} ({execute_lines[failed_step[0] - 1]}) failed with exit code {failed_step[1]}');
+        if not returncode == 0 or len(timings) + skipped < len(execute_lines):
+            # ssh itself failed or the script was cut off
+            raise SSHConnectionError(f'Error: Could not execute the template on host {loginnode}: {ssh_errors.strip()}');
+        return timings;
+
+    def use (self, loginnode=None, user=None, proxyjump=None, dry_run=False, batch=False, force=False):
 
         ssh_options = {};
         kernel_specs = ['LANGUAGE', 'DISPLAYNAME', 'ARGV', 'ENV'];
@@ -120,8 +297,9 @@ class ScriptTemplate:
             ssh_cmd_str = ssh_cmd_str + ' ' + user;
             print(Color.F_Default);
 
-        # startup ssh connection
-        while True:
+        # startup ssh connection - the batch mode connects once when executing
+        ssh_session = None;
+        while not batch:
             try:
                 print(f'\nTry to establish a ssh connection using command: {Color.F_Default}{ssh_cmd_str}\n');
                 ssh_session = pxssh.pxssh(options=ssh_options);
@@ -186,8 +364,15 @@ class ScriptTemplate:
             except IndexError:
                 print(f'Warning: Skipping line "{inputvar}" due to parsing error!');
 
+        # REPLACE '$' vars in kernel specs
+        for type_spec, value in set_kernel_specs.items():
+            for replace_item, replace_value in var_values.items():
+                if '$'+str(replace_item) in value:
+                    set_kernel_specs[str(type_spec)] = set_kernel_specs[str(type_spec)].replace('$'+str(replace_item), replace_value);
+
         print('\033[0m');
         # EXECUTE ALL LINES SPECIFIED IN execute_lines
+        rendered_lines = [];
         for line in execute_lines:
             for replace_item, replace_value in var_values.items():
                 if '$'+str(replace_item) in line:
@@ -196,17 +381,27 @@ class ScriptTemplate:
             if dry_run == True:
                 print(f"[DRY RUN/EXECUTE TEMPLATE] Would execute: {line}");
             else:
-                print(f'Executing following line: {Color.F_Blue}' + str(line) + f'{Color.F_Default}');
-                ssh_session.sendline(str(line));
+                rendered_lines.append(line);
+
+        # steps which already ran with the same inputs are skipped
+        cache = TemplateCache(rendered_lines, set_kernel_specs, force=force);
+        if rendered_lines and batch:
+            self.run_batch(loginnode, user, proxy, rendered_lines, cache);
+        elif rendered_lines:
+            ssh_session.sendline('template_failed=0; ' + cache.prepare("printf '%s-%s\\n' 'slurmkernel' 'cached'"));
+            ssh_session.prompt();
+            if b'slurmkernel-cached' in ssh_session.before:
+                print(f'{Color.F_LightGreen}\u2713 environment already installed and verified, nothing to do (use --force to install again){Color.F_Default}');
+            else:
+                for step, line in enumerate(rendered_lines):
+                    print(f'Executing following line: {Color.F_Blue}' + str(line) + f'{Color.F_Default}');
+                    ssh_session.sendline(cache.wrap(step, line, "printf '%s\\n' 'skipped: already done (cached)'", 'template_failed=1'));
+                    ssh_session.prompt();
+                ssh_session.sendline('[ $template_failed -eq 0 ] && ' + cache.complete());
                 ssh_session.prompt();
 
-        # REPLACE '$' vars in kernel specs
-        for type_spec, value in set_kernel_specs.items():
-            for replace_item, replace_value in var_values.items():
-                if '$'+str(replace_item) in value:
-                    set_kernel_specs[str(type_spec)] = set_kernel_specs[str(type_spec)].replace('$'+str(replace_item), replace_value);
-
-        ssh_session.logout();
+        if ssh_session:
+            ssh_session.logout();
 
         if len(input_variables) < 1 or len(set_kernel_specs) < 1:
             raise RenderTemplateError();
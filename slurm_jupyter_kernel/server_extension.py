@@ -0,0 +1,39 @@
+import json;
+import math;
+from tornado import web;
+from jupyter_server.base.handlers import APIHandler;
+from jupyter_server.auth.decorator import authorized;
+from jupyter_server.utils import url_path_join;
+
+# GET <base_url>/api/slurm_jupyter_kernel/kernels/<kernel id>/telemetry[?lease=<seconds>]
+telemetry_route = r'api/slurm_jupyter_kernel/kernels/([\w-]+)/telemetry';
+
+class TelemetryHandler (APIHandler):
+
+    # same permission as reading the kernel itself
+    auth_resource = 'kernels';
+
+    @web.authenticated
+    @authorized
+    async def get (self, kernel_id):
+
+        if not kernel_id in self.kernel_manager:
+            raise web.HTTPError(404, f'No such kernel {kernel_id}');
+        provisioner = getattr(self.kernel_manager.get_kernel(kernel_id), 'provisioner', None);
+        if not hasattr(provisioner, 'telemetry'):
+            raise web.HTTPError(404, f'Kernel {kernel_id} does not run in a Slurm job');
+        # seconds to keep sampling, at most telemetry_lease of the kernelspec
+        lease = self.get_query_argument('lease', None);
+        try:
+            lease = float(lease) if lease is not None else None;
+        except ValueError:
+            raise web.HTTPError(400, f'Invalid lease {lease}');
+        if lease is not None and not (math.isfinite(lease) and lease >= 0):
+            raise web.HTTPError(400, f'Invalid lease {lease}');
+        self.finish(json.dumps(provisioner.telemetry(lease)));
+
+def _load_jupyter_server_extension (serverapp):
+
+    route = url_path_join(serverapp.web_app.settings['base_url'], telemetry_route);
+    serverapp.web_app.add_handlers('.*$', [(route, TelemetryHandler)]);
+    serverapp.log.info(f'slurm_jupyter_kernel: job telemetry at {route}');
@@ -0,0 +1,191 @@
+import re;
+import asyncio;
+import threading;
+from subprocess import TimeoutExpired;
+from slurm_jupyter_kernel.job_status import SlurmStatusUnavailable;
+
+class SharedAllocationError (Exception):
+    pass;
+
+# sbatch flags which describe the resources of one kernel (one job step)
+kernel_resource_flags = ['cpus-per-task', 'mem', 'mem-per-cpu', 'gres', 'gpus', 'ntasks', 'ntasks-per-node'];
+
+def scale_resource (value, factor):
+
+    # 4G -> 16G, gpu:a100:1 -> gpu:a100:4
+    match = re.match(r'^(.*?)(\d+)([a-zA-Z]*)$', str(value));
+    if not match:
+        return value;
+    return f'{match.group(1)}{int(match.group(2)) * factor}{match.group(3)}';
+
+def split_sbatch_flags (sbatch_flags, size):
+
+    # the allocation gets room for `size` kernels, every job step gets the resources of one kernel
+    allocation_flags = {};
+    step_flags = {};
+    for parameter, value in sbatch_flags.items():
+        if not parameter in kernel_resource_flags:
+            allocation_flags[parameter] = value;
+        elif parameter in ['ntasks', 'ntasks-per-node']:
+            continue;
+        elif parameter in ['mem', 'gres', 'gpus']:
+            allocation_flags[parameter] = scale_resource(value, size);
+            step_flags[parameter] = value;
+        else:
+            allocation_flags[parameter] = value;
+            step_flags[parameter] = value;
+    allocation_flags['ntasks'] = size;
+    # mem is per node: tasks spread over several nodes would reserve size * mem on each of them
+    allocation_flags.setdefault('nodes', 1);
+    return allocation_flags, step_flags;
+
+class SharedAllocation:
+
+    # allocations per key (connection, resources), kernels of this Jupyter server share them
+    _allocations = {};
+    _allocations_lock = threading.Lock();
+    _locks = {};
+
+    def __init__ (self, key, connection, status_service, batch_job, job_directory, size=4, timeout=10.0, log=None):
+
+        self.key = key;
+        self.connection = connection;
+        self.status_service = status_service;
+        self.batch_job = batch_job;
+        self.job_directory = job_directory;
+        self.size = size;
+        self.timeout = timeout;
+        self.log = log;
+
+        self.job_id = None;
+        # kernel ids currently using the allocation - the last one releases it
+        self.kernels = set();
+        self.attached = 0;
+
+    @classmethod
+    def _lock (cls, key):
+
+        with cls._allocations_lock:
+            if not key in cls._locks:
+                cls._locks[key] = asyncio.Lock();
+            return cls._locks[key];
+
+    @classmethod
+    async def attach (cls, key, kernel_id, kernel_job, connection, status_service, batch_job, job_directory, size=4, timeout=10.0, log=None):
+
+        async with cls._lock(key):
+            for allocation in list(cls._allocations.get(key, [])):
+                if len(allocation.kernels) >= allocation.size:
+                    continue;
+                if not await allocation._alive():
+                    cls._remove(allocation);
+                    continue;
+                if await allocation._hand_over(kernel_id, kernel_job):
+                    return allocation;
+                cls._remove(allocation);
+
+            # no allocation with a free slot left - submit a new one
+            allocation = cls(key, connection, status_service, batch_job, job_directory, size=size, timeout=timeout, log=log);
+            await allocation._submit();
+            with cls._allocations_lock:
+                cls._allocations.setdefault(key, []).append(allocation);
+            if not await allocation._hand_over(kernel_id, kernel_job):
+                job_id = allocation.job_id;
+                cls._remove(allocation);
+                await allocation._cancel();
+                raise SharedAllocationError(f'Could not hand over the kernel to the shared Slurm job {job_id}');
+            return allocation;
+
+    @classmethod
+    def _remove (cls, allocation):
+
+        with cls._allocations_lock:
+            if allocation in cls._allocations.get(allocation.key, []):
+                cls._allocations[allocation.key].remove(allocation);
+
+    async def _alive (self):
+
+        try:
+            return not await self.status_service.get_state(self.job_id) is None;
+        except SlurmStatusUnavailable:
+            # the hand over fails anyway if the allocation is gone
+            return True;
+
+    async def _submit (self):
+
+        sbatch_command = ['/bin/bash', '--login', '-c', '"sbatch --parsable"'];
+        await self.connection.ensure();
+        try:
+            returncode, sbatch_out, sbatch_err = await self.connection.run(sbatch_command, input=self.batch_job.encode(), timeout=self.timeout);
+        except TimeoutExpired:
+            raise SharedAllocationError('Timeout expired when submitting the shared Slurm job');
+
+        job_id = re.search(r"(\d+)", sbatch_out.decode('utf-8'));
+        if not returncode == 0 or not job_id:
+            raise SharedAllocationError('Could not submit the shared Slurm job: ' + sbatch_err.decode('utf-8').strip());
+
+        self.job_id = int(job_id.group(1));
+        self.status_service.register(self.job_id);
+        # the directory exists as long as the allocation accepts kernels
+        try:
+            returncode, _, mkdir_err = await self.connection.run(['/bin/bash', '-c', f'"mkdir -p {self.job_directory}/{self.job_id}/kernels"'], timeout=self.timeout);
+        except TimeoutExpired:
+            returncode, mkdir_err = None, b'timeout expired';
+        if not returncode == 0:
+            # no kernel could ever use the job
+            job_id = self.job_id;
+            await self._cancel();
+            raise SharedAllocationError(f'Could not create the directory of the shared Slurm job {job_id}: ' + mkdir_err.decode('utf-8', 'replace').strip());
+        if self.log:
+            self.log.info(f'Submitted shared Slurm job {self.job_id} for up to {self.size} kernels');
+
+    async def _cancel (self):
+
+        try:
+            await self.connection.run(['/bin/bash', '--login', '-c', f'"scancel {self.job_id}"'], timeout=self.timeout);
+        except Exception as e:
+            if self.log:
+                self.log.warning(f'Could not cancel the shared Slurm job {self.job_id}: {e}');
+        self.status_service.unregister(self.job_id);
+        self.job_id = None;
+
+    async def _hand_over (self, kernel_id, kernel_job):
+
+        # the allocation starts a job step for every kernel.sh which appears in its directory
+        allocation_directory = f'{self.job_directory}/{self.job_id}';
+        kernel_directory = f'{allocation_directory}/kernels/{kernel_id}';
+        hand_over_command = ['/bin/bash', '-c', f'"[ -d {allocation_directory}/kernels ] && [ ! -f {allocation_directory}/release ] && mkdir -p {kernel_directory} && cat > {kernel_directory}/kernel.sh.tmp && mv {kernel_directory}/kernel.sh.tmp {kernel_directory}/kernel.sh"'];
+        try:
+            returncode, _, _ = await self.connection.run(hand_over_command, input=kernel_job.encode(), timeout=self.timeout);
+        except TimeoutExpired:
+            returncode = 1;
+        if not returncode == 0:
+            return False;
+
+        self.kernels.add(kernel_id);
+        self.attached += 1;
+        return True;
+
+    async def detach (self, kernel_id):
+
+        async with self._lock(self.key):
+            self.kernels.discard(kernel_id);
+            if self.kernels:
+                return False;
+
+            # last kernel gone: give the allocation back
+            self._remove(self);
+            try:
+                await self.connection.ensure();
+                await self.connection.run(['/bin/bash', '-c', f'"[ -d {self.job_directory}/{self.job_id} ] && touch {self.job_directory}/{self.job_id}/release"'], timeout=self.timeout);
+            except Exception as e:
+                if self.log:
+                    self.log.warning(f'Could not release the shared Slurm job {self.job_id}: {e}');
+            self.status_service.unregister(self.job_id);
+            if self.log:
+                self.log.info(f'Released shared Slurm job {self.job_id} after {self.attached} kernels');
+            return True;
+
+    def stats (self):
+
+        return {'job_id': self.job_id, 'size': self.size, 'kernels': len(self.kernels), 'attached': self.attached};
@@ -0,0 +1,346 @@
+import os;
+import asyncio;
+import tempfile;
+import threading;
+from time import monotonic;
+from hashlib import sha256;
+from subprocess import DEVNULL, PIPE, TimeoutExpired;
+
+class SSHMasterError (Exception):
+    pass;
+
+async def run_command (command, input=None, timeout=None):
+
+    # run a local command without blocking the event loop; the process is killed on timeout or cancellation
+    process = await asyncio.create_subprocess_exec(*command, stdin=PIPE if input is not None else DEVNULL, stdout=PIPE, stderr=PIPE);
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(input=input), timeout=timeout);
+    except asyncio.TimeoutError:
+        await _kill_process(process);
+        raise TimeoutExpired(command, timeout);
+    except asyncio.CancelledError:
+        await _kill_process(process);
+        raise;
+
+    return process.returncode, stdout, stderr;
+
+async def _kill_process (process):
+
+    if process.returncode is None:
+        try:
+            process.kill();
+        except ProcessLookupError:
+            pass;
+        await process.wait();
+
+class SSHConnection:
+
+    # one master connection per (proxyjump, loginnode, username) inside this process
+    _connections = {};
+    _connections_lock = threading.Lock();
+
+    control_persist = 600;
+    connect_timeout = 10.0;
+    # a successful check is trusted this long - ControlMaster=auto covers a master dying in between
+    check_interval = 5.0;
+
+    def __init__ (self, loginnode, username, proxyjump=None):
+
+        self.loginnode = loginnode;
+        self.username = username;
+        self.proxyjump = proxyjump or '';
+        self.key = (self.proxyjump, self.loginnode, self.username);
+
+        # unix socket paths are limited to ~104 characters - use a short hash as name
+        control_dir = os.path.join(tempfile.gettempdir(), f'sjk-{os.getuid()}');
+        os.makedirs(control_dir, mode=0o700, exist_ok=True);
+        self.control_path = os.path.join(control_dir, sha256(repr(self.key).encode()).hexdigest()[:16]);
+
+        self.established = False;
+        self.connect_time = None;
+        self.checked = None;
+        self.hits = 0;
+        self.misses = 0;
+        self.reconnects = 0;
+        self._lock = asyncio.Lock();
+
+    @classmethod
+    def get (cls, loginnode, username, proxyjump=None):
+
+        key = (proxyjump or '', loginnode, username);
+        with cls._connections_lock:
+            if not key in cls._connections:
+                cls._connections[key] = cls(loginnode, username, proxyjump);
+            return cls._connections[key];
+
+    def control_options (self):
+
+        # ControlMaster=auto lets every command fall back to opening a new master if the old one died
+        return ['-o', 'ControlMaster=auto', '-o', f'ControlPath={self.control_path}', '-o', f'ControlPersist={self.control_persist}'];
+
+    def ssh_command (self, flags=None, multiplexed=True):
+
+        command = ['ssh'] + (flags or []);
+        if multiplexed:
+            command += self.control_options();
+        if self.proxyjump:
+            command += ['-J', self.proxyjump];
+        if self.username:
+            command += ['-l', self.username];
+        command.append(self.loginnode);
+        return command;
+
+    def proxy_command (self, multiplexed=True):
+
+        # used as ProxyCommand to reach hosts behind the loginnode through the master connection
+        return ' '.join(self.ssh_command(['-W', '%h:%p'], multiplexed=multiplexed));
+
+    async def is_alive (self):
+
+        check_command = ['ssh', '-O', 'check', '-o', f'ControlPath={self.control_path}', self.loginnode];
+        returncode, _, _ = await run_command(check_command, timeout=self.connect_timeout);
+        return returncode == 0;
+
+    async def ensure (self):
+
+        async with self._lock:
+            # concurrent callers wait for one check instead of each running their own
+            if self.checked and monotonic() - self.checked < self.check_interval:
+                self.hits += 1;
+                return True;
+            if await self.is_alive():
+                self.checked = monotonic();
+                self.hits += 1;
+                return True;
+
+            self.misses += 1;
+            if self.established:
+                self.reconnects += 1;
+
+            # ssh uses the first value given for an option: ControlMaster=yes overrides the generic auto
+            master_command = self.ssh_command(['-fNA', '-o', 'ControlMaster=yes', '-o', 'ServerAliveInterval=30']);
+            start = monotonic();
+            try:
+                returncode, _, stderr = await run_command(master_command, timeout=self.connect_timeout);
+            except TimeoutExpired:
+                self.established = False;
+                raise SSHMasterError(f'Timeout expired when opening the SSH master connection to {self.loginnode}');
+
+            if not returncode == 0:
+                self.established = False;
+                raise SSHMasterError(f'Could not open the SSH master connection to {self.loginnode}:\n' + stderr.decode('utf-8').strip());
+
+            self.established = True;
+            self.checked = monotonic();
+            self.connect_time = monotonic() - start;
+            return False;
+
+    async def run (self, remote_command, input=None, timeout=None, flags=None):
+
+        # run a command on the loginnode over the master connection - callers ensure() the master first
+        return await run_command(self.ssh_command(flags or ['-TA']) + remote_command, input=input, timeout=timeout);
+
+    async def close (self):
+
+        await run_command(['ssh', '-O', 'exit', '-o', f'ControlPath={self.control_path}', self.loginnode], timeout=self.connect_timeout);
+        self.established = False;
+        self.checked = None;
+
+    def stats (self):
+
+        return {'hits': self.hits, 'misses': self.misses, 'reconnects': self.reconnects, 'connect_time': self.connect_time};
+
+class LoginNodeGroup:
+
+    # login nodes of one cluster which stand in for each other - used like a single SSHConnection
+    _groups = {};
+    _groups_lock = threading.Lock();
+
+    # a failed login node is skipped this long, doubled with every further failure
+    retry_interval = 30.0;
+    max_retry_interval = 600.0;
+    # round trip times are measured again after this many seconds
+    probe_interval = 300.0;
+    # a healthy login node only takes over if it answers at least this much faster
+    switch_ratio = 0.5;
+    # commands timing out in a row until a login node counts as overloaded
+    max_timeouts = 2;
+
+    def __init__ (self, loginnodes, username, proxyjump=None):
+
+        self.loginnodes = list(loginnodes);
+        self.username = username;
+        self.proxyjump = proxyjump or '';
+        self.key = (self.proxyjump, tuple(self.loginnodes), self.username);
+        self.connections = {loginnode: SSHConnection.get(loginnode, username, proxyjump) for loginnode in self.loginnodes};
+
+        # smoothed round trip time of a command over the master connection, per login node
+        self.rtt = {};
+        self.failures = {loginnode: 0 for loginnode in self.loginnodes};
+        self.timeouts = {loginnode: 0 for loginnode in self.loginnodes};
+        self.down_until = {loginnode: 0.0 for loginnode in self.loginnodes};
+
+        self.current = None;
+        self.probed = None;
+        self.probes = set();
+        self.failovers = 0;
+        self.switches = 0;
+        self._lock = asyncio.Lock();
+
+    @classmethod
+    def get (cls, loginnodes, username, proxyjump=None):
+
+        key = (proxyjump or '', tuple(loginnodes), username);
+        with cls._groups_lock:
+            if not key in cls._groups:
+                cls._groups[key] = cls(loginnodes, username, proxyjump);
+            return cls._groups[key];
+
+    @property
+    def loginnode (self):
+
+        return self.current or self.loginnodes[0];
+
+    @property
+    def connection (self):
+
+        return self.connections[self.loginnode];
+
+    @property
+    def connect_time (self):
+
+        return self.connection.connect_time;
+
+    def ssh_command (self, flags=None, multiplexed=True):
+
+        return self.connection.ssh_command(flags, multiplexed=multiplexed);
+
+    def proxy_command (self, multiplexed=True):
+
+        # tunnels opened after a failover jump through the new login node
+        return self.connection.proxy_command(multiplexed=multiplexed);
+
+    def _healthy (self, loginnode):
+
+        return monotonic() >= self.down_until[loginnode];
+
+    def report_failure (self, loginnode):
+
+        self.failures[loginnode] += 1;
+        self.timeouts[loginnode] = 0;
+        self.down_until[loginnode] = monotonic() + min(self.retry_interval * 2 ** (self.failures[loginnode] - 1), self.max_retry_interval);
+        self.connections[loginnode].checked = None;
+
+    async def _probe (self, loginnode):
+
+        connection = self.connections[loginnode];
+        try:
+            await connection.ensure();
+            start = monotonic();
+            returncode, _, _ = await connection.run(['true'], timeout=connection.connect_timeout);
+        except (SSHMasterError, TimeoutExpired):
+            returncode = 255;
+        if not returncode == 0:
+            self.report_failure(loginnode);
+            return None;
+
+        rtt = monotonic() - start;
+        self.rtt[loginnode] = rtt if not loginnode in self.rtt else 0.7 * self.rtt[loginnode] + 0.3 * rtt;
+        self.failures[loginnode] = 0;
+        self.timeouts[loginnode] = 0;
+        self.down_until[loginnode] = 0.0;
+        return rtt;
+
+    def _background (self, coroutine):
+
+        # probes outlive the call which started them - keep a reference until they are done
+        task = asyncio.ensure_future(coroutine);
+        self.probes.add(task);
+        task.add_done_callback(self.probes.discard);
+        return task;
+
+    async def _select (self):
+
+        # all login nodes are tried again if none of them is healthy
+        candidates = [loginnode for loginnode in self.loginnodes if self._healthy(loginnode)] or sorted(self.loginnodes, key=lambda loginnode: self.down_until[loginnode]);
+        self.probed = monotonic();
+
+        if all(loginnode in self.rtt for loginnode in candidates):
+            # round trip times are known: try the fastest first
+            for loginnode in sorted(candidates, key=lambda loginnode: self.rtt[loginnode]):
+                if await self._probe(loginnode) is not None:
+                    return loginnode;
+        else:
+            # first login node to answer wins, the others finish in the background and record their round trip time
+            pending = {self._background(self._probe(loginnode)): loginnode for loginnode in candidates};
+            waiting = set(pending.keys());
+            while waiting:
+                done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED);
+                for task in done:
+                    if task.result() is not None:
+                        return pending[task];
+
+        raise SSHMasterError('Could not open an SSH master connection to any of the login nodes ' + ', '.join(self.loginnodes));
+
+    async def _reprobe (self):
+
+        await asyncio.gather(*[self._probe(loginnode) for loginnode in self.loginnodes if self._healthy(loginnode)]);
+        healthy = [loginnode for loginnode in self.loginnodes if self._healthy(loginnode) and loginnode in self.rtt];
+        if not healthy or not self.current in self.rtt:
+            return;
+        fastest = min(healthy, key=lambda loginnode: self.rtt[loginnode]);
+        if not fastest == self.current and self.rtt[fastest] < self.switch_ratio * self.rtt[self.current]:
+            self.current = fastest;
+            self.switches += 1;
+
+    async def ensure (self):
+
+        async with self._lock:
+            if self.current and self._healthy(self.current):
+                try:
+                    reused = await self.connections[self.current].ensure();
+                    if monotonic() - self.probed > self.probe_interval and not self.probes:
+                        self.probed = monotonic();
+                        self._background(self._reprobe());
+                    return reused;
+                except SSHMasterError:
+                    self.report_failure(self.current);
+
+            previous = self.current;
+            self.current = await self._select();
+            if previous and not previous == self.current:
+                self.failovers += 1;
+            return False;
+
+    async def run (self, remote_command, input=None, timeout=None, flags=None):
+
+        # failures only mark the login node, the next ensure() fails over - commands are never sent twice
+        loginnode = self.loginnode;
+        try:
+            result = await self.connections[loginnode].run(remote_command, input=input, timeout=timeout, flags=flags);
+        except TimeoutExpired:
+            self.timeouts[loginnode] += 1;
+            if self.timeouts[loginnode] >= self.max_timeouts:
+                self.report_failure(loginnode);
+            raise;
+
+        self.timeouts[loginnode] = 0;
+        if result[0] == 255:
+            # ssh itself failed: check the master connection again
+            self.connections[loginnode].checked = None;
+        return result;
+
+    async def close (self):
+
+        for task in list(self.probes):
+            task.cancel();
+        for connection in self.connections.values():
+            await connection.close();
+        self.current = None;
+
+    def stats (self):
+
+        stats = self.connection.stats();
+        stats.update({'loginnode': self.loginnode, 'rtt': {loginnode: round(rtt * 1000, 1) for loginnode, rtt in self.rtt.items()},
+                      'down': [loginnode for loginnode in self.loginnodes if not self._healthy(loginnode)], 'failovers': self.failovers, 'switches': self.switches});
+        return stats;
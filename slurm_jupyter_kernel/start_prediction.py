@@ -0,0 +1,120 @@
+import re;
+import shlex;
+import asyncio;
+import threading;
+from time import monotonic;
+from subprocess import TimeoutExpired;
+from slurm_jupyter_kernel.poll_scheduler import PollScheduler;
+
+def shape_key (sbatch_flags):
+
+    return tuple(sorted((str(parameter), str(value)) for parameter, value in sbatch_flags.items()));
+
+def describe_shape (sbatch_flags, base_flags=None):
+
+    # only what differs from the base flags, e.g. partition=gpu cpus-per-task=8
+    base_flags = base_flags or {};
+    changed = [f'{parameter}={value}' for parameter, value in sbatch_flags.items() if not str(base_flags.get(parameter)) == str(value)];
+    return ' '.join(changed) or 'sbatch_flags';
+
+def test_only_script (shapes, job_name='jupyter_slurm_kernel'):
+
+    # every shape is tested by its own sbatch --test-only in the background - one login shell for all of them
+    script = '';
+    for index, sbatch_flags in enumerate(shapes):
+        flags = ' '.join(shlex.quote(f'--{parameter}={value}') for parameter, value in sbatch_flags.items());
+        script += f'(sbatch --test-only -J {job_name} {flags} --wrap=true < /dev/null 2>&1 | sed "s/^/{index}:/") &\n';
+    return script + 'wait\n';
+
+async def predict_starts (connection, shapes, timeout=10.0):
+
+    # sbatch --test-only asks the scheduler when a job of these resources would start, nothing is submitted
+    # returns (start time or None, scheduler message) per shape
+    if not shapes:
+        return [];
+    try:
+        returncode, test_out, _ = await connection.run(['/bin/bash', '--login', '-s'], input=test_only_script(shapes).encode(), timeout=timeout);
+    except TimeoutExpired:
+        return [(None, 'timeout expired')] * len(shapes);
+
+    messages = [[] for _ in shapes];
+    for line in test_out.decode('utf-8', 'replace').splitlines():
+        index, _, message = line.partition(':');
+        if index.isdigit() and int(index) < len(shapes):
+            messages[int(index)].append(message.strip());
+
+    predictions = [];
+    for message in messages:
+        message = ' '.join(message);
+        start = re.search(r'to start at (\S+)', message);
+        predictions.append((PollScheduler.parse_start_time(start.group(1)) if start else None, message or f'no answer (exit code {returncode})'));
+    return predictions;
+
+async def predict_start (connection, sbatch_flags, timeout=10.0):
+
+    start, _ = (await predict_starts(connection, [sbatch_flags], timeout=timeout))[0];
+    return start;
+
+class StartPredictionCache:
+
+    # one cache per SSH connection (proxyjump, loginnode, username) inside this process
+    _caches = {};
+    _caches_lock = threading.Lock();
+
+    def __init__ (self, connection, ttl=30.0, timeout=10.0):
+
+        self.connection = connection;
+        self.ttl = ttl;
+        self.timeout = timeout;
+        # shape key -> (prediction time, start time, scheduler message)
+        self.predictions = {};
+        self._lock = asyncio.Lock();
+
+        self.probes = 0;
+        self.probed_shapes = 0;
+        self.hits = 0;
+
+    @classmethod
+    def get (cls, connection, ttl=30.0, timeout=10.0):
+
+        with cls._caches_lock:
+            if not connection.key in cls._caches:
+                cls._caches[connection.key] = cls(connection, ttl, timeout);
+            cache = cls._caches[connection.key];
+            # the newest kernelspec wins
+            cache.ttl = ttl;
+            cache.timeout = timeout;
+            return cache;
+
+    async def predict (self, shapes):
+
+        # start times of all shapes - recent predictions are reused, the others are probed with one remote command
+        async with self._lock:
+            now = monotonic();
+            self.predictions = {key: cached for key, cached in self.predictions.items() if now - cached[0] < self.ttl};
+            results = {};
+            missing = {};
+            for sbatch_flags in shapes:
+                key = shape_key(sbatch_flags);
+                if key in self.predictions:
+                    self.hits += 1;
+                    results[key] = self.predictions[key][1:];
+                else:
+                    missing[key] = sbatch_flags;
+
+            if missing:
+                self.probes += 1;
+                self.probed_shapes += len(missing);
+                predictions = await predict_starts(self.connection, list(missing.values()), timeout=self.timeout);
+                probed = monotonic();
+                for key, (start, message) in zip(missing.keys(), predictions):
+                    results[key] = (start, message);
+                    # failed probes are not cached, the next launch asks again
+                    if start is not None:
+                        self.predictions[key] = (probed, start, message);
+
+            return [results[shape_key(sbatch_flags)] for sbatch_flags in shapes];
+
+    def stats (self):
+
+        return {'shapes': len(self.predictions), 'probes': self.probes, 'probed_shapes': self.probed_shapes, 'hits': self.hits};
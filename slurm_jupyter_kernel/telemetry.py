@@ -0,0 +1,152 @@
+import time;
+import asyncio;
+import threading;
+from time import monotonic;
+from collections import deque;
+from subprocess import TimeoutExpired;
+from slurm_jupyter_kernel.rightsizing import parse_time, parse_memory;
+
+# CPU time, memory and bytes read of all tasks of a step, and the bytes written
+sstat_fields = ['JobID', 'TRESUsageInTot', 'TRESUsageOutTot'];
+
+def parse_tres (value):
+
+    # cpu=00:01:02,energy=0,fs/disk=123456,mem=1.50G,pages=0,vmem=2G
+    return dict(item.split('=', 1) for item in value.split(',') if '=' in item);
+
+def parse_bytes (value):
+
+    # TRES values without unit are bytes
+    value = str(value).strip();
+    if value.isdigit():
+        return int(value);
+    return parse_memory(value) or 0;
+
+def parse_sstat (output):
+
+    # job id -> summed usage of all of its running steps (batch, extern, srun steps)
+    usage = {};
+    for line in output.splitlines():
+        fields = line.strip().split('|');
+        if not len(fields) == len(sstat_fields):
+            continue;
+        job_id = fields[0].split('.')[0];
+        usage_in, usage_out = parse_tres(fields[1]), parse_tres(fields[2]);
+        job = usage.setdefault(job_id, {'cpu_time': 0.0, 'mem': 0, 'read': 0, 'write': 0});
+        job['cpu_time'] += parse_time(usage_in.get('cpu', '')) or 0.0;
+        job['mem'] += parse_bytes(usage_in.get('mem', 0));
+        job['read'] += parse_bytes(usage_in.get('fs/disk', 0));
+        job['write'] += parse_bytes(usage_out.get('fs/disk', 0));
+    return usage;
+
+class JobTelemetry:
+
+    # one sampler per SSH connection (proxyjump, loginnode, username) inside this process - all watched jobs share one sstat
+    _services = {};
+    _services_lock = threading.Lock();
+
+    def __init__ (self, connection, interval=10.0, history=360, timeout=10.0, log=None):
+
+        self.connection = connection;
+        self.interval = interval;
+        self.history = history;
+        self.timeout = timeout;
+        self.log = log;
+
+        # job id -> lease end: only jobs somebody looks at are sampled
+        self.leases = {};
+        # job id -> the last <history> samples, and the counters of the previous sample for rates
+        self.samples = {};
+        self._previous = {};
+        self._task = None;
+
+        self.queries = 0;
+        self.failures = 0;
+        self.last_latency = None;
+
+    @classmethod
+    def get (cls, connection, interval=10.0, history=360, timeout=10.0, log=None):
+
+        with cls._services_lock:
+            if not connection.key in cls._services:
+                cls._services[connection.key] = cls(connection, interval, history, timeout, log);
+            service = cls._services[connection.key];
+            # the fastest interval asked for wins, e.g. a kernelspec for benchmarking
+            service.interval = min(service.interval, interval);
+            service.timeout = timeout;
+            if not service.history == history:
+                service.history = max(service.history, history);
+                service.samples = {job_id: deque(samples, maxlen=service.history) for job_id, samples in service.samples.items()};
+            return service;
+
+    def watch (self, job_id, lease=60.0):
+
+        # sample the job for the next <lease> seconds - without a reader the sampler stops on its own
+        job_id = str(job_id);
+        self.leases[job_id] = max(self.leases.get(job_id, 0.0), monotonic() + lease);
+        self.samples.setdefault(job_id, deque(maxlen=self.history));
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._sample_loop());
+
+    def forget (self, job_id):
+
+        job_id = str(job_id);
+        self.leases.pop(job_id, None);
+        self.samples.pop(job_id, None);
+        self._previous.pop(job_id, None);
+
+    def get_samples (self, job_id):
+
+        return list(self.samples.get(str(job_id), []));
+
+    async def _sample_loop (self):
+
+        while True:
+            now = monotonic();
+            self.leases = {job_id: lease for job_id, lease in self.leases.items() if lease > now};
+            if not self.leases:
+                return;
+            try:
+                await self.sample(list(self.leases.keys()));
+            except Exception as e:
+                self.failures += 1;
+                if self.log:
+                    self.log.debug(f'Job telemetry sample failed: {e}');
+            await asyncio.sleep(self.interval);
+
+    async def sample (self, job_ids):
+
+        fields = ','.join(sstat_fields);
+        sstat_command = ['/bin/bash', '--login', '-c', f'"sstat -n -P -a -j {",".join(job_ids)} -o {fields} 2> /dev/null"'];
+        await self.connection.ensure();
+        start = monotonic();
+        try:
+            _, sstat_out, _ = await self.connection.run(sstat_command, timeout=self.timeout);
+        except TimeoutExpired:
+            self.failures += 1;
+            return;
+        self.queries += 1;
+        self.last_latency = monotonic() - start;
+
+        usage = parse_sstat(sstat_out.decode('utf-8', 'replace'));
+        sampled = monotonic();
+        for job_id in job_ids:
+            if not job_id in usage or not job_id in self.samples:
+                # pending, ended or forgotten meanwhile
+                continue;
+            current = usage[job_id];
+            sample = {'time': time.time(), 'cpu_time': current['cpu_time'], 'mem': current['mem'], 'read': current['read'], 'write': current['write'],
+                      'cpu_load': None, 'read_rate': None, 'write_rate': None};
+            previous = self._previous.get(job_id);
+            if previous and sampled > previous[0]:
+                elapsed = sampled - previous[0];
+                # busy cores, bytes per second
+                sample['cpu_load'] = round(max(0.0, current['cpu_time'] - previous[1]['cpu_time']) / elapsed, 2);
+                sample['read_rate'] = int(max(0, current['read'] - previous[1]['read']) / elapsed);
+                sample['write_rate'] = int(max(0, current['write'] - previous[1]['write']) / elapsed);
+            self._previous[job_id] = (sampled, current);
+            self.samples[job_id].append(sample);
+
+    def stats (self):
+
+        return {'watched': len(self.leases), 'jobs': len(self.samples), 'interval': self.interval, 'queries': self.queries, 'failures': self.failures, 'last_latency': self.last_latency};
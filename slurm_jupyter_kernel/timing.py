@@ -0,0 +1,147 @@
+import os;
+import math;
+import json;
+import time;
+import atexit;
+import asyncio;
+import threading;
+from time import monotonic;
+from contextlib import contextmanager;
+from jupyter_core.paths import jupyter_data_dir;
+
+def default_timing_file ():
+
+    return os.path.join(jupyter_data_dir(), 'slurm_jupyter_kernel', 'timings.jsonl');
+
+class LaunchTimer:
+
+    # all kernels of one Jupyter server append to the same file
+    _write_lock = threading.Lock();
+    # spans wait here (per file) and are appended by a worker thread, the event loop never waits for the disk
+    _buffers = {};
+    _buffer_lock = threading.Lock();
+    _flush_loop = None;
+    # seconds spans are collected before they are written
+    flush_delay = 1.0;
+
+    # the file is rotated once (timings.jsonl.1) when it grows beyond this size
+    max_file_size = 10 * 1024 * 1024;
+
+    def __init__ (self, path=None, enabled=True, **tags):
+
+        self.path = path or default_timing_file();
+        self.enabled = enabled;
+        self.tags = tags;
+        self.marks = {};
+
+    def tag (self, **tags):
+
+        self.tags.update(tags);
+
+    def mark (self, name):
+
+        # start of a phase which ends in another method (e.g. queue wait)
+        self.marks[name] = monotonic();
+
+    def since (self, name, phase, **tags):
+
+        # record the time since a mark once, later calls are ignored
+        start = self.marks.pop(name, None);
+        if start is not None:
+            self.record(phase, monotonic() - start, **tags);
+
+    @contextmanager
+    def span (self, phase, **tags):
+
+        start = monotonic();
+        try:
+            yield;
+        except BaseException as e:
+            tags['error'] = type(e).__name__;
+            raise;
+        finally:
+            self.record(phase, monotonic() - start, **tags);
+
+    def record (self, phase, duration, **tags):
+
+        if not self.enabled:
+            return;
+        span = {'time': round(time.time(), 3), 'phase': phase, 'duration': round(duration, 4)};
+        span.update(self.tags);
+        span.update(tags);
+        try:
+            loop = asyncio.get_running_loop();
+        except RuntimeError:
+            loop = None;
+        with self._buffer_lock:
+            self._buffers.setdefault(self.path, []).append(json.dumps(span) + '\n');
+            if loop is not None and LaunchTimer._flush_loop is loop:
+                # a flush is scheduled already
+                return;
+            LaunchTimer._flush_loop = loop;
+        if loop is None:
+            # no event loop to block (e.g. the command line)
+            LaunchTimer.flush();
+        else:
+            loop.call_later(self.flush_delay, lambda: loop.run_in_executor(None, LaunchTimer.flush));
+
+    @classmethod
+    def flush (cls):
+
+        with cls._buffer_lock:
+            buffers = cls._buffers;
+            cls._buffers = {};
+            cls._flush_loop = None;
+        for path, lines in buffers.items():
+            try:
+                with cls._write_lock:
+                    os.makedirs(os.path.dirname(path), exist_ok=True);
+                    if os.path.exists(path) and os.path.getsize(path) > cls.max_file_size:
+                        os.replace(path, path + '.1');
+                    with open(path, 'a') as timing_file:
+                        timing_file.write(''.join(lines));
+            except OSError:
+                # timings must never break a kernel launch
+                pass;
+
+# spans of the last second (or of a closed event loop) are written when the Jupyter server exits
+atexit.register(LaunchTimer.flush);
+
+def read_spans (path=None):
+
+    path = path or default_timing_file();
+    spans = [];
+    for file in [path + '.1', path]:
+        if not os.path.exists(file):
+            continue;
+        with open(file, 'r') as timing_file:
+            for line in timing_file:
+                try:
+                    spans.append(json.loads(line));
+                except json.decoder.JSONDecodeError:
+                    continue;
+    return spans;
+
+def percentile (values, p):
+
+    # nearest rank on sorted values
+    if not values:
+        return None;
+    index = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1));
+    return values[index];
+
+def summarize (spans, since=None):
+
+    # (cluster, partition, phase) -> count and percentiles of the durations
+    durations = {};
+    for span in spans:
+        if since and span.get('time', 0) < since:
+            continue;
+        key = (span.get('loginnode') or '-', span.get('partition') or '-', span.get('phase'));
+        durations.setdefault(key, []).append(span.get('duration', 0.0));
+
+    summary = {};
+    for key, values in durations.items():
+        values.sort();
+        summary[key] = {'count': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90), 'p99': percentile(values, 99), 'max': values[-1]};
+    return summary;
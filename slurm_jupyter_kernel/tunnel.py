@@ -0,0 +1,236 @@
+import asyncio;
+from collections import deque;
+from time import monotonic;
+from subprocess import DEVNULL, PIPE;
+
+class SSHTunnelError (Exception):
+    pass;
+class TransportProfileError (Exception):
+    pass;
+
+# ssh settings of the tunnel, selected with the transport_profile option of the provisioner
+transport_profiles = {
+    'default': {},
+    # rich outputs (plots, dataframes, images) compress well - worth it on slow links, costs CPU on fast ones
+    'compressed': {'compression': True},
+    # AES-GCM is hardware accelerated on most CPUs, chacha20-poly1305 is fast without
+    'fast-cipher': {'ciphers': 'aes128-gcm@openssh.com,chacha20-poly1305@openssh.com'},
+    # iopub gets its own ssh process, so large outputs do not hold up shell and control replies
+    'split': {'split_channels': True},
+    # everything for a slow WAN link; the tunnel also gets its own connection to the loginnode
+    'wan': {'compression': True, 'ciphers': 'aes128-gcm@openssh.com,chacha20-poly1305@openssh.com', 'split_channels': True, 'dedicated_connection': True},
+};
+
+def transport_profile (name='default', overrides=None):
+
+    if not name in transport_profiles:
+        raise TransportProfileError(f'Unknown transport profile {name}! Available profiles: ' + ', '.join(transport_profiles.keys()));
+    profile = {'compression': False, 'ciphers': '', 'split_channels': False, 'dedicated_connection': False, 'ssh_options': {}};
+    profile.update(transport_profiles[name]);
+    for option, value in (overrides or {}).items():
+        if not option in profile:
+            raise TransportProfileError(f'Unknown transport option {option}! Available options: ' + ', '.join(profile.keys()));
+        profile[option] = value;
+    return profile;
+
+class SSHTunnel:
+
+    # ssh exits on its own if the compute node does not answer for ServerAliveInterval * ServerAliveCountMax seconds
+    server_alive_interval = 10;
+    server_alive_count_max = 3;
+    max_reconnect_delay = 30.0;
+    # seconds to wait for the first byte (or the refusal) through a forwarded port
+    probe_timeout = 1.0;
+
+    def __init__ (self, connection, exec_node, ports, timeout=10.0, log=None, profile=None, remote_ports=None):
+
+        self.connection = connection;
+        self.exec_node = exec_node;
+        self.ports = list(ports);
+        # ports on the compute node, if they differ from the local ones
+        self.remote_ports = list(remote_ports or ports);
+        self.timeout = timeout;
+        self.log = log;
+        self.profile = profile or transport_profile();
+
+        self.process = None;
+        self.monitor = None;
+        self.stderr = deque(maxlen=20);
+        self.stopped = False;
+
+        self.setup_time = None;
+        self.reconnects = 0;
+        self.failures = 0;
+
+    def command (self):
+
+        # ssh uses the first value given for an option: options of the profile go first
+        ssh_command = ['ssh', '-NA'];
+        for option, value in self.profile['ssh_options'].items():
+            ssh_command += ['-o', f'{option}={value}'];
+        if self.profile['compression']:
+            ssh_command += ['-o', 'Compression=yes'];
+        if self.profile['ciphers']:
+            ssh_command += ['-o', f'Ciphers={self.profile["ciphers"]}'];
+
+        # jump to the compute node through the master connection of the loginnode (or a connection of its own)
+        proxy_command = self.connection.proxy_command(multiplexed=not self.profile['dedicated_connection']);
+        ssh_command += ['-o', 'StrictHostKeyChecking=no', '-o', 'ExitOnForwardFailure=yes',
+                        '-o', f'ServerAliveInterval={self.server_alive_interval}', '-o', f'ServerAliveCountMax={self.server_alive_count_max}',
+                        '-o', f'ProxyCommand={proxy_command}'];
+        for port, remote_port in zip(self.ports, self.remote_ports):
+            ssh_command += ['-L', f'{port}:127.0.0.1:{remote_port}'];
+        ssh_command.append(self.exec_node);
+        return ssh_command;
+
+    async def _port_accepting (self, port):
+
+        # the local listener of ssh accepts right away - only an answer from the compute node shows the kernel is there:
+        # ZMQ sockets send their greeting at once, ssh closes the connection if the compute node refuses it
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port);
+        except OSError:
+            return False;
+        try:
+            return not await asyncio.wait_for(reader.read(1), self.probe_timeout) == b'';
+        except asyncio.TimeoutError:
+            # open but silent - no refusal arrived in time
+            return True;
+        except OSError:
+            return False;
+        finally:
+            writer.close();
+            try:
+                await writer.wait_closed();
+            except OSError:
+                pass;
+
+    async def _ports_accepting (self):
+
+        return all(await asyncio.gather(*[self._port_accepting(port) for port in self.ports]));
+
+    async def _open (self):
+
+        start = monotonic();
+        await self.connection.ensure();
+        self.process = await asyncio.create_subprocess_exec(*self.command(), stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE);
+        self.stderr.clear();
+        stderr_reader = asyncio.ensure_future(self._read_stderr(self.process));
+
+        # ready as soon as the kernel answers through all forwarded ports
+        while monotonic() - start < self.timeout:
+            if not self.process.returncode is None:
+                await stderr_reader;
+                raise SSHTunnelError('Error starting the SSH tunnel. Output:\n\n' + '\n'.join(self.stderr));
+            if await self._ports_accepting():
+                self.setup_time = monotonic() - start;
+                return;
+            await asyncio.sleep(0.05);
+
+        await self._terminate();
+        raise SSHTunnelError(f'Timeout expired when starting the SSH tunnel to compute node {self.exec_node}');
+
+    async def _read_stderr (self, process):
+
+        # keep the pipe drained for the whole lifetime of the tunnel, only the last lines are kept
+        async for line in process.stderr:
+            self.stderr.append(line.decode('utf-8', 'replace').strip());
+
+    async def start (self):
+
+        self.stopped = False;
+        await self._open();
+        self.monitor = asyncio.ensure_future(self._watch());
+
+    async def _watch (self):
+
+        # reconnect transparently whenever the tunnel process dies
+        delay = 1.0;
+        while not self.stopped:
+            await self.process.wait();
+            if self.stopped:
+                break;
+
+            if self.log:
+                self.log.warning(f'SSH tunnel to compute node {self.exec_node} died (exit code {self.process.returncode}). Reconnecting...');
+            while not self.stopped:
+                try:
+                    await self._open();
+                    self.reconnects += 1;
+                    delay = 1.0;
+                    if self.log:
+                        self.log.info(f'SSH tunnel to compute node {self.exec_node} re-established: ' + str(self.stats()));
+                    break;
+                except Exception as e:
+                    self.failures += 1;
+                    if self.log:
+                        self.log.warning(f'Reconnecting the SSH tunnel to compute node {self.exec_node} failed: {e}');
+                    await asyncio.sleep(delay);
+                    delay = min(delay * 2, self.max_reconnect_delay);
+
+    def is_alive (self):
+
+        return not self.stopped and not self.process is None and self.process.returncode is None;
+
+    async def _terminate (self):
+
+        if self.process and self.process.returncode is None:
+            try:
+                self.process.terminate();
+            except ProcessLookupError:
+                pass;
+            await self.process.wait();
+
+    async def stop (self):
+
+        self.stopped = True;
+        if self.monitor and not self.monitor.done():
+            self.monitor.cancel();
+        await self._terminate();
+
+    def stats (self):
+
+        return {'exec_node': self.exec_node, 'alive': self.is_alive(), 'setup_time': self.setup_time, 'reconnects': self.reconnects, 'failed_reconnects': self.failures};
+
+class SplitTunnel:
+
+    # one SSHTunnel for the split ports (iopub) and one for all other ports - used like a single SSHTunnel
+    def __init__ (self, connection, exec_node, ports, split_ports, timeout=10.0, log=None, profile=None, remote_ports=None):
+
+        self.exec_node = exec_node;
+        self.ports = list(ports);
+        port_map = dict(zip(self.ports, remote_ports or self.ports));
+        other_ports = [port for port in self.ports if not port in split_ports];
+        self.tunnels = [SSHTunnel(connection, exec_node, ports, timeout=timeout, log=log, profile=profile, remote_ports=[port_map[port] for port in ports])
+                        for ports in [list(split_ports), other_ports] if ports];
+
+    @property
+    def setup_time (self):
+
+        setup_times = [tunnel.setup_time for tunnel in self.tunnels if not tunnel.setup_time is None];
+        return max(setup_times) if setup_times else None;
+
+    def command (self):
+
+        return [tunnel.command() for tunnel in self.tunnels];
+
+    async def start (self):
+
+        try:
+            await asyncio.gather(*[tunnel.start() for tunnel in self.tunnels]);
+        except SSHTunnelError:
+            await self.stop();
+            raise;
+
+    def is_alive (self):
+
+        return all(tunnel.is_alive() for tunnel in self.tunnels);
+
+    async def stop (self):
+
+        for tunnel in self.tunnels:
+            await tunnel.stop();
+
+    def stats (self):
+
+        return {'exec_node': self.exec_node, 'channels': [tunnel.stats() for tunnel in self.tunnels]};
@@ -0,0 +1,170 @@
+import re;
+import asyncio;
+import threading;
+from hashlib import sha256;
+from subprocess import TimeoutExpired;
+from slurm_jupyter_kernel.job_status import SlurmStatusUnavailable;
+
+class WarmKernelPool:
+
+    # one pool per kernelspec (loginnode, sbatch flags, kernel command, environment)
+    _pools = {};
+    _pools_lock = threading.Lock();
+
+    # hard limits - warm allocations cost allocation hours
+    max_size = 8;
+    max_total_size = 16;
+    # seconds between checks for expired or cancelled pool jobs while nobody claims
+    prune_interval = 60.0;
+
+    def __init__ (self, key, connection, status_service, batch_job, job_directory, size=1, timeout=10.0, log=None):
+
+        self.key = key;
+        self.connection = connection;
+        self.status_service = status_service;
+        self.batch_job = batch_job;
+        self.job_directory = job_directory;
+        self.size = min(size, self.max_size);
+        self.timeout = timeout;
+        self.log = log;
+
+        # job ids of submitted allocations which are not claimed yet
+        self.jobs = [];
+        self._refill_task = None;
+        self._prune_task = None;
+
+        self.hits = 0;
+        self.misses = 0;
+        self.submitted = 0;
+        self.expired = 0;
+
+    @staticmethod
+    def kernelspec_key (*parts):
+
+        return sha256(repr(parts).encode()).hexdigest()[:16];
+
+    @classmethod
+    def get (cls, key, *args, **kwargs):
+
+        with cls._pools_lock:
+            if not key in cls._pools:
+                cls._pools[key] = cls(key, *args, **kwargs);
+            pool = cls._pools[key];
+            # the newest kernelspec wins, e.g. after the pool size was edited
+            pool.size = min(kwargs.get('size', pool.size), cls.max_size);
+            pool.log = kwargs.get('log', pool.log);
+            return pool;
+
+    @classmethod
+    def total_size (cls):
+
+        return sum(len(pool.jobs) for pool in cls._pools.values());
+
+    async def _job_states (self):
+
+        # all pool jobs are part of the batched squeue of the status service
+        states = {};
+        ended = [];
+        for job_id in list(self.jobs):
+            try:
+                fields = await self.status_service.get_state(job_id);
+            except SlurmStatusUnavailable:
+                continue;
+            if fields is None:
+                # the allocation reached its idle lifetime or was cancelled
+                self.jobs.remove(job_id);
+                self.status_service.unregister(job_id);
+                self.expired += 1;
+                ended.append(job_id);
+                continue;
+            states[job_id] = fields[0];
+        if ended:
+            await self._remove_job_directories(ended);
+        return states;
+
+    async def _remove_job_directories (self, job_ids):
+
+        # an expired job leaves its claimed directory behind, removed once Slurm no longer knows the job
+        remove_command = ['/bin/bash', '-c', '"rm -rf ' + ' '.join(f'{self.job_directory}/{job_id}' for job_id in job_ids) + '"'];
+        try:
+            await self.connection.run(remove_command, timeout=self.timeout);
+        except TimeoutExpired:
+            pass;
+
+    async def claim (self, connection_info):
+
+        # running allocations first - pending ones have at least spent some time in the queue already
+        states = await self._job_states();
+        candidates = sorted(states.keys(), key=lambda job_id: 0 if states[job_id] == 'RUNNING' else 1);
+
+        for job_id in candidates:
+            # another launch may have claimed it in the meantime
+            if not job_id in self.jobs:
+                continue;
+            self.jobs.remove(job_id);
+            job_directory = f'{self.job_directory}/{job_id}';
+            # mkdir is atomic: either we or the idle timeout of the job win the allocation; a running job created
+            # its directory already - if it is gone, the job ended since the cached squeue
+            create_directory = '' if states[job_id] == 'RUNNING' else f'mkdir -p {job_directory} && ';
+            claim_command = ['/bin/bash', '-c', f'"{create_directory}mkdir {job_directory}/claimed && cat > {job_directory}/connection.json.tmp && mv {job_directory}/connection.json.tmp {job_directory}/connection.json"'];
+            try:
+                returncode, _, _ = await self.connection.run(claim_command, input=connection_info.encode(), timeout=self.timeout);
+            except TimeoutExpired:
+                returncode = 1;
+            if returncode == 0:
+                self.hits += 1;
+                return int(job_id);
+            self.status_service.unregister(job_id);
+            self.expired += 1;
+
+        self.misses += 1;
+        return None;
+
+    def refill (self):
+
+        # submit missing allocations in the background
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.ensure_future(self._refill());
+        return self._refill_task;
+
+    async def _refill (self):
+
+        while len(self.jobs) < self.size and WarmKernelPool.total_size() < self.max_total_size:
+            sbatch_command = ['/bin/bash', '--login', '-c', '"sbatch --parsable"'];
+            try:
+                await self.connection.ensure();
+                returncode, sbatch_out, sbatch_err = await self.connection.run(sbatch_command, input=self.batch_job.encode(), timeout=self.timeout);
+            except Exception as e:
+                if self.log:
+                    self.log.error(f'Could not submit a warm Slurm job: {e}');
+                return;
+
+            job_id = re.search(r"(\d+)", sbatch_out.decode('utf-8'));
+            if not returncode == 0 or not job_id:
+                if self.log:
+                    self.log.error('Could not submit a warm Slurm job: ' + sbatch_err.decode('utf-8').strip());
+                return;
+
+            self.jobs.append(job_id.group(1));
+            self.status_service.register(job_id.group(1));
+            self.submitted += 1;
+            if self.log:
+                self.log.info(f'Submitted warm Slurm job {job_id.group(1)} ({len(self.jobs)}/{self.size} in pool)');
+            if self._prune_task is None or self._prune_task.done():
+                self._prune_task = asyncio.ensure_future(self._prune());
+
+    async def _prune (self):
+
+        # jobs which reached warm_pool_max_idle or were cancelled leave the pool (and their directories are removed)
+        # even if no kernel claims from it anymore - ends with the last pool job
+        while self.jobs:
+            await asyncio.sleep(self.prune_interval);
+            try:
+                await self._job_states();
+            except Exception as e:
+                if self.log:
+                    self.log.debug(f'Could not check the warm Slurm jobs: {e}');
+
+    def stats (self):
+
+        return {'size': self.size, 'idle': len(self.jobs), 'hits': self.hits, 'misses': self.misses, 'submitted': self.submitted, 'expired': self.expired};
@@ -0,0 +1,267 @@
+import os;
+import re;
+import json;
+import uuid;
+import shlex;
+import asyncio;
+import threading;
+from time import monotonic;
+from hashlib import sha256;
+from subprocess import TimeoutExpired;
+from jupyter_core.paths import jupyter_data_dir;
+from slurm_jupyter_kernel.ssh_connection import run_command;
+
+class WorkdirSyncError (Exception):
+    pass;
+
+# in the remote working directory: token of the last complete sync, and a directory which exists while a sync runs
+sync_marker = '.slurm_jupyter_kernel_sync';
+sync_lock = '.slurm_jupyter_kernel_syncing';
+# interrupted transfers continue from here instead of starting over
+partial_directory = '.slurm_jupyter_kernel_partial';
+
+# run by the batch job before the kernel starts: waits for a running sync (not for the lock of a sync which died), then the kernel starts inside the synced directory
+sync_wait_job = """sync_deadline=$((SECONDS + {TIMEOUT}))
+while [ -d {DIRECTORY}/{LOCK} ] && [ -z "$(find {DIRECTORY}/{LOCK} -maxdepth 0 -mmin +{STALE} 2> /dev/null)" ] && [ $SECONDS -lt $sync_deadline ]; do
+    sleep 0.5
+done
+cd {DIRECTORY}
+""";
+
+def default_manifest_directory ():
+
+    return os.path.join(jupyter_data_dir(), 'slurm_jupyter_kernel', 'sync');
+
+def relative_paths (local_root, paths):
+
+    # declared paths are relative to the local working directory (absolute ones have to be inside it)
+    relative = [];
+    for path in paths:
+        path = os.path.relpath(os.path.join(local_root, os.path.expanduser(path)), local_root);
+        if path == '..' or path.startswith('..' + os.sep):
+            raise WorkdirSyncError(f'Sync path {path} is outside of the working directory {local_root}');
+        relative.append(path);
+    return list(dict.fromkeys(relative));
+
+def scan_files (local_root, paths):
+
+    # relative file path -> [size, mtime] of every file below the declared paths
+    files = {};
+    for path in paths:
+        full_path = os.path.join(local_root, path);
+        if os.path.isfile(full_path) or os.path.islink(full_path):
+            walk = [(os.path.dirname(full_path), [], [os.path.basename(full_path)])];
+        else:
+            walk = os.walk(full_path);
+        for directory, _, names in walk:
+            for name in names:
+                file_path = os.path.join(directory, name);
+                try:
+                    stat = os.lstat(file_path);
+                except OSError:
+                    continue;
+                files[os.path.relpath(file_path, local_root)] = [stat.st_size, stat.st_mtime_ns];
+    return files;
+
+def parse_rsync_stats (output):
+
+    # rsync --stats, numbers with thousands separators since rsync 3.1
+    stats = {};
+    for name, pattern in [('bytes_sent', r'Total bytes sent: ([\d,.]+)'), ('transferred_size', r'Total transferred file size: ([\d,.]+)'), ('files_transferred', r'Number of regular files transferred: ([\d,.]+)')]:
+        match = re.search(pattern, output);
+        if match:
+            stats[name] = int(re.sub(r'[,.]', '', match.group(1)));
+    return stats;
+
+class WorkdirSync:
+
+    # one sync per (SSH connection, local working directory, paths, remote directory) inside this process -
+    # kernels started from the same directory wait for each other instead of sending the same files twice
+    _syncs = {};
+    _syncs_lock = threading.Lock();
+
+    # bump to throw away manifests written by older versions
+    version = 1;
+    retries = 3;
+
+    def __init__ (self, connection, local_root, paths, remote_directory, timeout=600.0, manifest_directory=None, ssh_timeout=10.0):
+
+        self.connection = connection;
+        self.local_root = local_root;
+        self.paths = paths;
+        self.remote_directory = remote_directory;
+        # timeout of one rsync attempt, and of the short remote commands (lock, unlock)
+        self.timeout = timeout;
+        self.ssh_timeout = ssh_timeout;
+        key = sha256(repr((connection.key, local_root, tuple(paths), remote_directory)).encode('utf-8')).hexdigest()[:16];
+        self.manifest_path = os.path.join(manifest_directory or default_manifest_directory(), f'{key}.json');
+        # the remote directory is named after the local one, e.g. ~/.slurm_jupyter_kernel/sync/analysis-1a2b3c4d
+        name = re.sub(r'[^\w.-]', '_', os.path.basename(local_root)) or 'root';
+        self.remote_path = f'{remote_directory.rstrip("/")}/{name}-{sha256(local_root.encode("utf-8")).hexdigest()[:8]}';
+        self.manifest = None;
+        self._lock = asyncio.Lock();
+        # the remote lock of this process is held until its transfer ends
+        self.transferring = False;
+
+        self.syncs = 0;
+        self.skipped = 0;
+        self.busy = 0;
+        self.bytes_sent = 0;
+
+    @classmethod
+    def get (cls, connection, local_root, paths, remote_directory, timeout=600.0, ssh_timeout=10.0):
+
+        paths = relative_paths(local_root, paths);
+        key = (connection.key, local_root, tuple(paths), remote_directory);
+        with cls._syncs_lock:
+            if not key in cls._syncs:
+                cls._syncs[key] = cls(connection, local_root, paths, remote_directory, timeout, ssh_timeout=ssh_timeout);
+            sync = cls._syncs[key];
+            sync.timeout = timeout;
+            sync.ssh_timeout = ssh_timeout;
+            return sync;
+
+    def load_manifest (self):
+
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file);
+        except (OSError, ValueError):
+            manifest = {};
+        if not manifest.get('version') == self.version:
+            manifest = {'version': self.version, 'remote': None, 'token': None, 'files': {}};
+        return manifest;
+
+    def save_manifest (self):
+
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True);
+            temp_path = f'{self.manifest_path}.{os.getpid()}.tmp';
+            with open(temp_path, 'w') as manifest_file:
+                json.dump(self.manifest, manifest_file);
+            os.replace(temp_path, self.manifest_path);
+        except OSError:
+            # a read-only home only costs the cache, rsync still sends deltas only
+            pass;
+
+    def rsync_command (self, remote_path):
+
+        # rsync runs through the SSH master connection; --partial-dir keeps interrupted files for the next attempt
+        ssh_command = self.connection.ssh_command(['-T'])[:-1];
+        return ['rsync', '-a', '--partial', f'--partial-dir={partial_directory}', '--from0', '--files-from=-', '--stats', '-e', shlex.join(ssh_command),
+                f'{self.local_root}/', f'{self.connection.loginnode}:{remote_path}/'];
+
+    async def prepare (self, wait_timeout):
+
+        # scans the local files and locks the remote directory if anything has to be sent - one remote command
+        # returns the absolute remote directory, the sbatch snippet and whether a transfer is needed
+        # a lock held by another client or by our own running transfer is left alone - the batch job waits until it is released
+        async with self._lock:
+            if self.manifest is None:
+                self.manifest = self.load_manifest();
+            start = monotonic();
+            files = await asyncio.get_running_loop().run_in_executor(None, scan_files, self.local_root, self.paths);
+            scan_time = monotonic() - start;
+            changed = [path for path, stat in files.items() if not self.manifest['files'].get(path) == stat];
+
+            # the manifest only counts while the remote marker still carries its token (scratch may be purged)
+            token = self.manifest['token'] or 'none';
+            stale_minutes = self.stale_minutes();
+            script = f'''sync_directory={self.remote_path}
+mkdir -p $sync_directory && cd $sync_directory || exit 1
+pwd
+marker=valid
+[ "$(cat {sync_marker} 2> /dev/null)" = {shlex.quote(token)} ] || marker=stale
+echo $marker
+if [ {int(self.transferring)} -eq 1 ]; then
+    echo busy
+elif [ $marker = stale ] || [ {int(bool(changed))} -eq 1 ]; then
+    find . -maxdepth 1 -name {sync_lock} -type d -mmin +{stale_minutes} -exec rmdir {{}} \\; 2> /dev/null
+    if mkdir {sync_lock} 2> /dev/null; then echo locked; else echo busy; fi
+fi
+''';
+            try:
+                returncode, prepare_out, prepare_err = await self.connection.run(['/bin/bash', '--login', '-s'], input=script.encode(), timeout=self.ssh_timeout);
+            except TimeoutExpired:
+                raise WorkdirSyncError('Timeout expired when preparing the remote working directory');
+            # the login shell may print a banner first - the answer is at the end
+            lines = prepare_out.decode('utf-8', 'replace').strip().splitlines();
+            locked = bool(lines) and lines[-1] == 'locked';
+            busy = bool(lines) and lines[-1] == 'busy';
+            if locked or busy:
+                lines = lines[:-1];
+            if not returncode == 0 or len(lines) < 2 or not lines[-1] in ['valid', 'stale']:
+                raise WorkdirSyncError(f'Could not create the remote working directory {self.remote_path}: ' + prepare_err.decode('utf-8', 'replace').strip());
+            remote_path, marker = lines[-2], lines[-1];
+
+            if marker == 'stale' or not self.manifest['remote'] == remote_path:
+                # unknown remote state (first sync, purged scratch, another client) - rsync compares every file,
+                # unchanged ones still cost no data
+                changed = list(files.keys());
+            if locked:
+                self.transferring = True;
+            elif busy:
+                self.busy += 1;
+            else:
+                self.skipped += 1;
+
+            snippet = sync_wait_job.format(TIMEOUT=int(wait_timeout), DIRECTORY=shlex.quote(remote_path), LOCK=sync_lock, STALE=stale_minutes);
+            return remote_path, snippet, {'files': len(files), 'changed': len(changed) if locked else 0, 'scan_time': scan_time, 'pending': (files, changed) if locked else None, 'busy': busy};
+
+    def stale_minutes (self):
+
+        # a lock older than all rsync attempts together belongs to a sync which died
+        return int(self.timeout * self.retries / 60) + 1;
+
+    async def transfer (self, remote_path, prepared):
+
+        # sends the changed files and unlocks the remote directory, retried with what was sent already kept
+        files, changed = prepared['pending'];
+        try:
+            return await self._transfer(remote_path, files, changed);
+        finally:
+            self.transferring = False;
+
+    async def _transfer (self, remote_path, files, changed):
+
+        async with self._lock:
+            start = monotonic();
+            stats = {};
+            error = None;
+            for attempt in range(self.retries):
+                try:
+                    returncode, rsync_out, rsync_err = await run_command(self.rsync_command(remote_path), input=b'\0'.join(path.encode('utf-8') for path in changed), timeout=self.timeout);
+                except FileNotFoundError:
+                    error = 'rsync is not installed';
+                    break;
+                except TimeoutExpired:
+                    returncode, rsync_out, rsync_err = None, b'', f'timeout expired after {self.timeout}s'.encode();
+                stats = parse_rsync_stats(rsync_out.decode('utf-8', 'replace'));
+                self.bytes_sent += stats.get('bytes_sent', 0);
+                # 24: files vanished while sending - they are gone locally as well
+                if returncode in [0, 24]:
+                    error = None;
+                    break;
+                error = rsync_err.decode('utf-8', 'replace').strip() or f'rsync exited with code {returncode}';
+                await asyncio.sleep(2 ** attempt);
+
+            new_token = uuid.uuid4().hex if error is None else 'failed';
+            unlock = f'cd {shlex.quote(remote_path)} && echo {new_token} > {sync_marker} && rmdir {sync_lock}\n';
+            try:
+                await self.connection.run(['/bin/bash', '--login', '-s'], input=unlock.encode(), timeout=self.ssh_timeout);
+            except TimeoutExpired:
+                # the batch job stops waiting at its deadline
+                pass;
+            if error is not None:
+                self.manifest['token'] = None;
+                raise WorkdirSyncError(f'Could not sync {self.local_root} to {remote_path}: {error}');
+
+            self.manifest = {'version': self.version, 'remote': remote_path, 'token': new_token, 'files': files};
+            self.save_manifest();
+            self.syncs += 1;
+            stats.update({'duration': monotonic() - start, 'attempts': attempt + 1});
+            return stats;
+
+    def stats (self):
+
+        return {'syncs': self.syncs, 'skipped': self.skipped, 'busy': self.busy, 'bytes_sent': self.bytes_sent, 'files': len((self.manifest or {}).get('files', {}))};
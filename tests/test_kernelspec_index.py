@@ -0,0 +1,115 @@
+import os;
+import json;
+from slurm_jupyter_kernel.kernelspec_index import KernelspecIndex;
+
+def slurm_spec (display_name):
+
+    return {'argv': ['python', '-m', 'ipykernel_launcher', '-f', '{connection_file}'], 'display_name': display_name, 'language': 'python',
+            'metadata': {'kernel_provisioner': {'provisioner_name': 'remote-slurm-provisioner', 'config': {'loginnode': 'login'}}}};
+
+def write_kernelspec (kernel_dir, name, spec, mtime=None):
+
+    # explicit mtimes: two writes within one timestamp tick of the filesystem look unchanged
+    os.makedirs(kernel_dir / name, exist_ok=True);
+    kernel_file = kernel_dir / name / 'kernel.json';
+    kernel_file.write_text(spec if isinstance(spec, str) else json.dumps(spec));
+    if mtime is not None:
+        os.utime(kernel_file, ns=(mtime, mtime));
+        os.utime(kernel_dir, ns=(mtime, mtime));
+
+def index_for (tmp_path, *kernel_dirs):
+
+    return KernelspecIndex(path=str(tmp_path / 'index.json'), kernel_dirs=[str(kernel_dir) for kernel_dir in kernel_dirs]);
+
+def test_scan_parses_once (tmp_path):
+
+    kernel_dir = tmp_path / 'kernels';
+    write_kernelspec(kernel_dir, 'slurm-a', slurm_spec('A'));
+    write_kernelspec(kernel_dir, 'local', {'argv': ['python'], 'display_name': 'Local', 'language': 'python'});
+    index = index_for(tmp_path, kernel_dir);
+    found = index.scan();
+    assert sorted(found.keys()) == ['local', 'slurm-a'];
+    assert index.parsed == 2;
+    assert found['slurm-a'][1]['slurm'] and found['slurm-a'][1]['spec']['display_name'] == 'A';
+    # only Slurm kernelspecs are kept in the index
+    assert not found['local'][1]['slurm'] and found['local'][1]['spec'] is None;
+
+    # the next Jupyter server start reads the index instead of the files
+    index = index_for(tmp_path, kernel_dir);
+    found = index.scan();
+    assert index.parsed == 0;
+    assert index.reused == 2;
+    assert found['slurm-a'][0] == str(kernel_dir / 'slurm-a');
+
+def test_changed_kernelspec_is_parsed_again (tmp_path):
+
+    kernel_dir = tmp_path / 'kernels';
+    write_kernelspec(kernel_dir, 'slurm-a', slurm_spec('A'), mtime=1_000_000_000);
+    index_for(tmp_path, kernel_dir).scan();
+    write_kernelspec(kernel_dir, 'slurm-a', slurm_spec('A (new partition)'), mtime=2_000_000_000);
+    index = index_for(tmp_path, kernel_dir);
+    found = index.scan();
+    assert index.parsed == 1;
+    assert found['slurm-a'][1]['spec']['display_name'] == 'A (new partition)';
+
+def test_touched_kernelspec_is_reused (tmp_path):
+
+    kernel_dir = tmp_path / 'kernels';
+    write_kernelspec(kernel_dir, 'slurm-a', slurm_spec('A'), mtime=1_000_000_000);
+    index_for(tmp_path, kernel_dir).scan();
+    os.utime(kernel_dir / 'slurm-a' / 'kernel.json', ns=(2_000_000_000, 2_000_000_000));
+    index = index_for(tmp_path, kernel_dir);
+    index.scan();
+    # same content: the hash matches, the new mtime is remembered
+    assert index.parsed == 0;
+    assert index.kernelspecs[str(kernel_dir / 'slurm-a')]['mtime'] == 2_000_000_000;
+
+def test_added_and_removed_kernelspecs (tmp_path):
+
+    kernel_dir = tmp_path / 'kernels';
+    write_kernelspec(kernel_dir, 'slurm-a', slurm_spec('A'), mtime=1_000_000_000);
+    index_for(tmp_path, kernel_dir).scan();
+    write_kernelspec(kernel_dir, 'slurm-b', slurm_spec('B'), mtime=2_000_000_000);
+    os.remove(kernel_dir / 'slurm-a' / 'kernel.json');
+    os.rmdir(kernel_dir / 'slurm-a');
+    os.utime(kernel_dir, ns=(3_000_000_000, 3_000_000_000));
+    index = index_for(tmp_path, kernel_dir);
+    found = index.scan();
+    assert list(found.keys()) == ['slurm-b'];
+    assert not str(kernel_dir / 'slurm-a') in index.kernelspecs;
+
+def test_first_kernel_dir_wins (tmp_path):
+
+    user_dir, system_dir = tmp_path / 'user', tmp_path / 'system';
+    write_kernelspec(user_dir, 'Slurm-A', slurm_spec('user'));
+    write_kernelspec(system_dir, 'slurm-a', slurm_spec('system'));
+    found = index_for(tmp_path, user_dir, tmp_path / 'missing', system_dir).scan();
+    assert list(found.keys()) == ['slurm-a'];
+    assert found['slurm-a'][1]['spec']['display_name'] == 'user';
+
+def test_invalid_kernelspec (tmp_path):
+
+    kernel_dir = tmp_path / 'kernels';
+    write_kernelspec(kernel_dir, 'broken', '{"argv": [');
+    os.makedirs(kernel_dir / 'empty');
+    found = index_for(tmp_path, kernel_dir).scan();
+    assert list(found.keys()) == ['broken'];
+    assert not found['broken'][1]['valid'];
+
+def test_rescan_and_version (tmp_path):
+
+    kernel_dir = tmp_path / 'kernels';
+    write_kernelspec(kernel_dir, 'slurm-a', slurm_spec('A'));
+    index_for(tmp_path, kernel_dir).scan();
+    index = index_for(tmp_path, kernel_dir);
+    index.scan(rescan=True);
+    assert index.parsed == 1;
+
+    # an index of another version is thrown away
+    index_data = json.loads((tmp_path / 'index.json').read_text());
+    index_data['version'] = KernelspecIndex.version + 1;
+    (tmp_path / 'index.json').write_text(json.dumps(index_data));
+    index = index_for(tmp_path, kernel_dir);
+    index.scan();
+    assert index.parsed == 1;
+    assert json.loads((tmp_path / 'index.json').read_text())['version'] == KernelspecIndex.version;
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta;
+from slurm_jupyter_kernel.poll_scheduler import PollScheduler;
+
+cluster_now = datetime(2024, 5, 2, 12, 0, 0);
+
+def pending_for (scheduler, seconds):
+
+    # the scheduler measures the pending time itself - move its start back instead of waiting
+    scheduler.next_interval('PENDING', 'N/A', 'Priority');
+    scheduler.pending_since -= seconds;
+
+def start_in (seconds):
+
+    return (cluster_now + timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S');
+
+def test_parse_start_time ():
+
+    assert PollScheduler.parse_start_time('2024-05-02T14:03:11') == datetime(2024, 5, 2, 14, 3, 11);
+    assert PollScheduler.parse_start_time('N/A') is None;
+    assert PollScheduler.parse_start_time('Unknown') is None;
+    assert PollScheduler.parse_start_time(None) is None;
+
+def test_not_pending_resets ():
+
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    pending_for(scheduler, 600);
+    assert scheduler.next_interval('RUNNING') == 0.5;
+    assert scheduler.pending_since is None;
+    assert scheduler.expected_wait is None;
+
+def test_backoff_grows ():
+
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    first = scheduler.next_interval('PENDING', 'N/A', 'Priority');
+    scheduler.pending_since -= 120;
+    later = scheduler.next_interval('PENDING', 'N/A', 'Priority');
+    assert first == PollScheduler.base_interval;
+    assert later > first;
+
+def test_backoff_limits_depend_on_reason ():
+
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    pending_for(scheduler, 3600);
+    # Priority/Resources may start any moment, held jobs will not
+    assert scheduler.next_interval('PENDING', 'N/A', 'Resources') == 60.0;
+    assert scheduler.next_interval('PENDING', 'N/A', 'JobHeldUser') == 120.0;
+    assert scheduler.next_interval('PENDING', 'N/A', None) == 60.0;
+
+def test_no_overflow_after_days ():
+
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    pending_for(scheduler, 3 * 86400);
+    assert scheduler.next_interval('PENDING', 'N/A', 'Dependency') == 120.0;
+
+def test_near_start_polls_fast ():
+
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    pending_for(scheduler, 3600);
+    assert scheduler.next_interval('PENDING', start_in(10), 'Priority', cluster_now=cluster_now) == 0.5;
+    assert scheduler.expected_wait == 10.0;
+
+def test_wakes_up_before_start ():
+
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    pending_for(scheduler, 3600);
+    interval = scheduler.next_interval('PENDING', start_in(40), 'Dependency', cluster_now=cluster_now);
+    assert interval == 40 - PollScheduler.near_start_window;
+
+def test_past_estimate_is_unknown ():
+
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    pending_for(scheduler, 3600);
+    interval = scheduler.next_interval('PENDING', start_in(-3600), 'Priority', cluster_now=cluster_now);
+    assert scheduler.expected_wait is None;
+    assert interval == 60.0;
+
+def test_cluster_clock_is_used ():
+
+    # measured against the cluster clock - the clock of the Jupyter host (years later here) would put the estimate in the past
+    scheduler = PollScheduler(min_interval=0.5, max_interval=120.0);
+    pending_for(scheduler, 60);
+    scheduler.next_interval('PENDING', start_in(600), 'Priority', cluster_now=cluster_now);
+    assert scheduler.expected_wait == 600.0;
+
+def test_interval_bounds ():
+
+    scheduler = PollScheduler(min_interval=2.0, max_interval=10.0);
+    assert scheduler.next_interval('PENDING', start_in(1), 'Priority', cluster_now=cluster_now) == 2.0;
+    pending_for(scheduler, 3600);
+    assert scheduler.next_interval('PENDING', 'N/A', 'Dependency') == 10.0;
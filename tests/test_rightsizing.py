@@ -0,0 +1,120 @@
+from slurm_jupyter_kernel.rightsizing import parse_time, format_time, parse_memory, format_memory, parse_sacct, suggest_sbatch_flags;
+
+def sacct_line (job_id, state='COMPLETED', elapsed='00:30:00', time_limit='120', req_mem='8G', tres='billing=4,cpu=4,mem=8G,node=1', max_rss='', name='jupyter_slurm_kernel', partition='normal'):
+
+    return '|'.join([job_id, name, partition, state, elapsed, time_limit, req_mem, tres, max_rss]);
+
+def job (elapsed=1800.0, max_rss=2 * 1024 ** 3, state='COMPLETED', partition='normal', tres=None):
+
+    return {'job_id': '1', 'partition': partition, 'state': state, 'elapsed': elapsed, 'time_limit': 7200.0, 'req_mem': 8 * 1024 ** 3,
+            'tres': tres or {'cpu': '4', 'mem': '8G'}, 'max_rss': max_rss};
+
+def test_parse_time ():
+
+    assert parse_time('30') == 1800;
+    assert parse_time('05:30') == 330;
+    assert parse_time('01:02:03') == 3723;
+    assert parse_time('2-03') == 2 * 86400 + 3 * 3600;
+    assert parse_time('1-00:30:00') == 86400 + 1800;
+    assert parse_time('UNLIMITED') is None;
+    assert parse_time('') is None;
+
+def test_format_time ():
+
+    assert format_time(3723) == '01:02:03';
+    assert format_time(86400 + 900) == '1-00:15:00';
+    # never shorter than asked for
+    assert format_time(59.2) == '00:01:00';
+
+def test_parse_memory ():
+
+    assert parse_memory('4000M') == 4000 * 1024 ** 2;
+    assert parse_memory('1.5G') == int(1.5 * 1024 ** 3);
+    assert parse_memory('4000Mn') == 4000 * 1024 ** 2;
+    assert parse_memory('2Gc') == 2 * 1024 ** 3;
+    assert parse_memory('123456', default_unit='K') == 123456 * 1024;
+    assert parse_memory('lots') is None;
+
+def test_format_memory_rounds_up ():
+
+    assert format_memory(3 * 1024 ** 3) == '3G';
+    assert format_memory(3 * 1024 ** 3 + 1) == '4G';
+    assert format_memory(300 * 1024 ** 2) == '512M';
+    assert format_memory(1) == '256M';
+
+def test_parse_sacct ():
+
+    output = '\n'.join([
+        sacct_line('100', state='CANCELLED by 1234', elapsed='01:00:00', time_limit='240'),
+        sacct_line('100.batch', name='batch', state='CANCELLED', max_rss='1048576K'),
+        sacct_line('100.0', name='kernel', state='CANCELLED', max_rss='3G'),
+        sacct_line('101', state='TIMEOUT', time_limit='UNLIMITED'),
+        # other jobs of the user and broken lines are left out
+        sacct_line('102', name='simulation'),
+        sacct_line('102.batch', name='batch', max_rss='10G'),
+        'not|enough|fields',
+    ]);
+    jobs = {job['job_id']: job for job in parse_sacct(output)};
+    assert sorted(jobs.keys()) == ['100', '101'];
+    assert jobs['100']['state'] == 'CANCELLED';
+    assert jobs['100']['elapsed'] == 3600;
+    assert jobs['100']['time_limit'] == 240 * 60;
+    assert jobs['100']['req_mem'] == 8 * 1024 ** 3;
+    assert jobs['100']['tres'] == {'billing': '4', 'cpu': '4', 'mem': '8G', 'node': '1'};
+    # the largest MaxRSS of all steps
+    assert jobs['100']['max_rss'] == 3 * 1024 ** 3;
+    assert jobs['101']['time_limit'] is None;
+    assert jobs['101']['max_rss'] is None;
+
+def test_parse_sacct_step_before_job ():
+
+    jobs = parse_sacct('\n'.join([sacct_line('200.batch', name='batch', max_rss='512M'), sacct_line('200')]));
+    assert len(jobs) == 1;
+    assert jobs[0]['max_rss'] == 512 * 1024 ** 2;
+
+def test_suggestion_rounds_up ():
+
+    # p95 of 50 minutes * 1.2 = 60 minutes, 2.5G * 1.2 = 3G
+    jobs = [job(elapsed=3000.0, max_rss=int(2.5 * 1024 ** 3)) for _ in range(10)];
+    suggestion = suggest_sbatch_flags(jobs, {'partition': 'normal', 'cpus-per-task': 4, 'time': '04:00:00', 'mem': '16G'});
+    assert suggestion['samples'] == 10;
+    assert suggestion['flags'] == {'time': '01:00:00', 'mem': '3G'};
+    # one second more is the next quarter hour, one byte more the next gigabyte
+    jobs = [job(elapsed=3000.0 + 1 / 1.2, max_rss=int(2.5 * 1024 ** 3) + 1) for _ in range(10)];
+    suggestion = suggest_sbatch_flags(jobs, {'partition': 'normal', 'cpus-per-task': 4, 'time': '04:00:00', 'mem': '16G'});
+    assert suggestion['flags'] == {'time': '01:15:00', 'mem': '4G'};
+
+def test_suggestion_never_grows ():
+
+    jobs = [job(elapsed=3000.0, max_rss=6 * 1024 ** 3) for _ in range(10)];
+    suggestion = suggest_sbatch_flags(jobs, {'time': '01:00:00', 'mem': '4G'});
+    assert suggestion['flags'] == {};
+
+def test_suggestion_bounds ():
+
+    jobs = [job(elapsed=60.0, max_rss=100 * 1024 ** 2) for _ in range(10)];
+    suggestion = suggest_sbatch_flags(jobs, {'time': '08:00:00', 'mem': '16G'}, bounds={'time': ['00:30:00', '02:00:00'], 'mem': ['2G']});
+    assert suggestion['flags'] == {'time': '00:30:00', 'mem': '2G'};
+
+def test_suggestion_needs_samples ():
+
+    jobs = [job() for _ in range(4)];
+    suggestion = suggest_sbatch_flags(jobs, {'time': '04:00:00', 'mem': '16G'});
+    assert suggestion['flags'] == {};
+    assert suggestion['samples'] == 4;
+    assert suggestion['reasons'];
+
+def test_suggestion_skips_limited_jobs ():
+
+    # time limits and out of memory kills say nothing about what was needed
+    jobs = [job() for _ in range(8)] + [job(state='TIMEOUT'), job(state='TIMEOUT'), job(state='OUT_OF_MEMORY')];
+    suggestion = suggest_sbatch_flags(jobs, {'time': '04:00:00', 'mem': '16G'});
+    assert suggestion['flags'] == {};
+    assert len(suggestion['reasons']) == 2;
+
+def test_suggestion_only_same_shape ():
+
+    jobs = [job(partition='gpu') for _ in range(5)] + [job(tres={'cpu': '8'}) for _ in range(5)] + [job(tres={'cpu': '4', 'gres/gpu': '1'}) for _ in range(5)];
+    suggestion = suggest_sbatch_flags(jobs, {'partition': 'normal', 'cpus-per-task': 4, 'time': '04:00:00', 'mem': '16G'});
+    assert suggestion['samples'] == 0;
+    assert suggest_sbatch_flags(jobs, {'partition': 'gpu', 'time': '04:00:00', 'mem': '16G'})['samples'] == 5;
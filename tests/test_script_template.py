@@ -0,0 +1,124 @@
+import os;
+import subprocess;
+from slurm_jupyter_kernel.script_template import ScriptTemplate, TemplateCache;
+
+marker = '@@test';
+
+def cache_in (tmp_path, execute_lines, kernel_specs, force=False):
+
+    cache = TemplateCache(execute_lines, kernel_specs, force=force);
+    cache.directory = str(tmp_path / 'cache');
+    return cache;
+
+def run_script (batch_script, directory):
+
+    # like run_batch: from a file, the script closes its stdin
+    script_path = os.path.join(directory, 'batch.sh');
+    with open(script_path, 'w') as script_file:
+        script_file.write(batch_script);
+    result = subprocess.run(['bash', script_path], capture_output=True, text=True);
+    # the markers the script reports: start, end, skip, cached
+    return result.returncode, [line.split()[1:] for line in result.stdout.splitlines() if line.startswith(marker)];
+
+def run (execute_lines, cache):
+
+    return run_script(ScriptTemplate.render_batch(execute_lines, marker, cache), os.path.dirname(cache.directory));
+
+def steps (reported, kind):
+
+    return [int(fields[1]) for fields in reported if fields[0] == kind];
+
+def venv_template (tmp_path):
+
+    venv = tmp_path / 'venv';
+    execute_lines = ['export PIP_NO_CACHE_DIR=1', f'mkdir {venv}', f'touch {venv}/installed', f'echo wrapper > {venv}/wrapper.sh', f'chmod +x {venv}/wrapper.sh'];
+    return execute_lines, {'ARGV': f'{venv}/wrapper.sh ipython kernel -f {{connection_file}}'};
+
+def test_render_batch_without_cache (tmp_path):
+
+    batch_script = ScriptTemplate.render_batch(['echo one', 'false', 'echo three'], marker);
+    assert batch_script.startswith('exec 2>&1 < /dev/null\n');
+    returncode, reported = run_script(batch_script, tmp_path);
+    # the first failing step ends the script
+    assert reported == [['start', '1'], ['end', '1', '0'], ['start', '2'], ['end', '2', '1']];
+    assert returncode == 1;
+
+def test_shell_state_lines_are_not_cached ():
+
+    cache = TemplateCache(['module load Python', 'cd $HOME', 'pip install ipykernel', 'source venv/bin/activate'], {});
+    assert cache.marker(0) is None;
+    assert cache.marker(1) is None;
+    assert cache.marker(2) is not None;
+    assert cache.marker(3) is None;
+
+def test_keys_depend_on_previous_lines ():
+
+    first = TemplateCache(['mkdir a', 'touch a/b'], {});
+    second = TemplateCache(['mkdir c', 'touch a/b'], {});
+    assert not first.keys[1] == second.keys[1];
+    assert not first.complete_key == TemplateCache(['mkdir a', 'touch a/b'], {'ARGV': 'python'}).complete_key;
+
+def test_installed_environment_is_cached (tmp_path):
+
+    execute_lines, kernel_specs = venv_template(tmp_path);
+    returncode, reported = run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    assert returncode == 0;
+    assert steps(reported, 'end') == [1, 2, 3, 4, 5];
+    returncode, reported = run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    assert returncode == 0;
+    assert reported == [['cached']];
+
+def test_removed_executable_installs_again (tmp_path):
+
+    execute_lines, kernel_specs = venv_template(tmp_path);
+    run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    os.remove(tmp_path / 'venv' / 'wrapper.sh');
+    returncode, reported = run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    assert returncode == 1;
+    # all markers were removed: mkdir runs again and fails on the existing directory
+    assert steps(reported, 'start') == [1, 2];
+    assert steps(reported, 'skip') == [];
+
+def test_step_result_is_checked (tmp_path):
+
+    execute_lines, kernel_specs = venv_template(tmp_path);
+    run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    os.remove(tmp_path / 'venv' / 'installed');
+    returncode, reported = run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    assert returncode == 0;
+    # the step whose file is gone runs again, and every step after it
+    assert steps(reported, 'skip') == [2];
+    assert steps(reported, 'end') == [1, 3, 4, 5];
+    assert (tmp_path / 'venv' / 'installed').exists();
+
+def test_failed_run_continues (tmp_path):
+
+    execute_lines, kernel_specs = venv_template(tmp_path);
+    failing_lines = execute_lines[:3] + ['false'];
+    returncode, _ = run(failing_lines, cache_in(tmp_path, failing_lines, kernel_specs));
+    assert returncode == 1;
+    returncode, reported = run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    assert returncode == 0;
+    assert steps(reported, 'skip') == [2, 3];
+    assert steps(reported, 'end') == [1, 4, 5];
+
+def test_step_after_a_repeated_step_runs_again (tmp_path):
+
+    # the second step has no path to check - it is only trusted while the step before it is
+    venv = tmp_path / 'venv';
+    execute_lines = [f'mkdir -p {venv}', f'echo installed >> {tmp_path}/log'];
+    run(execute_lines, cache_in(tmp_path, execute_lines, {}));
+    os.rmdir(venv);
+    os.remove(tmp_path / 'cache' / cache_in(tmp_path, execute_lines, {}).complete_key);
+    returncode, reported = run(execute_lines, cache_in(tmp_path, execute_lines, {}));
+    assert returncode == 0;
+    assert steps(reported, 'end') == [1, 2];
+
+def test_force_runs_every_step (tmp_path):
+
+    execute_lines, kernel_specs = venv_template(tmp_path);
+    execute_lines[1] = f'mkdir -p {tmp_path}/venv';
+    run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs));
+    returncode, reported = run(execute_lines, cache_in(tmp_path, execute_lines, kernel_specs, force=True));
+    assert returncode == 0;
+    assert steps(reported, 'end') == [1, 2, 3, 4, 5];
@@ -0,0 +1,44 @@
+from slurm_jupyter_kernel.shared_allocation import scale_resource, split_sbatch_flags;
+
+def test_scale_resource_units ():
+
+    assert scale_resource('4G', 4) == '16G';
+    assert scale_resource('500M', 3) == '1500M';
+    assert scale_resource('2048', 2) == '4096';
+    assert scale_resource(8, 2) == '16';
+
+def test_scale_resource_gres ():
+
+    # only the count at the end is scaled
+    assert scale_resource('gpu:a100:1', 4) == 'gpu:a100:4';
+    assert scale_resource('gpu:2', 2) == 'gpu:4';
+    assert scale_resource('a100:1', 3) == 'a100:3';
+
+def test_scale_resource_without_count ():
+
+    assert scale_resource('gpu', 4) == 'gpu';
+    assert scale_resource('', 4) == '';
+
+def test_split_scales_allocation ():
+
+    allocation_flags, step_flags = split_sbatch_flags({'partition': 'gpu', 'time': '01:00:00', 'cpus-per-task': 8, 'mem': '4G', 'gres': 'gpu:a100:1'}, 4);
+    assert allocation_flags == {'partition': 'gpu', 'time': '01:00:00', 'cpus-per-task': 8, 'mem': '16G', 'gres': 'gpu:a100:4', 'ntasks': 4, 'nodes': 1};
+    # every job step gets the resources of one kernel
+    assert step_flags == {'cpus-per-task': 8, 'mem': '4G', 'gres': 'gpu:a100:1'};
+
+def test_split_drops_ntasks ():
+
+    allocation_flags, step_flags = split_sbatch_flags({'ntasks': 2, 'ntasks-per-node': 2, 'mem-per-cpu': '1G'}, 3);
+    assert allocation_flags['ntasks'] == 3;
+    assert not 'ntasks-per-node' in allocation_flags;
+    # per cpu - grows with the tasks on its own
+    assert allocation_flags['mem-per-cpu'] == '1G';
+    assert step_flags == {'mem-per-cpu': '1G'};
+
+def test_split_nodes ():
+
+    allocation_flags, _ = split_sbatch_flags({'mem': '4G'}, 2);
+    assert allocation_flags['nodes'] == 1;
+    allocation_flags, step_flags = split_sbatch_flags({'mem': '4G', 'nodes': 2}, 2);
+    assert allocation_flags['nodes'] == 2;
+    assert not 'nodes' in step_flags;
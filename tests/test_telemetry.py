@@ -0,0 +1,80 @@
+import asyncio;
+import pytest;
+from slurm_jupyter_kernel.telemetry import parse_tres, parse_bytes, parse_sstat, JobTelemetry;
+
+def test_parse_tres ():
+
+    assert parse_tres('cpu=00:01:02,energy=0,fs/disk=123456,mem=1.50G,pages=0,vmem=2G') == {'cpu': '00:01:02', 'energy': '0', 'fs/disk': '123456', 'mem': '1.50G', 'pages': '0', 'vmem': '2G'};
+    assert parse_tres('') == {};
+
+def test_parse_bytes ():
+
+    assert parse_bytes('123456') == 123456;
+    assert parse_bytes(0) == 0;
+    assert parse_bytes('1.50G') == int(1.5 * 1024 ** 3);
+    assert parse_bytes('512K') == 512 * 1024;
+    assert parse_bytes('') == 0;
+
+def test_parse_sstat_sums_steps ():
+
+    output = '\n'.join([
+        '4711.extern|cpu=00:00:00,fs/disk=0,mem=1M|fs/disk=0',
+        '4711.batch|cpu=00:01:00,fs/disk=2048,mem=100M|fs/disk=1024',
+        '4711.0|cpu=01:00:30,fs/disk=1000000,mem=1.5G|fs/disk=4096',
+        '4712.batch|cpu=00:00:05,mem=10M|',
+    ]);
+    usage = parse_sstat(output);
+    assert sorted(usage.keys()) == ['4711', '4712'];
+    assert usage['4711'] == {'cpu_time': 60.0 + 3630.0, 'mem': 1024 ** 2 + 100 * 1024 ** 2 + int(1.5 * 1024 ** 3), 'read': 1002048, 'write': 5120};
+    assert usage['4712'] == {'cpu_time': 5.0, 'mem': 10 * 1024 ** 2, 'read': 0, 'write': 0};
+
+def test_parse_sstat_skips_noise ():
+
+    # login banners and errors of sstat are no steps
+    output = 'Welcome to the cluster\nsstat: error: no steps running for job 4713\n\n4714.batch|cpu=00:00:01,mem=1M|fs/disk=0\n';
+    assert list(parse_sstat(output).keys()) == ['4714'];
+
+def test_parse_sstat_array_task ():
+
+    assert list(parse_sstat('4715_3.batch|cpu=00:00:01,mem=1M|fs/disk=0').keys()) == ['4715_3'];
+
+class Connection:
+
+    key = 'login';
+
+    def __init__ (self, outputs):
+
+        self.outputs = outputs;
+        self.commands = [];
+
+    async def ensure (self):
+
+        pass;
+
+    async def run (self, command, timeout=None):
+
+        self.commands.append(command);
+        return 0, self.outputs.pop(0).encode(), b'';
+
+def test_sample_rates ():
+
+    connection = Connection(['4711.batch|cpu=00:00:10,fs/disk=1000,mem=1G|fs/disk=0', '4711.batch|cpu=00:00:30,fs/disk=3000,mem=1G|fs/disk=500']);
+    telemetry = JobTelemetry(connection);
+    telemetry.samples['4711'] = [];
+
+    async def sample_twice ():
+        await telemetry.sample(['4711', '4712']);
+        # the rates are per second since the previous sample
+        telemetry._previous['4711'] = (telemetry._previous['4711'][0] - 10.0, telemetry._previous['4711'][1]);
+        await telemetry.sample(['4711', '4712']);
+
+    asyncio.run(sample_twice());
+    first, second = telemetry.samples['4711'];
+    assert first['cpu_load'] is None;
+    assert second['cpu_load'] == 2.0;
+    # a few milliseconds pass between the samples as well
+    assert second['read_rate'] == pytest.approx(200, abs=1);
+    assert second['write_rate'] == pytest.approx(50, abs=1);
+    # one sstat for all jobs
+    assert len(connection.commands) == 2 and '-j 4711,4712' in connection.commands[0][-1];
+    assert telemetry.stats()['queries'] == 2;